@@ -3,16 +3,250 @@ import threading
 import struct
 import time
 import hashlib
-import sqlite3
 import json
 from datetime import datetime
-import tkinter as tk
-from tkinter import ttk, scrolledtext, messagebox, simpledialog
 import select
 import queue
 import re
 import os
-import pickle
+import sys
+import importlib
+import contextlib
+import atexit
+import collections
+import itertools
+import argparse
+import mmap
+import random
+import bisect
+import math
+import heapq
+
+
+class _LazyModule:
+    """Модуль, который импортируется при первом обращении к атрибуту.
+
+    Ретранслятор, нагрузочный тест и рабочий процесс не загружают Tk,
+    а сервер метрик - только если он включен.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self._name)
+            self.__dict__['_module'] = module
+        return getattr(module, attr)
+
+
+tk = _LazyModule('tkinter')
+ttk = _LazyModule('tkinter.ttk')
+scrolledtext = _LazyModule('tkinter.scrolledtext')
+messagebox = _LazyModule('tkinter.messagebox')
+simpledialog = _LazyModule('tkinter.simpledialog')
+filedialog = _LazyModule('tkinter.filedialog')
+sqlite3 = _LazyModule('sqlite3')
+pickle = _LazyModule('pickle')
+multiprocessing = _LazyModule('multiprocessing')
+http_server = _LazyModule('http.server')
+tempfile = _LazyModule('tempfile')
+shutil = _LazyModule('shutil')
+fcntl = _LazyModule('fcntl')
+msvcrt = _LazyModule('msvcrt')
+
+
+class StartupProfile:
+    """Отметки времени запуска для --profile-startup"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.enabled = False
+        self.marks = {}
+
+    def mark(self, name):
+        """Отметка этапа; повторные отметки игнорируются"""
+        if name in self.marks:
+            return
+        elapsed = (time.perf_counter() - self.started) * 1000
+        self.marks[name] = elapsed
+        if self.enabled:
+            print(f"[startup] {name}: {elapsed:.1f} ms", flush=True)
+
+
+startup_profile = StartupProfile()
+
+
+class PersistentStore:
+    """Словарь в pickle-файле с отложенной атомарной записью.
+
+    Изменения сразу видны в памяти, а на диск их пишет фоновый поток не
+    раньше чем через flush_delay секунд после первого изменения: сначала во
+    временный файл, затем os.replace, поэтому файл на диске всегда целый.
+    Все set внутри transaction() дают одну запись и одно уведомление
+    подписчикам, исключение откатывает их. Вложенные транзакции сливаются
+    с внешней. На один путь в процессе приходится один экземпляр.
+    """
+
+    FLUSH_DELAY = 0.5
+
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path, defaults=None):
+        """Общее хранилище для файла path"""
+        with cls._stores_lock:
+            key = os.path.abspath(path)
+            store = cls._stores.get(key)
+            if store is None:
+                store = cls._stores[key] = cls(path, defaults)
+            elif defaults:
+                with store.lock:
+                    for name, value in defaults.items():
+                        store.data.setdefault(name, value)
+            return store
+
+    def __init__(self, path, defaults=None, flush_delay=FLUSH_DELAY):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.data = dict(defaults or {})
+        self.data.update(self.load())
+
+        self.lock = threading.RLock()
+        self.write_lock = threading.Lock()
+        self.flush_needed = threading.Event()
+        self.dirty = False
+        self.depth = 0
+        self.changes = {}
+        self.listeners = []
+        self.flusher = None
+
+        # Фоновый поток - демон, недописанное сохраняется при выходе
+        atexit.register(self.flush)
+
+    def load(self):
+        """Чтение файла; пустой словарь, если его нет или он поврежден"""
+        try:
+            with open(self.path, 'rb') as f:
+                loaded = pickle.load(f)
+            if isinstance(loaded, dict):
+                return loaded
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Error loading {self.path}: {e}")
+        return {}
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.data.get(key, default)
+
+    def snapshot(self):
+        """Копия всех значений"""
+        with self.lock:
+            return dict(self.data)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Группа изменений с одной записью и одним уведомлением"""
+        with self.lock:
+            outer = self.depth == 0
+            if outer:
+                backup, self.changes = dict(self.data), {}
+            self.depth += 1
+            try:
+                yield self
+            except BaseException:
+                if outer:
+                    self.data, self.changes = backup, {}
+                raise
+            finally:
+                self.depth -= 1
+
+            if not outer:
+                return
+            changes, self.changes = self.changes, {}
+            if changes:
+                self.schedule_flush()
+
+        if changes:
+            self.notify(changes)
+
+    def set(self, key, value):
+        """Установка значения; совпадающее значение ничего не пишет"""
+        with self.transaction():
+            if key not in self.data or self.data[key] != value:
+                self.data[key] = value
+                self.changes[key] = value
+
+    def update(self, values):
+        with self.transaction():
+            for key, value in values.items():
+                self.set(key, value)
+
+    def delete(self, key):
+        """Удаление ключа; подписчики получают для него None"""
+        with self.transaction():
+            if key in self.data:
+                del self.data[key]
+                self.changes[key] = None
+
+    def subscribe(self, callback):
+        """callback(changes) вызывается после каждой транзакции"""
+        with self.lock:
+            self.listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.listeners:
+                self.listeners.remove(callback)
+
+    def notify(self, changes):
+        with self.lock:
+            listeners = list(self.listeners)
+        for callback in listeners:
+            try:
+                callback(changes)
+            except Exception as e:
+                print(f"Settings listener error: {e}")
+
+    def schedule_flush(self):
+        """Пометка о несохраненных изменениях; вызывается под блокировкой"""
+        self.dirty = True
+        if self.flusher is None:
+            self.flusher = threading.Thread(target=self.run_flusher, name='store-flush', daemon=True)
+            self.flusher.start()
+        self.flush_needed.set()
+
+    def run_flusher(self):
+        while True:
+            self.flush_needed.wait()
+            # Частые изменения за время задержки попадают в одну запись
+            time.sleep(self.flush_delay)
+            self.flush_needed.clear()
+            self.flush()
+
+    def flush(self):
+        """Немедленная запись на диск, если есть изменения"""
+        with self.write_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                data = pickle.dumps(self.data, protocol=pickle.HIGHEST_PROTOCOL)
+                self.dirty = False
+
+            tmp_path = self.path + '.tmp'
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(f"Error saving {self.path}: {e}")
 
 
 class UserManager:
@@ -20,106 +254,1134 @@ class UserManager:
     
     def __init__(self):
         self.users_file = 'remembered_users.pkl'
-        self.remembered_users = self.load_remembered_users()
-    
-    def load_remembered_users(self):
-        """Загрузка запомненных пользователей"""
-        try:
-            if os.path.exists(self.users_file):
-                with open(self.users_file, 'rb') as f:
-                    return pickle.load(f)
-        except Exception as e:
-            print(f"Error loading remembered users: {e}")
-        return {}
+        self.store = PersistentStore.open(self.users_file)
     
-    def save_remembered_users(self):
-        """Сохранение запомненных пользователей"""
-        try:
-            with open(self.users_file, 'wb') as f:
-                pickle.dump(self.remembered_users, f)
-        except Exception as e:
-            print(f"Error saving remembered users: {e}")
+    @property
+    def remembered_users(self):
+        """Копия всех запомненных пользователей"""
+        return self.store.snapshot()
     
     def remember_user(self, ip, username, password_hash=None):
         """Запомнить пользователя по IP"""
-        self.remembered_users[ip] = {
+        self.store.set(ip, {
             'username': username,
             'password_hash': password_hash,  # Сохраняем хеш пароля для автоматического входа
             'timestamp': datetime.now().isoformat(),
             'auto_login': True if password_hash else False
-        }
-        self.save_remembered_users()
+        })
     
     def get_remembered_user(self, ip):
         """Получить запомненного пользователя по IP"""
-        return self.remembered_users.get(ip)
+        return self.store.get(ip)
     
     def forget_user(self, ip):
         """Забыть пользователя по IP"""
-        if ip in self.remembered_users:
-            del self.remembered_users[ip]
-            self.save_remembered_users()
+        self.store.delete(ip)
     
     def update_auto_login(self, ip, enable=True):
         """Обновить настройку автоматического входа"""
-        if ip in self.remembered_users:
-            self.remembered_users[ip]['auto_login'] = enable
-            self.save_remembered_users()
+        with self.store.transaction():
+            user = self.store.get(ip)
+            if user:
+                self.store.set(ip, dict(user, auto_login=enable))
 
 
 class SettingsManager:
     """Менеджер настроек приложения"""
     
+    DEFAULTS = {
+        'theme': 'dark',
+        'auto_login': True,
+        'notifications': True,
+        'sound_effects': True,
+        'message_history_limit': 1000,
+        'font_size': 11,
+        'start_minimized': False,
+        'show_online_status': True,
+        'network_process': False,
+        'downloads_dir': 'downloads',
+        'metrics_port': 0,
+        'tracing': False,
+        # Доля полосы сегмента под маяки присутствия всех узлов, байт/с
+        'presence_bandwidth': 2000,
+        # Отдельный multicast адрес для каждой реплицируемой группы.
+        # Ретранслятор переносит только основной адрес, поэтому по умолчанию выключено
+        'group_multicast': False,
+        # Хранилище сообщений: 'sqlite' (общая таблица), 'sharded' (файл на беседу)
+        # или 'log' (журнал только на дописывание для архивных узлов)
+        'message_storage': 'sqlite',
+        # Ограничения входящего трафика, сообщений в секунду:
+        # с одного IP (ретранслятор несет весь соседний сегмент) и от одного
+        # имени с одного IP
+        'ingest_ip_rate': 500,
+        'ingest_sender_rate': 50,
+        # Больше этого размера входящие файлы не принимаются, байт
+        'max_file_size': 4 * 1024 ** 3,
+        # IP адреса ретрансляторов своего сегмента. Только от них по TCP
+        # принимается присутствие из других сегментов с чужим адресом
+        'trusted_relays': []
+    }
+    
     def __init__(self):
         self.settings_file = 'app_settings.pkl'
-        self.settings = self.load_settings()
+        # Все экземпляры в процессе работают с одним хранилищем
+        self.store = PersistentStore.open(self.settings_file, self.DEFAULTS)
     
-    def load_settings(self):
-        """Загрузка настроек"""
-        default_settings = {
-            'theme': 'dark',
-            'auto_login': True,
-            'notifications': True,
-            'sound_effects': True,
-            'message_history_limit': 1000,
-            'font_size': 11,
-            'start_minimized': False,
-            'show_online_status': True
-        }
-        
-        try:
-            if os.path.exists(self.settings_file):
-                with open(self.settings_file, 'rb') as f:
-                    loaded_settings = pickle.load(f)
-                    # Объединяем с настройками по умолчанию
-                    default_settings.update(loaded_settings)
-        except Exception as e:
-            print(f"Error loading settings: {e}")
-        
-        return default_settings
+    @property
+    def settings(self):
+        """Копия всех настроек"""
+        return self.store.snapshot()
     
     def save_settings(self):
-        """Сохранение настроек"""
-        try:
-            with open(self.settings_file, 'wb') as f:
-                pickle.dump(self.settings, f)
-        except Exception as e:
-            print(f"Error saving settings: {e}")
+        """Немедленное сохранение настроек"""
+        self.store.flush()
     
     def get(self, key, default=None):
         """Получить значение настройки"""
-        return self.settings.get(key, default)
+        return self.store.get(key, default)
     
     def set(self, key, value):
         """Установить значение настройки"""
-        self.settings[key] = value
-        self.save_settings()
+        self.store.set(key, value)
+    
+    def transaction(self):
+        """Несколько изменений с одной записью на диск"""
+        return self.store.transaction()
+    
+    def subscribe(self, callback):
+        """Подписка на изменения настроек: callback(changes)"""
+        self.store.subscribe(callback)
+    
+    def unsubscribe(self, callback):
+        self.store.unsubscribe(callback)
 
 
-class DatabaseManager:
+class HybridClock:
+    """Гибридные логические часы (HLC) для порядка сообщений между узлами.
+
+    Метка - одно целое: миллисекунды физического времени, сдвинутые на
+    COUNTER_BITS, плюс логический счетчик. Метки узла строго возрастают,
+    метка принятого сообщения меньше всех последующих меток получателя, а
+    при синхронных часах метка почти совпадает с реальным временем.
+    Сортировка по (hlc, sender) поэтому одинакова на всех узлах.
+    """
+
+    COUNTER_BITS = 16
+    # Метки из будущего дальше этого не сдвигают наши часы
+    MAX_DRIFT = 60.0
+
     def __init__(self):
-        self.conn = sqlite3.connect('messenger.db', check_same_thread=False)
-        self.init_database()
+        self.last = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_time(cls, seconds):
+        return int(seconds * 1000) << cls.COUNTER_BITS
+
+    def now(self):
+        """Метка для отправки или локального события"""
+        physical = self.from_time(time.time())
+        with self.lock:
+            self.last = max(self.last + 1, physical)
+            return self.last
+
+    def update(self, remote):
+        """Учет метки принятого сообщения"""
+        now = time.time()
+        physical = self.from_time(now)
+        if not isinstance(remote, int) or remote > self.from_time(now + self.MAX_DRIFT):
+            return self.now()
+        with self.lock:
+            self.last = max(self.last + 1, remote + 1, physical)
+            return self.last
+
+
+class SQLiteMessageStore:
+    """Сообщения в общей таблице messages основной базы"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def save(self, sender, receiver, message_type, text, hlc, conversation):
+        self.conn.execute('''
+            INSERT INTO messages (sender, receiver, message_type, message_text, hlc, conversation)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (sender, receiver, message_type, text, hlc, conversation))
+        self.conn.commit()
+
+    def history(self, conversation, limit):
+        """Последние limit сообщений беседы: (sender, message_text, timestamp)"""
+        cursor = self.conn.execute('''
+            SELECT sender, message_text, timestamp
+            FROM messages
+            WHERE conversation = ?
+            ORDER BY hlc DESC, sender DESC
+            LIMIT ?
+        ''', (conversation, limit))
+        return list(reversed(cursor.fetchall()))
+
+    def page(self, conversation, before, limit):
+        """limit сообщений перед (hlc, sender): (hlc, sender, message_text, timestamp)"""
+        where = 'conversation = ?'
+        params = [conversation]
+        if before is not None:
+            where += ' AND (hlc, sender) < (?, ?)'
+            params.extend(before)
+
+        cursor = self.conn.execute(f'''
+            SELECT hlc, sender, message_text, timestamp
+            FROM messages
+            WHERE {where}
+            ORDER BY hlc DESC, sender DESC
+            LIMIT ?
+        ''', params + [limit])
+        return list(reversed(cursor.fetchall()))
+
+    def recent(self, username, groups, limit):
+        """Последние сообщения пользователя и все сообщения групп groups (id групп)"""
+        placeholders = ', '.join('?' * len(groups))
+        cursor = self.conn.execute(f'''
+            SELECT sender, receiver, message_type, message_text, timestamp 
+            FROM messages 
+            WHERE sender = ? OR receiver = ? OR receiver IN ({placeholders})
+            ORDER BY hlc DESC
+            LIMIT ?
+        ''', [username, username, *groups, limit])
+        return list(reversed(cursor.fetchall()))
+
+    def rename_user(self, old_username, new_username):
+        """Смена имени в сообщениях; фиксирует и откатывает вызывающая транзакция"""
+        self.conn.execute(
+            'UPDATE messages SET sender = ? WHERE sender = ?',
+            (new_username, old_username)
+        )
+        self.conn.execute(
+            'UPDATE messages SET receiver = ? WHERE receiver = ?',
+            (new_username, old_username)
+        )
+        self.conn.execute(
+            f'UPDATE messages SET conversation = {DatabaseManager.CONVERSATION_SQL} '
+            "WHERE message_type = 'private' AND (sender = ? OR receiver = ?)",
+            (new_username, new_username)
+        )
+
+    def drop(self, conversation):
+        cursor = self.conn.execute('DELETE FROM messages WHERE conversation = ?', (conversation,))
+        self.conn.commit()
+        return cursor.rowcount > 0
+
+
+class MessageShard:
+    """Файл SQLite с сообщениями одной беседы"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # Читатели не ждут писателя, а запись не ждет fsync на каждый коммит
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sender TEXT NOT NULL,
+                receiver TEXT NOT NULL,
+                message_type TEXT NOT NULL,
+                message_text TEXT NOT NULL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                is_read BOOLEAN DEFAULT FALSE,
+                hlc INTEGER NOT NULL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_hlc ON messages (hlc, sender)')
+        self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+class ShardedMessageStore:
+    """Сообщения, разложенные по файлам SQLite: файл на беседу.
+
+    Каталог catalog.db сопоставляет ключ беседы с файлом и участниками.
+    Запрос к беседе читает только ее небольшой файл, запись в разные беседы
+    идет параллельно под разными блокировками, а удаление беседы сводится
+    к удалению файла. Открытыми держится не больше max_open файлов.
+    """
+
+    MAX_OPEN = 64
+
+    # Одно хранилище на каталог в пределах процесса
+    stores = {}
+    stores_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, directory):
+        directory = os.path.abspath(directory)
+        with cls.stores_lock:
+            store = cls.stores.get(directory)
+            if store is None:
+                store = cls.stores[directory] = cls(directory)
+            return store
+
+    def __init__(self, directory, max_open=MAX_OPEN):
+        self.directory = directory
+        self.max_open = max_open
+        os.makedirs(directory, exist_ok=True)
+
+        catalog_path = os.path.join(directory, 'catalog.db')
+        self.created = not os.path.exists(catalog_path)
+        self.catalog = sqlite3.connect(catalog_path, check_same_thread=False)
+        self.catalog.execute('''
+            CREATE TABLE IF NOT EXISTS conversations (
+                conversation TEXT PRIMARY KEY,
+                file TEXT NOT NULL,
+                message_type TEXT NOT NULL,
+                user1 TEXT,
+                user2 TEXT
+            )
+        ''')
+        self.catalog.commit()
+        self.catalog_lock = threading.Lock()
+        # Каталог невелик и целиком держится в памяти
+        self.routes = {row[0]: row[1:] for row in self.catalog.execute(
+            'SELECT conversation, file, message_type, user1, user2 FROM conversations')}
+
+        self.shards = collections.OrderedDict()
+        self.shards_lock = threading.Lock()
+
+    @staticmethod
+    def participants(sender, receiver, message_type):
+        if message_type == 'group':
+            return message_type, None, receiver
+        return (message_type,) + tuple(sorted((sender, receiver)))
+
+    def route(self, conversation, participants=None):
+        """Файл беседы; с participants неизвестная беседа заводится"""
+        with self.catalog_lock:
+            route = self.routes.get(conversation)
+            if route is None and participants is not None:
+                # Имя файла случайное: после смены имени ключ беседы
+                # может снова понадобиться для новой беседы
+                route = (f"{os.urandom(8).hex()}.db",) + participants
+                self.catalog.execute('INSERT INTO conversations VALUES (?, ?, ?, ?, ?)',
+                                     (conversation,) + route)
+                self.catalog.commit()
+                self.routes[conversation] = route
+            return route
+
+    def shard(self, name):
+        with self.shards_lock:
+            shard = self.shards.get(name)
+            if shard is not None:
+                self.shards.move_to_end(name)
+                return shard
+            shard = self.shards[name] = MessageShard(os.path.join(self.directory, name))
+            evicted = []
+            while len(self.shards) > self.max_open:
+                evicted.append(self.shards.popitem(last=False)[1])
+        for old in evicted:
+            old.close()
+        return shard
+
+    @contextlib.contextmanager
+    def connection(self, conversation, participants=None):
+        """Соединение с файлом беседы под его блокировкой; None, если беседы нет"""
+        while True:
+            route = self.route(conversation, participants)
+            if route is None:
+                yield None
+                return
+            shard = self.shard(route[0])
+            with shard.lock:
+                if shard.conn is not None:
+                    yield shard.conn
+                    return
+            # Файл закрыт вытеснением между выбором и захватом - повторяем
+
+    def save(self, sender, receiver, message_type, text, hlc, conversation):
+        with self.connection(conversation, self.participants(sender, receiver, message_type)) as conn:
+            conn.execute('''
+                INSERT INTO messages (sender, receiver, message_type, message_text, hlc)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (sender, receiver, message_type, text, hlc))
+            conn.commit()
+
+    def import_rows(self, rows):
+        """Перенос сообщений из общей таблицы, по одной транзакции на беседу"""
+        conversations = collections.defaultdict(list)
+        for sender, receiver, message_type, text, timestamp, is_read, hlc, conversation in rows:
+            conversations[conversation].append(
+                (sender, receiver, message_type, text, timestamp, is_read, hlc))
+
+        for conversation, entries in conversations.items():
+            sender, receiver, message_type = entries[0][:3]
+            with self.connection(conversation, self.participants(sender, receiver, message_type)) as conn:
+                conn.executemany('''
+                    INSERT INTO messages
+                        (sender, receiver, message_type, message_text, timestamp, is_read, hlc)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', entries)
+                conn.commit()
+
+    def history(self, conversation, limit):
+        with self.connection(conversation) as conn:
+            if conn is None:
+                return []
+            cursor = conn.execute('''
+                SELECT sender, message_text, timestamp
+                FROM messages
+                ORDER BY hlc DESC, sender DESC
+                LIMIT ?
+            ''', (limit,))
+            return list(reversed(cursor.fetchall()))
+
+    def page(self, conversation, before, limit):
+        where, params = ('WHERE (hlc, sender) < (?, ?)', list(before)) if before is not None else ('', [])
+        with self.connection(conversation) as conn:
+            if conn is None:
+                return []
+            cursor = conn.execute(f'''
+                SELECT hlc, sender, message_text, timestamp
+                FROM messages
+                {where}
+                ORDER BY hlc DESC, sender DESC
+                LIMIT ?
+            ''', params + [limit])
+            return list(reversed(cursor.fetchall()))
+
+    def recent(self, username, groups, limit):
+        """Последние сообщения пользователя и все сообщения групп groups (id групп),
+        как в SQLiteMessageStore.recent"""
+        groups = set(groups)
+        with self.catalog_lock:
+            routes = list(self.routes.items())
+
+        rows = []
+        for conversation, (_, message_type, user1, user2) in routes:
+            # Получатель групповой беседы хранится в user2
+            whole = username in (user1, user2) if message_type != 'group' else user2 in groups
+            with self.connection(conversation) as conn:
+                if conn is None:
+                    continue
+                if whole:
+                    cursor = conn.execute('''
+                        SELECT hlc, sender, receiver, message_type, message_text, timestamp
+                        FROM messages ORDER BY hlc DESC LIMIT ?
+                    ''', (limit,))
+                else:
+                    cursor = conn.execute('''
+                        SELECT hlc, sender, receiver, message_type, message_text, timestamp
+                        FROM messages WHERE sender = ? OR receiver = ? ORDER BY hlc DESC LIMIT ?
+                    ''', (username, username, limit))
+                rows.extend(cursor.fetchall())
+
+        newest = sorted(rows, reverse=True)[:limit]
+        return [row[1:] for row in reversed(newest)]
+
+    def rename_user(self, old_username, new_username):
+        """Смена имени в сообщениях и ключах личных бесед.
+
+        Файлы бесед и каталог не входят в транзакцию основной базы, поэтому
+        смена делается целиком или никак: при ошибке уже сделанные шаги
+        отменяются. Возвращает функцию отмены на случай, если транзакция
+        вызывающего не зафиксируется.
+        """
+        undo = []
+        try:
+            with self.catalog_lock:
+                routes = list(self.routes.items())
+
+            for conversation, route in routes:
+                self.rename_rows(conversation, old_username, new_username, undo)
+
+            for conversation, (name, message_type, user1, user2) in routes:
+                if message_type == 'group' or old_username not in (user1, user2):
+                    continue
+                users = sorted(new_username if user == old_username else user for user in (user1, user2))
+                key = DatabaseManager.conversation_key(users[0], users[1], message_type)
+                self.rekey(conversation, key, users, undo)
+        except Exception:
+            self.revert(undo)
+            raise
+        return lambda: self.revert(undo)
+
+    @staticmethod
+    def revert(undo):
+        """Отмена шагов в обратном порядке"""
+        while undo:
+            undo.pop()()
+
+    def rename_rows(self, conversation, old_username, new_username, undo):
+        """Смена имени в строках беседы; отмена возвращает имя тем же строкам"""
+        with self.connection(conversation) as conn:
+            if conn is None:
+                return
+            changed = {}
+            for column in ('sender', 'receiver'):
+                changed[column] = [row[0] for row in conn.execute(
+                    f'SELECT id FROM messages WHERE {column} = ?', (old_username,))]
+                conn.execute(f'UPDATE messages SET {column} = ? WHERE {column} = ?',
+                             (new_username, old_username))
+            conn.commit()
+
+        def restore():
+            with self.connection(conversation) as conn:
+                if conn is None:
+                    return
+                for column, ids in changed.items():
+                    conn.executemany(f'UPDATE messages SET {column} = ? WHERE id = ?',
+                                     [(old_username, row_id) for row_id in ids])
+                conn.commit()
+        undo.append(restore)
+
+    def rekey(self, conversation, key, users, undo):
+        """Перенос личной беседы под ключ key.
+
+        Если беседа с таким ключом уже есть (новое имя уже переписывалось
+        с собеседником), сообщения переносятся в нее, а старый файл удаляется.
+        """
+        with self.catalog_lock:
+            route = self.routes[conversation]
+            if key not in self.routes:
+                self.set_route(conversation, key, route[:2] + tuple(users))
+
+                def restore_key():
+                    with self.catalog_lock:
+                        self.set_route(key, conversation, route)
+                undo.append(restore_key)
+                return
+
+        with self.connection(conversation) as conn:
+            rows = conn.execute('''
+                SELECT id, sender, receiver, message_type, message_text, timestamp, is_read, hlc
+                FROM messages ORDER BY id
+            ''').fetchall()
+        with self.connection(key) as conn:
+            added = []
+            for row in rows:
+                cursor = conn.execute('''
+                    INSERT INTO messages
+                        (sender, receiver, message_type, message_text, timestamp, is_read, hlc)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', row[1:])
+                added.append((cursor.lastrowid,))
+            conn.commit()
+
+        def restore():
+            with self.connection(key) as conn:
+                conn.executemany('DELETE FROM messages WHERE id = ?', added)
+                conn.commit()
+            # Строки возвращаются с прежними id: по ним отменяется смена имени
+            with self.connection(conversation, route[1:]) as conn:
+                conn.executemany('''
+                    INSERT INTO messages
+                        (id, sender, receiver, message_type, message_text, timestamp, is_read, hlc)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+                conn.commit()
+        undo.append(restore)
+        self.drop(conversation)
+
+    def set_route(self, conversation, key, route):
+        """Смена ключа беседы в каталоге; вызывается под catalog_lock"""
+        self.routes[key] = route
+        del self.routes[conversation]
+        self.catalog.execute(
+            'UPDATE conversations SET conversation = ?, user1 = ?, user2 = ? WHERE conversation = ?',
+            (key, route[2], route[3], conversation))
+        self.catalog.commit()
+
+    def drop(self, conversation):
+        """Удаление беседы вместе с ее файлом"""
+        with self.catalog_lock:
+            route = self.routes.pop(conversation, None)
+            if route is None:
+                return False
+            self.catalog.execute('DELETE FROM conversations WHERE conversation = ?', (conversation,))
+            self.catalog.commit()
+
+        with self.shards_lock:
+            shard = self.shards.pop(route[0], None)
+        if shard is not None:
+            shard.close()
+        path = os.path.join(self.directory, route[0])
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+        return True
+
+
+class LogSegment:
+    """Файл сегмента журнала, отображенный в память"""
+
+    def __init__(self, path, number, size=None):
+        self.path = path
+        self.number = number
+        self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        if size is not None and os.path.getsize(path) < size:
+            # Место под активный сегмент выделяется сразу (файл разреженный)
+            self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        self.view = memoryview(self.mm)
+
+    def __len__(self):
+        return len(self.mm)
+
+    def seal(self, used):
+        """Закрытие сегмента для записи: хвост отрезается"""
+        self.close()
+        with open(self.path, 'r+b') as f:
+            f.truncate(used)
+        self.file = open(self.path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if used else b''
+        self.view = memoryview(self.mm)
+
+    def flush(self):
+        if isinstance(self.mm, mmap.mmap) and not self.mm.closed:
+            self.mm.flush()
+
+    def close(self):
+        self.view.release()
+        if isinstance(self.mm, mmap.mmap) and not self.mm.closed:
+            self.mm.close()
+        self.file.close()
+
+
+class LogConversation:
+    """Разреженный индекс одной беседы в журнале.
+
+    Записи беседы связаны обратными ссылками prev. Индекс хранит по блоку
+    на каждые STRIDE записей: место последней записи блока, их число и
+    диапазон меток hlc. По диапазонам страница истории пропускает блоки,
+    не читая их записей.
+    """
+
+    __slots__ = ('message_type', 'user1', 'user2', 'last', 'blocks', 'size')
+
+    STRIDE = 64
+
+    def __init__(self, message_type, user1, user2):
+        self.message_type = message_type
+        self.user1 = user1
+        self.user2 = user2
+        self.last = None
+        self.blocks = []
+        self.size = 0
+
+    def add(self, location, hlc, size):
+        self.last = location
+        self.size += size
+        if self.blocks and self.blocks[-1][1] < self.STRIDE:
+            block = self.blocks[-1]
+            block[0] = location
+            block[1] += 1
+            block[2] = min(block[2], hlc)
+            block[3] = max(block[3], hlc)
+        else:
+            self.blocks.append([location, 1, hlc, hlc])
+
+    def merge(self, other):
+        """Присоединение записей другой беседы; новые записи продолжают эту"""
+        self.blocks = other.blocks + self.blocks
+        self.size += other.size
+
+
+class LogMessageStore:
+    """Журнал сообщений только на дописывание, для архивных узлов и ретрансляторов.
+
+    Сообщения пишутся подряд в сегменты фиксированного размера записями
+    с префиксом длины и читаются через mmap срезами memoryview без
+    копирования. Заполненный сегмент закрывается и начинается следующий.
+    Удаление беседы и смена имени - тоже записи журнала; место удаленных
+    бесед возвращает компакция, переписывающая живые записи в новые
+    сегменты. Индекс бесед строится при открытии одним проходом.
+
+    Каталог журнала открывает только один процесс: у каждого было бы свое
+    место записи, и их записи затирали бы друг друга.
+    """
+
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    # Доля мертвых записей, при которой компакция запускается сама
+    COMPACT_RATIO = 0.5
+    # Записей, копируемых компакцией за один захват блокировки
+    COMPACT_BATCH = 1024
+
+    LENGTH = struct.Struct('<I')
+    # kind, hlc, prev (номер сегмента, смещение), длины sender, receiver, timestamp
+    HEADER = struct.Struct('<BqIIHHH')
+
+    KIND_PRIVATE = 1
+    KIND_GROUP = 2
+    KIND_DROP = 3
+    KIND_RENAME = 4
+
+    stores = {}
+    stores_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, directory):
+        directory = os.path.abspath(directory)
+        with cls.stores_lock:
+            store = cls.stores.get(directory)
+            if store is None:
+                lock_file = cls.lock_directory(directory)
+                try:
+                    store = cls(directory)
+                except BaseException:
+                    lock_file.close()
+                    raise
+                store.lock_file = lock_file
+                cls.stores[directory] = store
+            return store
+
+    @staticmethod
+    def lock_directory(directory):
+        """Исключительная блокировка журнала между процессами.
+
+        Блокируется файл рядом с каталогом: компакция подменяет сам каталог.
+        Блокировку снимает система при завершении процесса.
+        """
+        lock_file = open(directory + '.lock', 'a+b')
+        try:
+            if os.name == 'nt':
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise RuntimeError(f"Журнал сообщений {directory} уже открыт другим процессом")
+        return lock_file
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = threading.RLock()
+        self.lock_file = None
+        self.compacting = False
+        self.recover()
+        self.created = not os.path.isdir(directory)
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def recover(self):
+        """Завершение прерванной компакции"""
+        compacted, old = self.directory + '.compact', self.directory + '.old'
+        if os.path.isdir(compacted) and not os.path.isdir(self.directory):
+            os.replace(compacted, self.directory)
+        for leftover in (compacted, old):
+            if os.path.isdir(leftover):
+                for name in os.listdir(leftover):
+                    os.remove(os.path.join(leftover, name))
+                os.rmdir(leftover)
+
+    def load(self):
+        """Открытие сегментов и восстановление индекса"""
+        self.segments = {}
+        self.conversations = {}
+        self.renames = []
+        self.total_bytes = 0
+        self.live_bytes = 0
+
+        numbers = sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                         if name.endswith('.log') and name[:-4].isdigit())
+        for number in numbers[:-1]:
+            self.segments[number] = LogSegment(self.segment_path(number), number)
+        self.active = number = numbers[-1] if numbers else 1
+        self.segments[number] = LogSegment(self.segment_path(number), number, self.segment_size)
+
+        for number in sorted(self.segments):
+            for offset, record in self.scan(number):
+                self.index_record((number, offset), record)
+        self.write_offset = self.end_of(self.active)
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, f"{number:08d}.log")
+
+    def scan(self, number):
+        """Записи сегмента по порядку: (смещение, запись)"""
+        offset = 0
+        view = self.segments[number].view
+        while offset + self.LENGTH.size <= len(view):
+            length, = self.LENGTH.unpack_from(view, offset)
+            # Нулевая длина - конец записанного; длина пишется последней
+            if length == 0 or offset + self.LENGTH.size + length > len(view):
+                return
+            yield offset, self.decode(view, offset, length)
+            offset += self.LENGTH.size + length
+
+    def end_of(self, number):
+        end = 0
+        for offset, record in self.scan(number):
+            end = offset + self.LENGTH.size + record[-1]
+        return end
+
+    def decode(self, view, offset, length):
+        """Разбор записи: строки декодируются прямо из среза mmap"""
+        kind, hlc, prev_segment, prev_offset, sender_len, receiver_len, timestamp_len = \
+            self.HEADER.unpack_from(view, offset + self.LENGTH.size)
+        start = offset + self.LENGTH.size + self.HEADER.size
+        end = offset + self.LENGTH.size + length
+        fields = []
+        for size in (sender_len, receiver_len, timestamp_len):
+            fields.append(str(view[start:start + size], 'utf-8'))
+            start += size
+        text = str(view[start:end], 'utf-8')
+        prev = (prev_segment, prev_offset) if prev_segment else None
+        return kind, hlc, prev, fields[0], fields[1], fields[2], text, length
+
+    def read(self, location):
+        number, offset = location
+        view = self.segments[number].view
+        length, = self.LENGTH.unpack_from(view, offset)
+        return self.decode(view, offset, length)
+
+    def read_key(self, location):
+        """Только метка, отправитель и ссылка назад - для обхода беседы"""
+        number, offset = location
+        view = self.segments[number].view
+        _, hlc, prev_segment, prev_offset, sender_len, _, _ = \
+            self.HEADER.unpack_from(view, offset + self.LENGTH.size)
+        start = offset + self.LENGTH.size + self.HEADER.size
+        return hlc, str(view[start:start + sender_len], 'utf-8'), \
+            (prev_segment, prev_offset) if prev_segment else None
+
+    def append(self, kind, hlc, prev, sender, receiver, timestamp, text):
+        """Запись в конец активного сегмента; возвращает ее место"""
+        fields = [value.encode('utf-8') for value in (sender, receiver, timestamp, text)]
+        length = self.HEADER.size + sum(len(field) for field in fields)
+        size = self.LENGTH.size + length
+        if size > self.segment_size:
+            raise ValueError("Запись больше сегмента журнала")
+        if self.write_offset + size > self.segment_size:
+            self.roll()
+
+        segment, offset = self.segments[self.active], self.write_offset
+        prev_segment, prev_offset = prev or (0, 0)
+        self.HEADER.pack_into(segment.mm, offset + self.LENGTH.size, kind, hlc,
+                              prev_segment, prev_offset, len(fields[0]), len(fields[1]), len(fields[2]))
+        position = offset + self.LENGTH.size + self.HEADER.size
+        for field in fields:
+            segment.mm[position:position + len(field)] = field
+            position += len(field)
+        # Длина последней: после сбоя запись видна целиком или не видна вовсе
+        self.LENGTH.pack_into(segment.mm, offset, length)
+        self.write_offset = offset + size
+        return (self.active, offset), length
+
+    def roll(self):
+        """Переход к новому сегменту"""
+        self.segments[self.active].seal(self.write_offset)
+        self.active += 1
+        self.segments[self.active] = LogSegment(self.segment_path(self.active), self.active,
+                                                self.segment_size)
+        self.write_offset = 0
+
+    def index_record(self, location, record):
+        kind, hlc, _, sender, receiver, _, text, length = record
+        size = self.LENGTH.size + length
+        self.total_bytes += size
+        if kind == self.KIND_DROP:
+            conversation = self.conversations.pop(text, None)
+            if conversation:
+                self.live_bytes -= conversation.size
+        elif kind == self.KIND_RENAME:
+            self.index_rename(location, sender, receiver)
+        else:
+            key, message_type = self.conversation_of(kind, sender, receiver)
+            conversation = self.conversations.get(key)
+            if conversation is None:
+                conversation = self.conversations[key] = LogConversation(
+                    *ShardedMessageStore.participants(sender, receiver, message_type))
+            conversation.add(location, hlc, size)
+            self.live_bytes += size
+
+    def conversation_of(self, kind, sender, receiver):
+        """Ключ беседы записи: в журнале он не хранится, а выводится из участников"""
+        message_type = 'group' if kind == self.KIND_GROUP else 'private'
+        return DatabaseManager.conversation_key(sender, receiver, message_type), message_type
+
+    def index_rename(self, location, old_username, new_username):
+        """Смена имени: записи до location читаются с новым именем"""
+        self.renames.append((location, old_username, new_username))
+        for key, conversation in list(self.conversations.items()):
+            if conversation.message_type == 'group' or old_username not in (conversation.user1, conversation.user2):
+                continue
+            users = sorted(new_username if user == old_username else user
+                           for user in (conversation.user1, conversation.user2))
+            new_key = DatabaseManager.conversation_key(users[0], users[1], 'private')
+            target = self.conversations.get(new_key)
+            if target is not None:
+                # Беседа под новым именем уже есть: записи объединяются
+                target.merge(self.conversations.pop(key))
+                continue
+            conversation.user1, conversation.user2 = users
+            self.conversations[new_key] = self.conversations.pop(key)
+
+    def resolve(self, name, location, renames=None):
+        for renamed_at, old_username, new_username in self.renames if renames is None else renames:
+            if location < renamed_at and name == old_username:
+                name = new_username
+        return name
+
+    def walk(self, conversation, before=None, limit=None, sender=None):
+        """Записи беседы с позицией меньше before, не больше limit новейших.
+
+        Возвращает (позиция, место, запись) по возрастанию позиции.
+        """
+        best = []
+        for last, count, min_hlc, max_hlc in reversed(conversation.blocks):
+            if before is not None and min_hlc > before[0]:
+                continue
+            if limit is not None and len(best) >= limit and max_hlc < best[0][0][0]:
+                continue
+            location = last
+            for _ in range(count):
+                hlc, author, prev = self.read_key(location)
+                if self.renames:
+                    author = self.resolve(author, location)
+                position = (hlc, author)
+                if (before is None or position < before) and (sender is None or author == sender):
+                    # Места различны, поэтому до сравнения записей дело не доходит
+                    entry = (position, location)
+                    if limit is None or len(best) < limit:
+                        heapq.heappush(best, entry)
+                    elif entry > best[0]:
+                        heapq.heapreplace(best, entry)
+                location = prev
+        # Записи целиком декодируются только для результата
+        return [(position, location, self.read(location)) for position, location in sorted(best)]
+
+    def save(self, sender, receiver, message_type, text, hlc, conversation,
+             timestamp=None):
+        timestamp = timestamp or time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        kind = self.KIND_GROUP if message_type == 'group' else self.KIND_PRIVATE
+        with self.lock:
+            current = self.conversations.get(self.conversation_of(kind, sender, receiver)[0])
+            prev = current.last if current else None
+            location, length = self.append(kind, hlc, prev, sender, receiver, timestamp, text)
+            self.index_record(location, (kind, hlc, prev, sender, receiver, timestamp, text, length))
+
+    def import_rows(self, rows):
+        for sender, receiver, message_type, text, timestamp, is_read, hlc, conversation in rows:
+            self.save(sender, receiver, message_type, text, hlc, conversation, timestamp)
+
+    def history(self, conversation, limit):
+        return [(sender, text, timestamp) for _, sender, text, timestamp in self.page(conversation, None, limit)]
+
+    def page(self, conversation, before, limit):
+        with self.lock:
+            current = self.conversations.get(conversation)
+            if current is None:
+                return []
+            return [(position[0], position[1], record[6], record[5])
+                    for position, _, record in self.walk(current, tuple(before) if before else None, limit)]
+
+    def recent(self, username, groups, limit):
+        """Последние сообщения пользователя и все сообщения групп groups (id групп),
+        как в SQLiteMessageStore.recent"""
+        groups = set(groups)
+        with self.lock:
+            rows = []
+            for current in self.conversations.values():
+                if current.message_type == 'group':
+                    whole = current.user2 in groups or current.user2 == username
+                elif username in (current.user1, current.user2):
+                    whole = True
+                else:
+                    continue
+                for position, location, record in self.walk(current, None, limit,
+                                                            None if whole else username):
+                    rows.append((position, self.resolve(record[4], location), current.message_type,
+                                 record[6], record[5]))
+        newest = sorted(rows)[-limit:]
+        return [(position[1],) + tuple(row) for position, *row in newest]
+
+    def rename_user(self, old_username, new_username):
+        """Смена имени одной записью журнала; возвращает функцию отмены"""
+        self.write_control(self.KIND_RENAME, old_username, new_username)
+        return lambda: self.rename_user(new_username, old_username)
+
+    def write_control(self, kind, sender='', receiver='', text=''):
+        """Запись удаления беседы или смены имени"""
+        with self.lock:
+            record = (kind, 0, None, sender, receiver, '', text)
+            location, length = self.append(*record)
+            self.index_record(location, record + (length,))
+
+    def replay(self, record):
+        """Повтор записи другого журнала с новыми ссылками назад"""
+        kind, hlc, _, sender, receiver, timestamp, text, _ = record
+        if kind in (self.KIND_DROP, self.KIND_RENAME):
+            self.write_control(kind, sender, receiver, text)
+        else:
+            conversation, message_type = self.conversation_of(kind, sender, receiver)
+            self.save(sender, receiver, message_type, text, hlc, conversation, timestamp)
+
+    def drop(self, conversation):
+        with self.lock:
+            if conversation not in self.conversations:
+                return False
+            self.write_control(self.KIND_DROP, text=conversation)
+            if self.total_bytes - self.live_bytes > self.COMPACT_RATIO * self.total_bytes \
+                    and not self.compacting:
+                # Компакция читает весь журнал - удаляющий ее не ждет
+                self.compacting = True
+                threading.Thread(target=self.compact_in_background, name='log-compact',
+                                 daemon=True).start()
+            return True
+
+    def compact_in_background(self):
+        try:
+            self.compact()
+        except Exception as e:
+            print(f"Log compaction error: {e}")
+        finally:
+            self.compacting = False
+
+    def compact(self):
+        """Перезапись живых записей в новые сегменты.
+
+        Новый журнал собирается рядом и подменяет каталог целиком; прерванная
+        компакция завершается или откатывается при следующем открытии.
+        Живые записи копируются пачками с отдельным захватом блокировки на
+        пачку, поэтому запись и чтение идут и во время компакции. Записи,
+        добавленные за это время, повторяются под блокировкой в конце.
+        """
+        with self.lock:
+            live = []
+            for current in self.conversations.values():
+                live.extend(location for _, location, _ in self.walk(current))
+            live.sort()
+            # Имена до mark разрешаются по сменам имени до mark, остальные
+            # смены повторяются вместе с хвостом
+            renames = list(self.renames)
+            mark = (self.active, self.write_offset)
+
+        compacted = LogMessageStore(self.directory + '.compact', self.segment_size)
+        try:
+            for start in range(0, len(live), self.COMPACT_BATCH):
+                with self.lock:
+                    for location in live[start:start + self.COMPACT_BATCH]:
+                        kind, hlc, _, sender, receiver, timestamp, text, _ = self.read(location)
+                        sender = self.resolve(sender, location, renames)
+                        receiver = self.resolve(receiver, location, renames)
+                        conversation, message_type = self.conversation_of(kind, sender, receiver)
+                        compacted.save(sender, receiver, message_type, text, hlc, conversation, timestamp)
+        except BaseException:
+            compacted.close()
+            self.recover()
+            raise
+
+        with self.lock:
+            try:
+                for number in range(mark[0], self.active + 1):
+                    for offset, record in self.scan(number):
+                        if (number, offset) >= mark:
+                            compacted.replay(record)
+            finally:
+                compacted.close()
+            self.close()
+
+            try:
+                os.replace(self.directory, self.directory + '.old')
+                try:
+                    os.replace(self.directory + '.compact', self.directory)
+                except OSError:
+                    # Прежний журнал возвращается на место
+                    os.replace(self.directory + '.old', self.directory)
+                    raise
+            finally:
+                # И при неудачной подмене журнал снова открыт: прежний или новый
+                try:
+                    self.recover()
+                finally:
+                    self.load()
+
+    def sync(self):
+        with self.lock:
+            for segment in self.segments.values():
+                segment.flush()
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            for segment in self.segments.values():
+                segment.close()
+            self.segments = {}
+
+
+class DatabaseManager:
+    # Файлы, схема которых уже проверена в этом процессе
+    initialized_paths = set()
+    initialized_lock = threading.Lock()
+    # Метки для сообщений, сохраняемых без метки отправителя
+    clock = HybridClock()
+    # Хранилища сообщений помимо общей таблицы: класс и суффикс каталога
+    STORAGE_ENGINES = {
+        'sharded': (ShardedMessageStore, '.shards'),
+        'log': (LogMessageStore, '.log')
+    }
+
+    # Ключ беседы: группа или упорядоченная пара собеседников.
+    # Пересчитывается в SQL при миграции и смене имени.
+    CONVERSATION_SQL = ("CASE WHEN message_type = 'group' THEN 'group:' || receiver "
+                        "ELSE 'private:' || min(sender, receiver) || char(10) || max(sender, receiver) END")
+
+    def __init__(self, db_path='messenger.db', storage=None):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        if db_path == ':memory:':
+            self.init_database()
+        else:
+            with self.initialized_lock:
+                path = os.path.abspath(db_path)
+                if path not in self.initialized_paths:
+                    self.init_database()
+                    self.initialized_paths.add(path)
+
+        self.db_path = db_path
+        self.storage = storage
+        self.message_store = None
+        self.message_store_lock = threading.Lock()
+
+    @property
+    def messages(self):
+        """Хранилище сообщений, открываемое при первом обращении.
+
+        Окну входа оно не нужно, а журнал сообщений держит открытым только
+        один процесс - тот, где работает мессенджер.
+        """
+        with self.message_store_lock:
+            if self.message_store is None:
+                self.message_store = self.open_message_store(self.db_path, self.storage)
+            return self.message_store
+
+    def open_message_store(self, db_path, storage=None):
+        """Хранилище сообщений: storage или выбранное в настройках"""
+        if storage is None:
+            storage = 'sqlite' if db_path == ':memory:' else SettingsManager().get('message_storage', 'sqlite')
+
+        if storage in self.STORAGE_ENGINES:
+            engine, suffix = self.STORAGE_ENGINES[storage]
+            store = engine.open(db_path + suffix)
+            if store.created:
+                # Первый запуск с этим хранилищем: переносим накопленную историю
+                store.created = False
+                store.import_rows(self.conn.execute('''
+                    SELECT sender, receiver, message_type, message_text, timestamp, is_read,
+                           hlc, conversation
+                    FROM messages
+                    ORDER BY id
+                '''))
+            return store
+        if storage != 'sqlite':
+            print(f"Unknown message storage '{storage}', using sqlite")
+        return SQLiteMessageStore(self.conn)
 
     def init_database(self):
         """Инициализация базы данных"""
@@ -162,7 +1424,9 @@ class DatabaseManager:
                     message_type TEXT NOT NULL,
                     message_text TEXT NOT NULL,
                     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_read BOOLEAN DEFAULT FALSE
+                    is_read BOOLEAN DEFAULT FALSE,
+                    hlc INTEGER,
+                    conversation TEXT
                 )
             ''',
             'group_chats': '''
@@ -182,14 +1446,58 @@ class DatabaseManager:
                     FOREIGN KEY (group_id) REFERENCES group_chats (id),
                     UNIQUE(group_id, username)
                 )
+            ''',
+            'group_ops': '''
+                CREATE TABLE IF NOT EXISTS group_ops (
+                    group_id TEXT NOT NULL,
+                    author TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    hlc INTEGER NOT NULL,
+                    op TEXT NOT NULL,
+                    member TEXT,
+                    name TEXT,
+                    deps TEXT NOT NULL,
+                    PRIMARY KEY (group_id, author, seq)
+                )
             '''
         }
 
         for table_name, table_sql in tables.items():
             cursor.execute(table_sql)
 
+        # Базы прежних версий: метки выводятся из времени записи,
+        # младшие биты id сохраняют локальный порядок внутри миллисекунды
+        columns = {row[1] for row in cursor.execute('PRAGMA table_info(messages)')}
+        if 'hlc' not in columns:
+            cursor.execute('ALTER TABLE messages ADD COLUMN hlc INTEGER')
+            cursor.execute('ALTER TABLE messages ADD COLUMN conversation TEXT')
+            cursor.execute(f'''
+                UPDATE messages SET
+                    hlc = (CAST(strftime('%s', timestamp) AS INTEGER) * 1000 << {HybridClock.COUNTER_BITS})
+                          + (id & {(1 << HybridClock.COUNTER_BITS) - 1}),
+                    conversation = {self.CONVERSATION_SQL}
+            ''')
+
+        # Беседа читается по индексу уже в нужном порядке, без сортировки
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_messages_conversation_hlc
+            ON messages (conversation, hlc, sender)
+        ''')
+
         self.conn.commit()
 
+    @staticmethod
+    def conversation_key(user1, user2, message_type):
+        """Ключ беседы, совпадающий с CONVERSATION_SQL"""
+        if message_type == 'group':
+            return f'group:{user2}'
+        return 'private:' + '\n'.join(sorted((user1, user2)))
+
+    @staticmethod
+    def position(hlc, sender):
+        """Место сообщения в беседе; None, если метка неизвестна"""
+        return None if hlc is None else (hlc, sender)
+
     def register_user(self, username, password):
         """Регистрация нового пользователя"""
         password_hash = hashlib.sha256(password.encode()).hexdigest()
@@ -266,6 +1574,7 @@ class DatabaseManager:
 
     def change_username(self, old_username, new_username):
         """Изменение имени пользователя"""
+        undo = None
         try:
             # Обновляем имя пользователя во всех связанных таблицах
             self.conn.execute('BEGIN TRANSACTION')
@@ -282,16 +1591,6 @@ class DatabaseManager:
                 (new_username, old_username)
             )
             
-            # Обновляем в таблице messages
-            self.conn.execute(
-                'UPDATE messages SET sender = ? WHERE sender = ?',
-                (new_username, old_username)
-            )
-            self.conn.execute(
-                'UPDATE messages SET receiver = ? WHERE receiver = ?',
-                (new_username, old_username)
-            )
-            
             # Обновляем в таблице contacts
             self.conn.execute(
                 'UPDATE contacts SET contact_username = ? WHERE contact_username = ?',
@@ -309,22 +1608,36 @@ class DatabaseManager:
                 'UPDATE group_members SET username = ? WHERE username = ?',
                 (new_username, old_username)
             )
-            
+
+            # Хранилище сообщений последним: файлы бесед не откатываются
+            # вместе с транзакцией, их отменяет возвращенная функция
+            undo = self.messages.rename_user(old_username, new_username)
+
             self.conn.commit()
             return True
         except sqlite3.IntegrityError:
-            self.conn.rollback()
+            self.rollback_rename(undo)
             return False
         except Exception as e:
-            self.conn.rollback()
+            self.rollback_rename(undo)
             print(f"Error changing username: {e}")
             return False
 
-    def add_contact(self, username, contact_username):
-        """Добавление контакта"""
+    def rollback_rename(self, undo):
+        """Откат смены имени в базе и в хранилище сообщений"""
+        self.conn.rollback()
+        if undo is not None:
+            undo()
+
+    def add_contact(self, username, contact_username, known=False):
+        """Добавление контакта.
+
+        known - пользователь замечен в сети и может не иметь учетной
+        записи в этой базе.
+        """
         # Проверяем существование пользователя
         cursor = self.conn.execute('SELECT id FROM users WHERE username = ?', (contact_username,))
-        if not cursor.fetchone():
+        if not known and not cursor.fetchone():
             return False
 
         try:
@@ -381,6 +1694,27 @@ class DatabaseManager:
 
         return [{'id': row[0], 'name': row[1], 'creator': row[2]} for row in cursor.fetchall()]
 
+    def save_group_ops(self, entries):
+        """Сохранение операций журнала состава групп"""
+        self.conn.executemany('''
+            INSERT OR IGNORE INTO group_ops (group_id, author, seq, hlc, op, member, name, deps)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(entry['group'], entry['author'], entry['seq'], entry['hlc'], entry['op'],
+               entry['member'], entry['name'], json.dumps(entry['deps']))
+              for entry in entries])
+        self.conn.commit()
+
+    def get_group_ops(self):
+        """Все операции журнала в причинном порядке"""
+        cursor = self.conn.execute('''
+            SELECT group_id, author, seq, hlc, op, member, name, deps
+            FROM group_ops
+            ORDER BY hlc, author, seq
+        ''')
+        return [{'group': row[0], 'author': row[1], 'seq': row[2], 'hlc': row[3], 'op': row[4],
+                 'member': row[5], 'name': row[6], 'deps': json.loads(row[7])}
+                for row in cursor.fetchall()]
+
     def get_contacts(self, username):
         """Получение списка контактов"""
         cursor = self.conn.execute('''
@@ -391,52 +1725,39 @@ class DatabaseManager:
 
         return [row[0] for row in cursor.fetchall()]
 
-    def save_message(self, sender, receiver, message_type, message_text):
-        """Сохранение сообщения в базу данных"""
-        self.conn.execute('''
-            INSERT INTO messages (sender, receiver, message_type, message_text)
-            VALUES (?, ?, ?, ?)
-        ''', (sender, receiver, message_type, message_text))
-        self.conn.commit()
+    def save_message(self, sender, receiver, message_type, message_text, hlc=None):
+        """Сохранение сообщения в базу данных.
+
+        hlc - метка, назначенная отправителем; без нее берется метка
+        локальных часов процесса.
+        """
+        if hlc is None:
+            hlc = self.clock.now()
+        self.messages.save(sender, receiver, message_type, message_text, hlc,
+                           self.conversation_key(sender, receiver, message_type))
 
     def get_message_history(self, user1, user2, message_type='private', limit=1000):
         """Получение истории сообщений"""
-        if message_type == 'group':
-            cursor = self.conn.execute('''
-                SELECT sender, message_text, timestamp 
-                FROM messages 
-                WHERE receiver = ? AND message_type = ?
-                ORDER BY timestamp DESC
-                LIMIT ?
-            ''', (user2, message_type, limit))
-        else:
-            cursor = self.conn.execute('''
-                SELECT sender, message_text, timestamp 
-                FROM messages 
-                WHERE ((sender = ? AND receiver = ?) OR (sender = ? AND receiver = ?))
-                AND message_type = ?
-                ORDER BY timestamp DESC
-                LIMIT ?
-            ''', (user1, user2, user2, user1, message_type, limit))
+        return self.messages.history(self.conversation_key(user1, user2, message_type), limit)
 
-        messages = cursor.fetchall()
-        return list(reversed(messages))
+    def get_message_page(self, user1, user2, message_type='private', before=None, limit=100):
+        """Страница истории: limit сообщений перед позицией before.
 
-    def get_all_messages(self, username, limit=500):
-        """Получение всех сообщений пользователя"""
-        cursor = self.conn.execute('''
-            SELECT sender, receiver, message_type, message_text, timestamp 
-            FROM messages 
-            WHERE sender = ? OR receiver = ? OR receiver IN (
-                SELECT name FROM group_chats WHERE id IN (
-                    SELECT group_id FROM group_members WHERE username = ?
-                )
-            )
-            ORDER BY timestamp DESC
-            LIMIT ?
-        ''', (username, username, username, limit))
+        Возвращает строки (position, sender, message_text, timestamp) в
+        порядке беседы, где position = (hlc, sender); без before - последнюю
+        страницу. Порядок задает индекс, поэтому он одинаков на всех узлах.
+        """
+        rows = self.messages.page(self.conversation_key(user1, user2, message_type), before, limit)
+        return [(self.position(hlc, sender), sender, text, timestamp)
+                for hlc, sender, text, timestamp in rows]
 
-        return list(reversed(cursor.fetchall()))
+    def get_all_messages(self, username, groups, limit=500):
+        """Сообщения пользователя и все сообщения групп groups (id групп)"""
+        return self.messages.recent(username, groups, limit)
+
+    def drop_conversation(self, user1, user2, message_type='private'):
+        """Удаление всей беседы"""
+        return self.messages.drop(self.conversation_key(user1, user2, message_type))
 
     def __del__(self):
         """Закрытие соединения с БД при уничтожении объекта"""
@@ -444,365 +1765,4026 @@ class DatabaseManager:
             self.conn.close()
 
 
-class MulticastMessenger:
-    def __init__(self, username, multicast_group='224.1.1.1', port=5007):
-        self.username = username
-        self.multicast_group = multicast_group
-        self.port = port
-        self.running = True
-        self.contacts = {}
-        self.groups = {}
+class Counter:
+    """Монотонный счетчик с метками"""
 
-        # База данных
-        self.db = DatabaseManager()
+    kind = 'counter'
 
-        # Менеджер настроек
-        self.settings = SettingsManager()
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
 
-        # Очередь для сообщений GUI
-        self.message_queue = queue.Queue()
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
 
-        # Инициализация сокетов
-        self.init_sockets()
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        return [(self.name, dict(zip(self.label_names, labels)), value) for labels, value in items]
 
-        # Загрузка контактов и групп
-        self.load_contacts()
-        self.load_groups()
 
-    def init_sockets(self):
-        """Инициализация сетевых сокетов"""
-        # Multicast сокет для группового чата
-        self.multicast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.multicast_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.multicast_sock.settimeout(1.0)
-        self.join_multicast_group()
+class Gauge:
+    """Мгновенное значение, вычисляемое при чтении.
 
-        # TCP сервер для личных сообщений
-        self.tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.tcp_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.tcp_server.settimeout(1.0)
-        self.tcp_server.bind(('0.0.0.0', 0))
-        self.tcp_port = self.tcp_server.getsockname()[1]
-        self.tcp_server.listen(5)
+    С label_name функция возвращает словарь {значение метки: значение}.
+    """
 
-        # Клиентские TCP соединения
-        self.client_sockets = []
+    kind = 'gauge'
 
-    def join_multicast_group(self):
-        """Присоединение к multicast группе"""
-        try:
-            group = socket.inet_aton(self.multicast_group)
-            mreq = struct.pack('4sL', group, socket.INADDR_ANY)
-            self.multicast_sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-            self.multicast_sock.bind(('', self.port))
-        except Exception as e:
-            print(f"Multicast error: {e}")
+    def __init__(self, name, help_text, callback, label_name=None):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+        self.label_name = label_name
 
-    def load_contacts(self):
-        """Загрузка контактов из базы данных"""
-        contacts = self.db.get_contacts(self.username)
-        for contact in contacts:
-            self.contacts[contact] = {'online': False, 'ip': None, 'port': None}
+    def samples(self):
+        if self.label_name is None:
+            return [(self.name, {}, self.callback())]
+        return [(self.name, {self.label_name: label}, value)
+                for label, value in self.callback().items()]
 
-    def load_groups(self):
-        """Загрузка групповых чатов"""
-        groups = self.db.get_user_groups(self.username)
-        for group in groups:
-            self.groups[f"GROUP_{group['id']}"] = {
-                'name': group['name'],
-                'creator': group['creator'],
-                'online': True
-            }
 
-    def broadcast_presence(self):
-        """Рассылка информации о своем присутствии"""
-        while self.running:
-            try:
-                presence_msg = {
-                    'type': 'presence',
-                    'username': self.username,
-                    'port': self.tcp_port,
-                    'action': 'online'
-                }
+class Histogram:
+    """Гистограмма с накопительными корзинами"""
 
-                self.multicast_sock.sendto(
-                    json.dumps(presence_msg).encode('utf-8'),
-                    (self.multicast_group, self.port)
-                )
-            except Exception as e:
-                print(f"Presence broadcast error: {e}")
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                       0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
 
-            time.sleep(10)
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
 
-    def listen_multicast(self):
-        """Прослушивание multicast сообщений"""
-        while self.running:
-            try:
-                data, addr = self.multicast_sock.recvfrom(1024)
-                message = json.loads(data.decode('utf-8'))
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
 
-                if message['type'] == 'presence':
-                    self.handle_presence(message, addr[0])
-                elif message['type'] == 'group_message':
-                    self.handle_group_message(message)
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
 
-            except socket.timeout:
-                continue
-            except Exception as e:
-                if self.running:
-                    print(f"Multicast listen error: {e}")
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            samples.append((self.name + '_bucket', {'le': repr(bound)}, cumulative))
+        cumulative += counts[-1]
+        samples.append((self.name + '_bucket', {'le': '+Inf'}, cumulative))
+        samples.append((self.name + '_sum', {}, total))
+        samples.append((self.name + '_count', {}, cumulative))
+        return samples
 
-    def handle_presence(self, message, ip):
-        """Обработка сообщений о присутствии"""
-        username = message['username']
 
-        if username != self.username and username in self.contacts:
-            self.contacts[username]['online'] = (message['action'] == 'online')
-            self.contacts[username]['ip'] = ip
-            self.contacts[username]['port'] = message['port']
+class NullMetric:
+    """Пустая метрика: вызовы ничего не делают"""
 
-            self.message_queue.put(('update_contacts', None))
+    def inc(self, *label_values, amount=1):
+        pass
 
-    def handle_group_message(self, message):
-        """Обработка групповых сообщений"""
-        if message['sender'] != self.username:
-            # Сохраняем в базу данных
-            self.db.save_message(
-                message['sender'],
-                message['group_id'],
-                'group',
-                message['text']
-            )
+    def observe(self, value):
+        pass
 
-            # Отправляем в очередь для GUI
-            self.message_queue.put(('group_message', message))
 
-    def send_group_message(self, group_id, text):
-        """Отправка группового сообщения"""
-        try:
-            message = {
-                'type': 'group_message',
-                'sender': self.username,
-                'group_id': group_id,
-                'text': text,
-                'timestamp': datetime.now().isoformat()
-            }
+class MetricsRegistry:
+    """Реестр метрик с выводом в текстовом формате Prometheus"""
 
-            self.multicast_sock.sendto(
-                json.dumps(message).encode('utf-8'),
-                (self.multicast_group, self.port)
-            )
+    enabled = True
 
-            # Сохраняем свое сообщение
-            self.db.save_message(self.username, group_id, 'group', text)
-            return True
-        except Exception as e:
-            print(f"Send group message error: {e}")
-            return False
+    def __init__(self):
+        self.metrics = []
 
-    def listen_tcp(self):
-        """Прослушивание TCP соединений для личных сообщений"""
-        while self.running:
-            try:
-                read_sockets = [self.tcp_server] + self.client_sockets
-                read_sockets, _, _ = select.select(read_sockets, [], [], 1.0)
+    def counter(self, name, help_text, label_names=()):
+        return self.register(Counter(name, help_text, label_names))
 
-                for sock in read_sockets:
-                    if sock == self.tcp_server:
-                        try:
-                            client_socket, addr = self.tcp_server.accept()
-                            client_socket.settimeout(1.0)
-                            self.client_sockets.append(client_socket)
-                        except socket.timeout:
-                            continue
-                    else:
-                        try:
-                            data = sock.recv(1024)
-                            if data:
-                                message = json.loads(data.decode('utf-8'))
-                                self.handle_private_message(message)
-                            else:
-                                sock.close()
-                                self.client_sockets.remove(sock)
-                        except (socket.timeout, ConnectionError):
-                            if sock in self.client_sockets:
-                                sock.close()
-                                self.client_sockets.remove(sock)
+    def gauge(self, name, help_text, callback, label_name=None):
+        return self.register(Gauge(name, help_text, callback, label_name))
 
+    def histogram(self, name, help_text, buckets=Histogram.DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, buckets))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Текст для /metrics"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                samples = metric.samples()
             except Exception as e:
-                if self.running:
-                    print(f"TCP listen error: {e}")
+                print(f"Metric {metric.name} error: {e}")
+                continue
+            for name, labels, value in samples:
+                if labels:
+                    label_text = ','.join(
+                        f'{key}="{escape_label_value(val)}"' for key, val in labels.items()
+                    )
+                    lines.append(f"{name}{{{label_text}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def escape_label_value(value):
+    """Экранирование значения метки для формата Prometheus"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class NullMetricsRegistry:
+    """Реестр для выключенных метрик - почти нулевые накладные расходы"""
+
+    enabled = False
+    NULL = NullMetric()
+
+    def counter(self, name, help_text, label_names=()):
+        return self.NULL
+
+    def gauge(self, name, help_text, callback, label_name=None):
+        return self.NULL
+
+    def histogram(self, name, help_text, buckets=None):
+        return self.NULL
+
+    def register(self, metric):
+        return metric
+
+    def render(self):
+        return ""
+
+
+class MessengerMetrics:
+    """Метрики узла мессенджера"""
+
+    # Типы сообщений, которые учитываются отдельной меткой
+    KNOWN_TYPES = ('presence', 'group_message', 'private_message', 'file_offer',
+                   'roster_query', 'roster_snapshot', 'group_op', 'group_digest',
+                   'group_sync', 'group_ops', 'relay_presence')
+
+    def __init__(self, messenger, registry):
+        self.registry = registry
+        self.messages_sent = registry.counter(
+            'neochat_messages_sent_total', 'Отправленные сообщения', ('type',))
+        self.messages_received = registry.counter(
+            'neochat_messages_received_total', 'Принятые сообщения', ('type',))
+        self.bytes_sent = registry.counter(
+            'neochat_bytes_sent_total', 'Отправлено байт', ('channel',))
+        self.bytes_received = registry.counter(
+            'neochat_bytes_received_total', 'Принято байт', ('channel',))
+        self.decode_errors = registry.counter(
+            'neochat_decode_errors_total', 'Ошибки разбора входящих сообщений', ('channel',))
+        self.send_failures = registry.counter(
+            'neochat_send_failures_total', 'Ошибки отправки', ('type',))
+        self.db_write_seconds = registry.histogram(
+            'neochat_db_write_seconds', 'Время записи сообщения в базу')
+        self.send_seconds = registry.histogram(
+            'neochat_send_seconds', 'Время отправки сообщения')
+        self.throttled = registry.counter(
+            'neochat_throttled_total', 'Отброшено защитой от перегрузки', ('reason',))
+
+        registry.gauge('neochat_message_queue_depth', 'Событий в очереди GUI',
+                       lambda: messenger.message_queue.qsize())
+        registry.gauge('neochat_event_lane_depth', 'Событий в очереди GUI по полосам',
+                       lambda: messenger.message_queue.depths(), 'lane')
+        registry.gauge('neochat_ingress_lane_depth', 'Принятых, но не обработанных сообщений по полосам',
+                       lambda: messenger.ingress_depths(), 'lane')
+        registry.gauge('neochat_client_sockets', 'Открытых входящих TCP соединений',
+                       lambda: len(messenger.client_sockets))
+        registry.gauge('neochat_contacts_online', 'Контактов в сети',
+                       lambda: sum(1 for info in list(messenger.contacts.values()) if info['online']))
+        registry.gauge('neochat_presence_members', 'Участников сегмента по маякам',
+                       lambda: messenger.presence.member_count())
+        registry.gauge('neochat_presence_interval_seconds', 'Текущий интервал маяков',
+                       lambda: messenger.presence.interval())
+
+    def message_type(self, message):
+        """Ограниченная метка типа сообщения"""
+        msg_type = message.get('type') if isinstance(message, dict) else None
+        return msg_type if msg_type in self.KNOWN_TYPES else 'other'
+
+
+class MessageTracer:
+    """Трассировка задержек сообщений по этапам.
+
+    Отправитель добавляет к сообщению поле trace с идентификатором, временем
+    отправки и длительностями своих этапов. Локальные отметки хранятся в поле
+    _trace и в сеть не уходят. Отметки ставятся по time.monotonic(), который
+    един для всех процессов узла, поэтому трассировка работает и в режиме
+    отдельного сетевого процесса. Этап network считается по часам двух узлов
+    и включает их рассинхронизацию.
+    """
+
+    SENDER_STAGES = ('thread_spawn', 'connect', 'send')
+    RECEIVER_STAGES = ('network', 'decode', 'save', 'queue_wait', 'render')
+    STAGES = SENDER_STAGES + RECEIVER_STAGES
+
+    def __init__(self, registry, enabled=False, history=200, samples=1000):
+        self.enabled = enabled
+        self.recent = collections.deque(maxlen=history)
+        self.durations = {stage: collections.deque(maxlen=samples) for stage in self.STAGES}
+        self.lock = threading.Lock()
+        self.histograms = {
+            stage: registry.register(Histogram(
+                f'neochat_trace_{stage}_seconds', f'Длительность этапа {stage}'))
+            for stage in self.STAGES
+        }
 
-    def handle_private_message(self, message):
-        """Обработка личных сообщений"""
-        if message['type'] == 'private_message':
-            # Сохраняем в базу данных
-            self.db.save_message(
-                message['sender'],
-                message['receiver'],
-                'private',
-                message['text']
-            )
+    def start(self, message, peer):
+        """Начало трассировки исходящего сообщения"""
+        if not self.enabled:
+            return
+        message['_trace'] = {
+            'id': os.urandom(8).hex(),
+            'peer': peer,
+            'direction': 'out',
+            'stamps': [['created', time.monotonic()]],
+            'remote': [],
+            'network_ms': None
+        }
 
-            # Отправляем в очередь для GUI
-            self.message_queue.put(('private_message', message))
+    def stamp(self, message, stage, at=None):
+        """Отметка времени завершения этапа"""
+        trace = message.get('_trace') if isinstance(message, dict) else None
+        if trace is not None:
+            trace['stamps'].append([stage, time.monotonic() if at is None else at])
+
+    def wire_message(self, message):
+        """Сообщение для отправки: локальные отметки заменяются полем trace"""
+        trace = message.get('_trace')
+        if trace is None:
+            return message
+
+        wire = {key: value for key, value in message.items() if key != '_trace'}
+        wire['trace'] = {
+            'id': trace['id'],
+            'sent_wall': time.time(),
+            'stages': self.local_durations(trace)
+        }
+        return wire
 
-    def send_private_message(self, receiver, text):
-        """Отправка личного сообщения"""
-        # Всегда сохраняем сообщение в БД
-        self.db.save_message(self.username, receiver, 'private', text)
+    def begin_remote(self, message, received_at, received_wall):
+        """Начало локальной части трассировки входящего сообщения"""
+        remote = message.get('trace')
+        if not self.enabled or not isinstance(remote, dict):
+            return
+        try:
+            network_ms = (received_wall - float(remote['sent_wall'])) * 1000
+            stages = [[str(name), float(ms)] for name, ms in remote.get('stages', [])]
+        except (KeyError, TypeError, ValueError):
+            return
 
-        if receiver in self.contacts and self.contacts[receiver]['online']:
+        message['_trace'] = {
+            'id': str(remote.get('id', '')),
+            'peer': message.get('sender'),
+            'direction': 'in',
+            'stamps': [['received', received_at]],
+            'remote': stages,
+            'network_ms': network_ms
+        }
+        self.stamp(message, 'decode')
+
+    def local_durations(self, trace):
+        """Длительности этапов по локальным отметкам, мс"""
+        stamps = trace['stamps']
+        return [[stamps[i][0], (stamps[i][1] - stamps[i - 1][1]) * 1000]
+                for i in range(1, len(stamps))]
+
+    def finish(self, message):
+        """Завершение трассировки и учет длительностей этапов"""
+        trace = message.pop('_trace', None) if isinstance(message, dict) else None
+        if trace is None:
+            return
+
+        stages = list(trace['remote'])
+        if trace['network_ms'] is not None:
+            stages.append(['network', trace['network_ms']])
+        stages.extend(self.local_durations(trace))
+
+        with self.lock:
+            for stage, ms in stages:
+                if stage in self.durations:
+                    self.durations[stage].append(ms)
+                    self.histograms[stage].observe(max(ms, 0.0) / 1000)
+            self.recent.append({
+                'id': trace['id'],
+                'peer': trace['peer'],
+                'direction': trace['direction'],
+                'time': datetime.now().strftime('%H:%M:%S'),
+                'stages': stages,
+                'total_ms': sum(ms for _, ms in stages)
+            })
+
+    def summary(self):
+        """Перцентили длительностей по этапам, мс"""
+        with self.lock:
+            data = {stage: sorted(values) for stage, values in self.durations.items() if values}
+        return {stage: {p: percentile(values, p) for p in (50, 90, 99)}
+                for stage, values in data.items()}
+
+    def recent_traces(self):
+        """Последние завершенные трассы, новые первыми"""
+        with self.lock:
+            return list(reversed(self.recent))
+
+
+class MetricsServer:
+    """Локальный HTTP сервер метрик в формате Prometheus"""
+
+    def __init__(self, registry, port, host='127.0.0.1'):
+        registry_ref = registry
+
+        class Handler(http_server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry_ref.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http_server.ThreadingHTTPServer((host, port), Handler)
+        self.port = self.httpd.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FramedConnection:
+    """TCP соединение с JSON кадрами, разделенными переводом строки"""
+
+    def __init__(self, sock, buffer=b''):
+        self.sock = sock
+        self.buffer = bytearray(buffer)
+
+    def send_frame(self, frame):
+        """Отправка одного кадра"""
+        self.sock.sendall(json.dumps(frame).encode('utf-8') + b'\n')
+
+    def read_frame(self):
+        """Чтение одного кадра"""
+        while True:
+            index = self.buffer.find(b'\n')
+            if index >= 0:
+                line = bytes(self.buffer[:index])
+                del self.buffer[:index + 1]
+                return json.loads(line.decode('utf-8'))
+
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("connection closed")
+            self.buffer += data
+
+    def read_exact_into(self, view):
+        """Чтение ровно len(view) байт в буфер без промежуточных копий"""
+        filled = min(len(self.buffer), len(view))
+        if filled:
+            view[:filled] = self.buffer[:filled]
+            del self.buffer[:filled]
+
+        while filled < len(view):
+            received = self.sock.recv_into(view[filled:])
+            if not received:
+                raise ConnectionError("connection closed")
+            filled += received
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class FileTransferManager:
+    """Передача файлов по личному TCP каналу.
+
+    Файл передается кусками: отправитель считает SHA-256 куска прямо по mmap
+    и отдает данные через socket.sendfile, получатель пишет их в заранее
+    выделенный .part файл и подтверждает каждый кусок. Состояние получателя
+    хранится рядом с .part файлом, поэтому после обрыва передача продолжается
+    с последнего проверенного куска. Каждая передача идет в своем потоке и
+    своем соединении и не задерживает текстовые сообщения.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+    MAX_ATTEMPTS = 5
+    PROGRESS_INTERVAL = 0.25
+    # Ответа пользователя на файл не от контакта ждем меньше, чем
+    # отправитель ждет file_accept (таймаут соединения 30 с)
+    CONSENT_TIMEOUT = 25.0
+    MAX_PENDING_OFFERS = 4
+    # Свободное место, которое остается на диске после приема файла
+    DISK_RESERVE = 64 * 1024 * 1024
+
+    def __init__(self, messenger):
+        self.messenger = messenger
+        # transfer_id -> [threading.Event, согласие пользователя]
+        self.offers = {}
+        self.offers_lock = threading.Lock()
+
+    @property
+    def downloads_dir(self):
+        return self.messenger.settings.get('downloads_dir', 'downloads')
+
+    @property
+    def max_file_size(self):
+        return self.messenger.settings.get('max_file_size', 4 * 1024 ** 3)
+
+    def send(self, receiver, path):
+        """Запуск отправки файла в отдельном потоке"""
+        if not os.path.isfile(path):
+            return False
+
+        thread = threading.Thread(target=self._send_thread, args=(receiver, path))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def transfer_id(self, receiver, path, stat):
+        """Идентификатор передачи, одинаковый для повторных попыток"""
+        key = f"{self.messenger.username}|{receiver}|{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+    def _send_thread(self, receiver, path):
+        """Поток отправки файла с продолжением после обрыва"""
+        stat = os.stat(path)
+        info = {
+            'transfer_id': self.transfer_id(receiver, path, stat),
+            'peer': receiver,
+            'filename': os.path.basename(path),
+            'size': stat.st_size,
+            'done': 0,
+            'direction': 'out',
+            'status': 'active'
+        }
+        self.report(info, force=True)
+
+        for attempt in range(self.MAX_ATTEMPTS):
+            contact = self.messenger.contacts.get(receiver)
+            if not self.messenger.running or not contact or not contact['ip']:
+                break
             try:
-                message = {
-                    'type': 'private_message',
-                    'sender': self.username,
-                    'receiver': receiver,
-                    'text': text,
-                    'timestamp': datetime.now().isoformat()
+                with open(path, 'rb') as f:
+                    accepted = self._send_file(f, (contact['ip'], contact['port']), info)
+                if not accepted:
+                    # Отказ получателя повторными попытками не обходится
+                    info['status'] = 'rejected'
+                    self.report(info, force=True)
+                    return
+                info['status'] = 'done'
+                self.report(info, force=True)
+                self.messenger.save_message(
+                    self.messenger.username, receiver, 'private',
+                    f"📎 Файл: {info['filename']} ({format_size(info['size'])})"
+                )
+                return
+            except (OSError, ConnectionError, ValueError) as e:
+                print(f"File transfer to {receiver} interrupted: {e}")
+                self.messenger.stop_event.wait(min(2 ** attempt, 10))
+
+        info['status'] = 'failed'
+        self.report(info, force=True)
+
+    def _send_file(self, f, address, info):
+        """Одна попытка передачи; False, если получатель отказался"""
+        conn = FramedConnection(socket.create_connection(address, timeout=30.0))
+        try:
+            conn.send_frame({
+                'type': 'file_offer',
+                'transfer_id': info['transfer_id'],
+                'sender': self.messenger.username,
+                'filename': info['filename'],
+                'size': info['size'],
+                'chunk_size': self.CHUNK_SIZE
+            })
+            reply = conn.read_frame()
+            if reply.get('type') == 'file_reject':
+                print(f"File transfer to {info['peer']} rejected: {reply.get('reason')}")
+                return False
+            if reply.get('type') != 'file_accept':
+                raise ValueError(f"transfer rejected: {reply}")
+
+            size = info['size']
+            index = reply['offset'] // self.CHUNK_SIZE
+            info['done'] = index * self.CHUNK_SIZE
+            self.report(info, force=True)
+
+            if size == 0:
+                view = None
+                mapped = None
+            else:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                view = memoryview(mapped)
+
+            try:
+                failures = 0
+                while index * self.CHUNK_SIZE < size:
+                    start = index * self.CHUNK_SIZE
+                    length = min(self.CHUNK_SIZE, size - start)
+                    digest = hashlib.sha256(view[start:start + length]).hexdigest()
+
+                    conn.send_frame({
+                        'type': 'file_chunk',
+                        'index': index,
+                        'length': length,
+                        'sha256': digest
+                    })
+                    conn.sock.sendfile(f, start, length)
+
+                    ack = conn.read_frame()
+                    if ack.get('index') != index:
+                        raise ValueError(f"unexpected ack: {ack}")
+                    if not ack.get('ok'):
+                        # Кусок поврежден - отправляем его еще раз
+                        failures += 1
+                        if failures > 3:
+                            raise ValueError(f"chunk {index} failed verification")
+                        continue
+
+                    failures = 0
+                    index += 1
+                    info['done'] = min(index * self.CHUNK_SIZE, size)
+                    self.report(info)
+            finally:
+                if view is not None:
+                    view.release()
+                    mapped.close()
+
+            if conn.read_frame().get('type') != 'file_done':
+                raise ValueError("receiver did not confirm the file")
+            return True
+        finally:
+            conn.close()
+
+    def receive(self, sock, offer, buffer=b'', ip=None):
+        """Запуск приема файла в отдельном потоке"""
+        sock.settimeout(30.0)
+        thread = threading.Thread(target=self._receive_thread,
+                                  args=(FramedConnection(sock, buffer), offer, ip))
+        thread.daemon = True
+        thread.start()
+
+    def _receive_thread(self, conn, offer, ip):
+        """Поток приема файла"""
+        try:
+            self.validate_offer(offer)
+        except (OSError, ValueError) as e:
+            print(f"File offer rejected: {e}")
+            self.reject(conn, str(e))
+            conn.close()
+            return
+
+        info = {
+            'transfer_id': offer['transfer_id'],
+            'peer': offer['sender'],
+            'filename': os.path.basename(offer['filename']) or 'file',
+            'size': offer['size'],
+            'done': 0,
+            'direction': 'in',
+            'status': 'active'
+        }
+        try:
+            if not self.consent(info, ip):
+                self.reject(conn, 'declined')
+                info['status'] = 'rejected'
+                self.report(info, force=True)
+                return
+            self._receive_file(conn, offer, info)
+        except Exception as e:
+            # Частичный файл остается - отправитель продолжит с места обрыва.
+            # Любая ошибка завершает передачу, чтобы строка в GUI не висела
+            print(f"File transfer from {info['peer']} interrupted: {e}")
+            info['status'] = 'failed'
+            self.report(info, force=True)
+        finally:
+            conn.close()
+
+    def validate_offer(self, offer):
+        """Проверка предложения файла до ответа; ValueError, если принимать нельзя"""
+        transfer_id = offer.get('transfer_id')
+        size = offer.get('size')
+        if not isinstance(transfer_id, str) or not re.fullmatch(r'[0-9a-f]{1,64}', transfer_id):
+            raise ValueError("invalid transfer id")
+        if not isinstance(offer.get('sender'), str) or not offer['sender'] \
+                or not isinstance(offer.get('filename'), str):
+            raise ValueError("invalid file offer")
+        # bool - подкласс int, но размером не является
+        if type(size) is not int or size < 0:
+            raise ValueError("invalid file size")
+        if type(offer.get('chunk_size')) is not int or offer['chunk_size'] != self.CHUNK_SIZE:
+            raise ValueError("unsupported chunk size")
+        if size > self.max_file_size:
+            raise ValueError("file is too large")
+
+        # Недокачанный файл уже занимает свое место
+        os.makedirs(self.downloads_dir, exist_ok=True)
+        part_path = self.part_path(transfer_id)
+        existing = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if shutil.disk_usage(self.downloads_dir).free < size - existing + self.DISK_RESERVE:
+            raise ValueError("not enough disk space")
+
+    def part_path(self, transfer_id):
+        return os.path.join(self.downloads_dir, f"{transfer_id}.part")
+
+    def reject(self, conn, reason):
+        """Отказ от передачи; отправитель не повторяет попытку"""
+        try:
+            conn.send_frame({'type': 'file_reject', 'reason': reason})
+        except OSError:
+            pass
+
+    def consent(self, info, ip):
+        """Согласие на прием: контакт со своего адреса - сразу, остальные - по ответу пользователя"""
+        contact = self.messenger.contacts.get(info['peer'])
+        if contact and ip is not None and contact['ip'] == ip:
+            return True
+
+        entry = [threading.Event(), False]
+        with self.offers_lock:
+            if len(self.offers) >= self.MAX_PENDING_OFFERS or info['transfer_id'] in self.offers:
+                return False
+            self.offers[info['transfer_id']] = entry
+        try:
+            self.messenger.message_queue.put(('file_request', dict(info)))
+            entry[0].wait(self.CONSENT_TIMEOUT)
+            return entry[1]
+        finally:
+            with self.offers_lock:
+                self.offers.pop(info['transfer_id'], None)
+
+    def answer(self, transfer_id, accepted):
+        """Ответ пользователя на предложение файла"""
+        with self.offers_lock:
+            entry = self.offers.get(transfer_id)
+        if entry:
+            entry[1] = bool(accepted)
+            entry[0].set()
+
+    def _receive_file(self, conn, offer, info):
+        """Прием кусков в заранее выделенный файл"""
+        size = offer['size']
+        chunk_size = self.CHUNK_SIZE
+
+        part_path = self.part_path(offer['transfer_id'])
+        state_path = part_path + '.state'
+
+        state = {'size': size, 'chunk_size': chunk_size, 'verified': 0}
+        if os.path.exists(part_path) and os.path.exists(state_path):
+            with open(state_path, 'r', encoding='utf-8') as sf:
+                saved = json.load(sf)
+            if isinstance(saved, dict) and saved.get('size') == size \
+                    and saved.get('chunk_size') == chunk_size \
+                    and type(saved.get('verified')) is int \
+                    and 0 <= saved['verified'] * chunk_size <= size + chunk_size:
+                state = saved
+
+        mode = 'r+b' if os.path.exists(part_path) else 'w+b'
+        with open(part_path, mode) as f:
+            if mode == 'w+b':
+                self.preallocate(f, size)
+
+            index = state['verified']
+            info['done'] = min(index * chunk_size, size)
+            self.report(info, force=True)
+            conn.send_frame({'type': 'file_accept', 'offset': index * chunk_size})
+
+            chunk = bytearray(chunk_size)
+            while index * chunk_size < size:
+                header = self.chunk_header(conn.read_frame())
+                length = header['length']
+                if header['index'] != index or length != min(chunk_size, size - index * chunk_size):
+                    raise ValueError(f"unexpected chunk header: {header}")
+
+                view = memoryview(chunk)[:length]
+                conn.read_exact_into(view)
+                ok = hashlib.sha256(view).hexdigest() == header['sha256']
+                if ok:
+                    f.seek(index * chunk_size)
+                    f.write(view)
+                    index += 1
+                    state['verified'] = index
+                    with open(state_path, 'w', encoding='utf-8') as sf:
+                        json.dump(state, sf)
+                view.release()
+                conn.send_frame({'type': 'file_ack', 'index': header['index'], 'ok': ok})
+
+                info['done'] = min(index * chunk_size, size)
+                self.report(info)
+
+        final_path = self.unique_path(os.path.join(self.downloads_dir, info['filename']))
+        os.replace(part_path, final_path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        conn.send_frame({'type': 'file_done'})
+
+        info['status'] = 'done'
+        info['path'] = final_path
+        self.report(info, force=True)
+        self.messenger.save_message(
+            info['peer'], self.messenger.username, 'private',
+            f"📎 Файл: {info['filename']} ({format_size(size)})"
+        )
+
+    @staticmethod
+    def chunk_header(header):
+        """Заголовок куска из сети; ValueError, если он не такой, как ожидается"""
+        if not isinstance(header, dict) or header.get('type') != 'file_chunk' \
+                or type(header.get('index')) is not int or type(header.get('length')) is not int \
+                or not isinstance(header.get('sha256'), str) \
+                or not re.fullmatch(r'[0-9a-f]{64}', header['sha256']):
+            raise ValueError(f"invalid chunk header: {str(header)[:200]}")
+        return header
+
+    def preallocate(self, f, size):
+        """Выделение места под файл заранее"""
+        if size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+                return
+            except OSError:
+                pass
+        f.truncate(size)
+
+    def unique_path(self, path):
+        """Имя файла, не затирающее уже существующий"""
+        base, ext = os.path.splitext(path)
+        counter = 1
+        while os.path.exists(path):
+            path = f"{base} ({counter}){ext}"
+            counter += 1
+        return path
+
+    def report(self, info, force=False):
+        """Передача прогресса в очередь GUI (не чаще PROGRESS_INTERVAL)"""
+        now = time.monotonic()
+        if not force and now - info.get('reported', 0) < self.PROGRESS_INTERVAL:
+            return
+        info['reported'] = now
+        self.messenger.message_queue.put(('file_progress', dict(info)))
+
+
+def encode_roster(entries):
+    """Компактная запись списка участников для ответа на roster_query.
+
+    Записи (username, ip, port, version) сортируются по имени. Имя хранится
+    как длина общего с предыдущим префикса и остаток, IP (как число) и
+    версия - разностью с предыдущей записью, порт - как есть.
+    """
+    rows = []
+    prev_name, prev_ip, prev_version = '', 0, 0
+    for username, ip, port, version in sorted(entries):
+        ip_value = struct.unpack('!I', socket.inet_aton(ip))[0]
+        prefix = len(os.path.commonprefix([prev_name, username]))
+        rows.append([prefix, username[prefix:], ip_value - prev_ip, port, version - prev_version])
+        prev_name, prev_ip, prev_version = username, ip_value, version
+    return rows
+
+
+def decode_roster(rows):
+    """Обратное преобразование к encode_roster"""
+    entries = []
+    prev_name, prev_ip, prev_version = '', 0, 0
+    for prefix, suffix, ip_delta, port, version_delta in rows:
+        username = prev_name[:prefix] + suffix
+        ip_value = prev_ip + ip_delta
+        version = prev_version + version_delta
+        entries.append((username, socket.inet_ntoa(struct.pack('!I', ip_value)), port, version))
+        prev_name, prev_ip, prev_version = username, ip_value, version
+    return entries
+
+
+def format_size(size):
+    """Человекочитаемый размер файла"""
+    for unit in ('Б', 'КБ', 'МБ', 'ГБ'):
+        if size < 1024 or unit == 'ГБ':
+            return f"{size:.0f} {unit}" if unit == 'Б' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+class PriorityLanes:
+    """Две полосы очереди: управляющий трафик раньше чата.
+
+    Присутствие, список участников и обновления контактов выдаются первыми,
+    чтобы поток сообщений чата не задерживал их. Чтобы чат не голодал при
+    потоке управляющих элементов, после CONTROL_BURST управляющих подряд
+    один элемент берется из чата. Блокировки нет - ее держит владелец.
+    """
+
+    CONTROL = 'control'
+    CHAT = 'chat'
+    CONTROL_BURST = 16
+
+    def __init__(self):
+        self.lanes = {self.CONTROL: collections.deque(), self.CHAT: collections.deque()}
+        self.control_streak = 0
+
+    def put(self, lane, item):
+        self.lanes[lane].append(item)
+
+    def pop(self):
+        """Следующий элемент с учетом приоритета; IndexError, если пусто"""
+        control = self.lanes[self.CONTROL]
+        chat = self.lanes[self.CHAT]
+        if control and (not chat or self.control_streak < self.CONTROL_BURST):
+            self.control_streak += 1
+            return control.popleft()
+        self.control_streak = 0
+        return chat.popleft()
+
+    def depth(self, lane):
+        return len(self.lanes[lane])
+
+    def depths(self):
+        return {lane: len(items) for lane, items in self.lanes.items()}
+
+    def __len__(self):
+        return len(self.lanes[self.CONTROL]) + len(self.lanes[self.CHAT])
+
+
+class EventChannel:
+    """Очередь событий для GUI с пробуждением потребителя.
+
+    Совместима с queue.Queue по put/get/get_nowait/qsize/empty. Пробуждение
+    вызывается только при переходе очереди из пустого состояния в непустое,
+    поэтому поток событий не порождает поток пробуждений.
+
+    События обновления списков не несут данных, поэтому повторное событие
+    того же типа, пока первое еще ждет в очереди, отбрасывается.
+
+    Сообщения чата и прогресс передачи файлов идут в полосу чата, остальное -
+    в управляющую, которая обслуживается первой (см. PriorityLanes).
+    """
+
+    COALESCED = frozenset({'update_contacts', 'update_groups'})
+    CHAT_EVENTS = frozenset({'group_message', 'private_message', 'file_progress'})
+
+    def __init__(self):
+        self.events = PriorityLanes()
+        self.condition = threading.Condition()
+        self.waker = None
+        self.pending_updates = set()
+
+    def set_waker(self, waker):
+        """Установка функции пробуждения потребителя"""
+        with self.condition:
+            self.waker = waker
+            pending = bool(self.events)
+        if waker and pending:
+            waker()
+
+    def put(self, event):
+        with self.condition:
+            msg_type = event[0] if event else None
+            if msg_type in self.COALESCED:
+                if msg_type in self.pending_updates:
+                    return
+                self.pending_updates.add(msg_type)
+            was_empty = not self.events
+            # Завершающий None - в конец чата, чтобы не обогнать ждущие события
+            if event is None or msg_type in self.CHAT_EVENTS:
+                lane = PriorityLanes.CHAT
+            else:
+                lane = PriorityLanes.CONTROL
+            self.events.put(lane, event)
+            self.condition.notify()
+            waker = self.waker
+
+        # Будим вне блокировки, чтобы не держать производителей
+        if was_empty and waker:
+            waker()
+
+    def get(self, block=True, timeout=None):
+        with self.condition:
+            if not block:
+                timeout = 0
+            if not self.condition.wait_for(lambda: self.events, timeout):
+                raise queue.Empty
+            return self.pop_event()
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def drain(self, limit):
+        """Извлечение не более limit событий за раз"""
+        with self.condition:
+            count = min(limit, len(self.events))
+            return [self.pop_event() for _ in range(count)]
+
+    def pop_event(self):
+        """Извлечение события; вызывается под блокировкой"""
+        event = self.events.pop()
+        if event:
+            self.pending_updates.discard(event[0])
+        return event
+
+    def qsize(self):
+        return len(self.events)
+
+    def depths(self):
+        """Глубина каждой полосы"""
+        with self.condition:
+            return self.events.depths()
+
+    def empty(self):
+        return not self.events
+
+
+class RateLimiter:
+    """Ограничение частоты событий по ключу алгоритмом token bucket.
+
+    rate - событий в секунду, burst - допустимый всплеск. Ключей (адресов
+    или имен) не больше max_keys: давно не встречавшиеся вытесняются, так
+    что подделка адресов и имен не раздувает память. rate <= 0 отключает
+    ограничение.
+    """
+
+    MAX_KEYS = 4096
+
+    def __init__(self, rate, burst=None, max_keys=MAX_KEYS):
+        self.rate = rate
+        self.burst = burst if burst is not None else 2 * rate
+        self.max_keys = max_keys
+        # key -> [токены, время последнего пополнения]
+        self.buckets = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def allow(self, key, cost=1.0):
+        """Списание cost токенов; False, если ключ исчерпал лимит"""
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+                if len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < cost:
+                return False
+            bucket[0] -= cost
+            return True
+
+
+class PeerRecord:
+    """Сведения об одном замеченном участнике"""
+
+    __slots__ = ('username', 'ip', 'port', 'version', 'last_seen',
+                 'interval', 'capabilities', 'online')
+
+    def __init__(self, username):
+        self.username = username
+        self.ip = None
+        self.port = None
+        self.version = 0
+        self.last_seen = 0.0
+        self.interval = None
+        self.capabilities = 0
+        self.online = False
+
+
+class PeerDirectory:
+    """Справочник всех замеченных участников, а не только контактов.
+
+    Записи хранятся в порядке последнего обновления: самые давние
+    вытесняются при превышении max_size, а записи старше ttl секунд
+    удаляются. Поэтому память ограничена и при десятках тысяч участников.
+    """
+
+    MAX_SIZE = 65536
+    TTL = 24 * 3600
+
+    # Возможности узла, объявляемые в маяке битовой маской
+    CAP_FRAMING = 1
+    CAP_FILE_TRANSFER = 2
+    CAP_ROSTER = 4
+    CAP_GROUPS = 8
+    LOCAL_CAPABILITIES = CAP_FRAMING | CAP_FILE_TRANSFER | CAP_ROSTER | CAP_GROUPS
+
+    def __init__(self, max_size=MAX_SIZE, ttl=TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.records = collections.OrderedDict()
+        self.online_count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, username):
+        return self.records.get(username)
+
+    def is_online(self, username):
+        record = self.records.get(username)
+        return record is not None and record.online
+
+    def update(self, username, online, ip=None, port=None, version=0,
+               interval=None, capabilities=0, secondhand=False):
+        """Учет маяка или записи из списка участников.
+
+        secondhand - сведения об участнике от третьего узла: ушедшего в офлайн
+        они возвращают в сеть только с более новой версией, иначе опоздавший
+        список соседа отменил бы его прощальный маяк.
+        Возвращает запись или None, если сведения старее уже известных.
+        """
+        now = time.monotonic()
+        with self.lock:
+            record = self.records.get(username)
+            if record is None:
+                record = PeerRecord(username)
+                self.records[username] = record
+            elif version < record.version or (secondhand and online and not record.online
+                                              and version == record.version):
+                return None
+            else:
+                self.records.move_to_end(username)
+
+            if online:
+                record.ip, record.port = ip, port
+                record.interval = interval
+                record.capabilities = capabilities
+            self.online_count += online - record.online
+            record.online = online
+            record.version = version
+            record.last_seen = now
+            self.evict(now)
+            return record
+
+    def evict(self, now):
+        """Вытеснение давних записей; вызывается под блокировкой"""
+        while self.records:
+            username, record = next(iter(self.records.items()))
+            if len(self.records) <= self.max_size and now - record.last_seen <= self.ttl:
+                break
+            del self.records[username]
+            self.online_count -= record.online
+
+    def alive(self):
+        """Участники в сети"""
+        with self.lock:
+            return [record for record in self.records.values() if record.online]
+
+    def expire(self, timeout_for):
+        """Перевод в офлайн участников, чьи маяки перестали приходить.
+
+        timeout_for(record) возвращает допустимую паузу в секундах.
+        Возвращает имена ушедших.
+        """
+        now = time.monotonic()
+        gone = []
+        with self.lock:
+            for record in self.records.values():
+                if record.online and now - record.last_seen > timeout_for(record):
+                    record.online = False
+                    self.online_count -= 1
+                    gone.append(record.username)
+        return gone
+
+
+class PresenceScheduler:
+    """Адаптивный интервал маяков присутствия в духе RTCP (RFC 3550, 6.3).
+
+    Все узлы сегмента вместе тратят на маяки около bandwidth байт в
+    секунду: интервал растет пропорционально числу участников, но не
+    бывает меньше min_interval. Каждая пауза умножается на случайный
+    множитель 0.5..1.5, чтобы узлы не отправляли маяки одновременно.
+    Участник, не приславший маяк за EXPIRY_FACTOR своих интервалов,
+    считается ушедшим.
+    """
+
+    EXPIRY_FACTOR = 5
+    # Верхняя граница интервала, заявленного участником: с большим он
+    # никогда не устаревал бы. Собственный интервал такой величины
+    # получается только у сегмента из десятков тысяч узлов
+    MAX_INTERVAL = 600
+    # Поправка на укорочение пауз пересмотром таймера (RFC 3550, A.7)
+    COMPENSATION = math.e - 1.5
+    # Заголовки IP и UDP
+    PACKET_OVERHEAD = 28
+
+    def __init__(self, directory, min_interval, bandwidth):
+        self.directory = directory
+        self.min_interval = min_interval
+        self.bandwidth = bandwidth
+        self.avg_size = 128.0
+
+    def sent(self, size):
+        """Учет размера собственного маяка в скользящем среднем"""
+        self.avg_size += (size + self.PACKET_OVERHEAD - self.avg_size) / 16
+
+    def member_count(self):
+        return self.directory.online_count + 1
+
+    def interval(self):
+        """Детерминированный интервал без случайного множителя"""
+        return max(self.min_interval, self.member_count() * self.avg_size / self.bandwidth)
+
+    def next_delay(self):
+        """Пауза до следующего маяка"""
+        return self.interval() * random.uniform(0.5, 1.5) / self.COMPENSATION
+
+    def clamp_interval(self, interval):
+        """Заявленный интервал в пределах [min_interval, MAX_INTERVAL]; None, если это не число"""
+        try:
+            interval = float(interval)
+        except (TypeError, ValueError):
+            return None
+        if not math.isfinite(interval):
+            return None
+        return min(max(interval, self.min_interval), self.MAX_INTERVAL)
+
+    def expired(self):
+        """Участники, чьи маяки перестали приходить"""
+        fallback = self.interval()
+        return self.directory.expire(
+            lambda record: self.EXPIRY_FACTOR * max(record.interval or fallback, self.min_interval))
+
+
+class GroupMembership:
+    """Реплицируемый журнал состава групп.
+
+    Каждая операция (create, add, remove, rename) получает номер seq в
+    пределах автора и вектор версий группы deps на момент создания.
+    Операция применяется, когда применены все ее зависимости; до этого она
+    ждет в pending, а узел запрашивает недостающее. Состав и название
+    вычисляются по правилу "последняя запись побеждает" с ключом
+    (hlc, author): метки HLC согласованы с причинностью, поэтому узлы,
+    получившие одинаковый набор операций, видят одинаковую группу.
+    """
+
+    OPS = ('create', 'add', 'remove', 'rename')
+    # Ожидающих операций на группу и всего
+    MAX_PENDING = 1024
+    MAX_PENDING_TOTAL = 8192
+
+    def __init__(self):
+        self.groups = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, group_id):
+        return group_id in self.groups
+
+    def vector(self, group_id):
+        """Вектор версий группы: author -> последний примененный seq"""
+        with self.lock:
+            state = self.groups.get(group_id)
+            return dict(state['vector']) if state else {}
+
+    def is_member(self, group_id, username):
+        with self.lock:
+            state = self.groups.get(group_id)
+            return bool(state) and username in state['members'] and state['members'][username][1]
+
+    def awaiting(self, group_id):
+        """Есть операции, ждущие недостающих зависимостей"""
+        with self.lock:
+            return bool(self.pending.get(group_id))
+
+    @classmethod
+    def valid(cls, entry):
+        """Проверка операции из сети до того, как она изменит состояние"""
+        if not isinstance(entry, dict) or entry.get('op') not in cls.OPS:
+            return False
+        if not isinstance(entry.get('group'), str) or not isinstance(entry.get('author'), str):
+            return False
+        seq, hlc, deps = entry.get('seq'), entry.get('hlc'), entry.get('deps')
+        if type(seq) is not int or seq < 1 or type(hlc) is not int:
+            return False
+        if not isinstance(deps, dict) or not all(
+                isinstance(author, str) and type(version) is int for author, version in deps.items()):
+            return False
+        if 'member' not in entry or 'name' not in entry:
+            return False
+        # Поле, нужное операции, - строка; остальное - строка или None
+        needed = 'member' if entry['op'] in ('add', 'remove') else 'name'
+        for field in ('member', 'name'):
+            value = entry[field]
+            if not (isinstance(value, str) or (value is None and field != needed)):
+                return False
+        return True
+
+    def create_op(self, group_id, author, op, hlc, member=None, name=None):
+        """Новая локальная операция; применяется сразу"""
+        with self.lock:
+            state = self.groups.get(group_id)
+            if state is None and op != 'create':
+                raise KeyError(group_id)
+            vector = dict(state['vector']) if state else {}
+            entry = {
+                'group': group_id,
+                'author': author,
+                'seq': vector.get(author, 0) + 1,
+                'hlc': hlc,
+                'op': op,
+                'member': member,
+                'name': name,
+                'deps': vector
+            }
+            self.apply_locked(entry)
+            return entry
+
+    def apply(self, entry):
+        """Прием операции; возвращает список впервые примененных"""
+        if not self.valid(entry):
+            return []
+        with self.lock:
+            group_id = entry['group']
+            state = self.groups.get(group_id)
+            if state and state['vector'].get(entry['author'], 0) >= entry['seq']:
+                return []
+            if not self.ready(state, entry):
+                pending = self.pending.get(group_id, {})
+                if len(pending) < self.MAX_PENDING and \
+                        sum(map(len, self.pending.values())) < self.MAX_PENDING_TOTAL:
+                    self.pending.setdefault(group_id, pending)[(entry['author'], entry['seq'])] = entry
+                return []
+
+            applied = [entry]
+            self.apply_locked(entry)
+            # Примененная операция могла разблокировать ожидающие
+            pending = self.pending.get(group_id, {})
+            progress = True
+            while pending and progress:
+                progress = False
+                state = self.groups[group_id]
+                for key, waiting in list(pending.items()):
+                    if state['vector'].get(waiting['author'], 0) >= waiting['seq']:
+                        del pending[key]
+                    elif self.ready(state, waiting):
+                        del pending[key]
+                        self.apply_locked(waiting)
+                        applied.append(waiting)
+                        progress = True
+            if not pending:
+                self.pending.pop(group_id, None)
+            return applied
+
+    @staticmethod
+    def ready(state, entry):
+        vector = state['vector'] if state else {}
+        if vector.get(entry['author'], 0) != entry['seq'] - 1:
+            return False
+        return all(vector.get(author, 0) >= seq for author, seq in entry['deps'].items())
+
+    def apply_locked(self, entry):
+        group_id, author = entry['group'], entry['author']
+        state = self.groups.get(group_id)
+        if state is None:
+            state = self.groups[group_id] = {
+                'vector': {}, 'members': {}, 'name': (0, '', ''), 'creator': None, 'ops': []
+            }
+        state['vector'][author] = entry['seq']
+        state['ops'].append(entry)
+
+        stamp = (entry['hlc'], author)
+        op = entry['op']
+        if op == 'create':
+            state['creator'] = author
+            self.assign(state['members'], author, stamp, True)
+            op = 'rename'
+        if op in ('add', 'remove') and entry['member']:
+            self.assign(state['members'], entry['member'], stamp, op == 'add')
+        if op == 'rename' and entry['name'] and stamp > state['name'][:2]:
+            state['name'] = stamp + (entry['name'],)
+
+    @staticmethod
+    def assign(members, username, stamp, present):
+        current = members.get(username)
+        if current is None or stamp > current[0]:
+            members[username] = (stamp, present)
+
+    def missing(self, group_id, vector):
+        """Операции группы, которых нет у узла с вектором vector"""
+        with self.lock:
+            state = self.groups.get(group_id)
+            if not state:
+                return []
+            return [entry for entry in state['ops']
+                    if entry['seq'] > vector.get(entry['author'], 0)]
+
+    def behind(self, group_id, vector):
+        """У узла с вектором vector есть операции, которых нет у нас"""
+        local = self.vector(group_id)
+        return any(seq > local.get(author, 0) for author, seq in vector.items())
+
+    def digest(self, username):
+        """Векторы версий групп, в которых состоит username"""
+        with self.lock:
+            return {group_id: dict(state['vector']) for group_id, state in self.groups.items()
+                    if state['members'].get(username, (None, False))[1]}
+
+    def groups_of(self, username):
+        """Состав и название групп, в которых состоит username"""
+        with self.lock:
+            result = {}
+            for group_id, state in self.groups.items():
+                if not state['members'].get(username, (None, False))[1]:
+                    continue
+                result[group_id] = {
+                    'name': state['name'][2],
+                    'creator': state['creator'],
+                    'members': sorted(name for name, (_, present) in state['members'].items()
+                                      if present)
                 }
+            return result
 
-                # Создаем отдельный поток для отправки
-                thread = threading.Thread(
-                    target=self._send_private_message_thread,
-                    args=(receiver, message)
-                )
-                thread.daemon = True
-                thread.start()
-                return True
+
+class MulticastMessenger:
+    # Сколько соседей в среднем отвечает новичку списком участников
+    ROSTER_RESPONDERS = 3
+    # Разброс задержки ответа, чтобы ответы не приходили одной пачкой
+    ROSTER_REPLY_SPREAD = 0.05
+
+    # Входящие TCP соединения: всего, с одного адреса, новых в секунду
+    # с одного адреса; молчащие дольше CLIENT_IDLE_TIMEOUT закрываются
+    MAX_CLIENTS = 64
+    MAX_CLIENTS_PER_IP = 8
+    CONNECTION_RATE = 10
+    CLIENT_IDLE_TIMEOUT = 30.0
+    # Недочитанная строка длиннее этого - не сообщение, а мусор
+    MAX_TCP_BUFFER = 1024 * 1024
+
+    # Принятые сообщения раскладываются по полосам: управляющие обслуживаются
+    # раньше чата. За проход обрабатывается не больше INGRESS_BATCH, затем
+    # сокеты читаются снова, поэтому маяк ждет не дольше одной пачки чата.
+    # Сверх INGRESS_BACKLOG в полосе сообщения отбрасываются
+    CONTROL_TYPES = frozenset({'presence', 'roster_query', 'roster_snapshot', 'group_op',
+                               'group_digest', 'group_sync', 'group_ops', 'relay_presence'})
+    INGRESS_BATCH = 32
+    INGRESS_DRAIN = 256
+    INGRESS_BACKLOG = 4096
+
+    def __init__(self, username, multicast_group='224.1.1.1', port=5007,
+                 db_path='messenger.db', interface=None, metrics_port=None, db=None):
+        self.username = username
+        self.multicast_group = multicast_group
+        self.port = port
+        self.interface = interface
+        self.running = True
+        self.stopped = False
+        self.threads = []
+
+        # Сигнал остановки: Event для ожиданий и пара сокетов для select
+        self.stop_event = threading.Event()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.announce_presence = True
+        self.contacts = {}
+        self.groups = {}
+        # Все замеченные участники, не только контакты
+        self.directory = PeerDirectory()
+        # Версия собственного состояния: более старые сведения о нас отбрасываются
+        self.presence_version = int(time.time() * 1000)
+        # Метки порядка сообщений, общего для всех узлов
+        self.clock = HybridClock()
+        # Реплицируемый состав групп и группы, на которые мы подписаны
+        self.memberships = GroupMembership()
+        self.subscriptions = set()
+
+        # База данных; окно входа передает уже открытое соединение
+        self.db = db if db is not None else DatabaseManager(db_path)
+
+        # Менеджер настроек
+        self.settings = SettingsManager()
+
+        # Защита от перегрузки: один узел не должен замедлять остальных
+        self.ip_limiter = RateLimiter(self.settings.get('ingest_ip_rate', 500))
+        self.sender_limiter = RateLimiter(self.settings.get('ingest_sender_rate', 50))
+        self.connection_limiter = RateLimiter(self.CONNECTION_RATE)
+        # Принятые, но еще не обработанные сообщения каждого слушателя
+        self.multicast_ingress = PriorityLanes()
+        self.tcp_ingress = PriorityLanes()
+
+        # Интервал маяков подстраивается под размер сегмента;
+        # presence_interval - его нижняя граница
+        self.presence = PresenceScheduler(self.directory, 10,
+                                          self.settings.get('presence_bandwidth', 2000))
+        self.presence_wakeup = threading.Event()
+
+        # Очередь для сообщений GUI
+        self.message_queue = EventChannel()
+
+        # Метрики; при выключенном HTTP сервере используются пустые заглушки
+        if metrics_port is None:
+            metrics_port = self.settings.get('metrics_port', 0)
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        registry = MetricsRegistry() if metrics_port else NullMetricsRegistry()
+
+        # Инициализация сокетов
+        self.init_sockets()
+        self.metrics = MessengerMetrics(self, registry)
+        self.tracer = MessageTracer(registry, enabled=self.settings.get('tracing', False))
+
+        # Передача файлов по TCP каналу
+        self.file_transfers = FileTransferManager(self)
+
+    def init_sockets(self):
+        """Инициализация сетевых сокетов"""
+        # Multicast сокет для группового чата
+        self.multicast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.multicast_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.join_multicast_group()
+
+        # TCP сервер для личных сообщений
+        self.tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp_server.setblocking(False)
+        self.tcp_server.bind(('0.0.0.0', 0))
+        self.tcp_port = self.tcp_server.getsockname()[1]
+        self.tcp_server.listen(5)
+
+        # Клиентские TCP соединения
+        self.client_sockets = []
+        self.client_buffers = {}
+        # sock -> [IP адрес, время последней активности]
+        self.client_activity = {}
+
+    def join_multicast_group(self):
+        """Присоединение к multicast группе"""
+        try:
+            if self.interface:
+                # Работа через конкретный интерфейс (например, loopback)
+                self.multicast_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                               socket.inet_aton(self.interface))
+            self.multicast_sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                                           self.membership_request(self.multicast_group))
+            self.multicast_sock.bind(('', self.port))
+        except Exception as e:
+            print(f"Multicast error: {e}")
+
+    def membership_request(self, address):
+        """Структура ip_mreq для подписки на адрес"""
+        group = socket.inet_aton(address)
+        if self.interface:
+            return struct.pack('4s4s', group, socket.inet_aton(self.interface))
+        return struct.pack('4sL', group, socket.INADDR_ANY)
+
+    @staticmethod
+    def group_address(group_id):
+        """Собственный multicast адрес реплицируемой группы"""
+        digest = hashlib.sha256(group_id.encode('utf-8')).digest()
+        return f"239.255.{digest[0]}.{digest[1] or 1}"
+
+    def group_destination(self, group_id):
+        """Адрес, на который отправляются сообщения группы"""
+        if group_id in self.subscriptions and self.settings.get('group_multicast', False):
+            return self.group_address(group_id)
+        return self.multicast_group
+
+    def update_subscriptions(self, groups):
+        """Подписка на адреса групп по текущему составу"""
+        if self.settings.get('group_multicast', False):
+            changes = [(group_id, socket.IP_ADD_MEMBERSHIP) for group_id in groups - self.subscriptions]
+            changes += [(group_id, socket.IP_DROP_MEMBERSHIP) for group_id in self.subscriptions - groups]
+            for group_id, option in changes:
+                try:
+                    self.multicast_sock.setsockopt(socket.IPPROTO_IP, option,
+                                                   self.membership_request(self.group_address(group_id)))
+                except OSError as e:
+                    print(f"Group subscription error ({group_id}): {e}")
+        self.subscriptions = groups
+
+    def load_contacts(self):
+        """Загрузка контактов из базы данных"""
+        contacts = self.db.get_contacts(self.username)
+        for contact in contacts:
+            # Присутствие могло прийти раньше загрузки списка
+            self.contacts.setdefault(contact, {'online': False, 'ip': None, 'port': None})
+
+    def load_groups(self):
+        """Загрузка групповых чатов"""
+        groups = self.db.get_user_groups(self.username)
+        for group in groups:
+            self.groups[f"GROUP_{group['id']}"] = {
+                'name': group['name'],
+                'creator': group['creator'],
+                'online': True
+            }
+
+        if not self.memberships.groups:
+            for entry in self.db.get_group_ops():
+                self.memberships.apply(entry)
+        self.refresh_groups()
+
+    def refresh_groups(self):
+        """Реплицируемые группы, в которых мы состоим, по журналу состава"""
+        current = self.memberships.groups_of(self.username)
+        for group_id in self.subscriptions - current.keys():
+            self.groups.pop(group_id, None)
+        for group_id, info in current.items():
+            self.groups[group_id] = dict(info, online=True)
+        self.update_subscriptions(set(current))
+
+    @property
+    def presence_interval(self):
+        """Минимальный интервал маяков присутствия"""
+        return self.presence.min_interval
+
+    @presence_interval.setter
+    def presence_interval(self, value):
+        self.presence.min_interval = value
+
+    def send_presence(self, action='online', username=None):
+        """Отправка маяка присутствия"""
+        presence_msg = {
+            'type': 'presence',
+            'username': username or self.username,
+            'port': self.tcp_port,
+            'action': action,
+            'version': self.presence_version,
+            'caps': PeerDirectory.LOCAL_CAPABILITIES,
+            # По объявленному интервалу получатели считают срок устаревания
+            'interval': round(self.presence.interval(), 1)
+        }
+
+        data = json.dumps(presence_msg).encode('utf-8')
+        self.multicast_sock.sendto(data, (self.multicast_group, self.port))
+        self.presence.sent(len(data))
+        self.metrics.messages_sent.inc('presence')
+        self.metrics.bytes_sent.inc('multicast', amount=len(data))
+
+    def announce_now(self):
+        """Внеочередной маяк при изменении собственного состояния"""
+        self.presence_wakeup.set()
+
+    def broadcast_presence(self):
+        """Рассылка информации о своем присутствии"""
+        if self.announce_presence:
+            # Список участников сегмента приходит сразу, не дожидаясь маяков
+            try:
+                self.send_roster_query()
+            except OSError as e:
+                print(f"Roster query error: {e}")
+
+        while self.running and self.announce_presence:
+            try:
+                self.send_presence()
             except Exception as e:
-                print(f"Send private message error: {e}")
-                return False
+                self.metrics.send_failures.inc('presence')
+                print(f"Presence broadcast error: {e}")
+            try:
+                self.send_group_digest()
+            except OSError as e:
+                print(f"Group digest error: {e}")
+
+            last_sent = time.monotonic()
+            delay = self.presence.next_delay()
+            while self.running:
+                if self.presence_wakeup.wait(max(0.0, last_sent + delay - time.monotonic())):
+                    # Внеочередной маяк или остановка
+                    self.presence_wakeup.clear()
+                    break
+                # Пересмотр таймера: если участников стало больше, пауза растет
+                delay = self.presence.next_delay()
+                if last_sent + delay <= time.monotonic():
+                    break
+
+            self.expire_presence()
+
+    def expire_presence(self):
+        """Контакты, маяки которых перестали приходить, становятся офлайн"""
+        changed = False
+        for username in self.presence.expired():
+            contact = self.contacts.get(username)
+            if contact and contact['online']:
+                contact['online'] = False
+                changed = True
+        if changed:
+            self.message_queue.put(('update_contacts', None))
+
+    def listen_multicast(self):
+        """Прослушивание multicast сообщений.
+
+        Сначала разбираются все ожидающие датаграммы, потом обрабатывается
+        пачка из полос, и сокет читается снова.
+        """
+        while self.running:
+            try:
+                # Пока есть необработанное, сокет только опрашивается
+                timeout = 0 if self.multicast_ingress else None
+                readable, _, _ = select.select([self.multicast_sock, self.wakeup_reader], [], [], timeout)
+                if self.wakeup_reader in readable:
+                    break
+                if self.multicast_sock in readable:
+                    self.read_multicast()
+
+                for _ in range(min(self.INGRESS_BATCH, len(self.multicast_ingress))):
+                    message, addr = self.multicast_ingress.pop()
+                    self.handle_multicast(message, addr)
+
+            except Exception as e:
+                if self.running:
+                    print(f"Multicast listen error: {e}")
+
+    def read_multicast(self):
+        """Чтение ожидающих датаграмм, не больше INGRESS_DRAIN за раз"""
+        for _ in range(self.INGRESS_DRAIN):
+            data, addr = self.multicast_sock.recvfrom(65535)
+            message = self.decode_datagram(data, addr)
+            if message is not None:
+                self.enqueue_ingress(self.multicast_ingress, message, (message, addr))
+            if not select.select([self.multicast_sock], [], [], 0)[0]:
+                return
+
+    def decode_datagram(self, data, addr):
+        """Проверка лимитов и разбор датаграммы; None, если она отброшена"""
+        received_at = time.monotonic()
+        received_wall = time.time()
+        self.metrics.bytes_received.inc('multicast', amount=len(data))
+        # Отбрасываем до разбора: JSON дороже проверки лимита
+        if not self.ip_limiter.allow(addr[0]):
+            self.metrics.throttled.inc('ip')
+            return None
+        try:
+            message = json.loads(data.decode('utf-8'))
+        except ValueError:
+            message = None
+        if not isinstance(message, dict):
+            # Мусор только учитывается: печать на каждый пакет сама стала бы нагрузкой
+            self.metrics.decode_errors.inc('multicast')
+            return None
+        if not self.admit(message, addr[0]):
+            return None
+        self.metrics.messages_received.inc(self.metrics.message_type(message))
+        if 'trace' in message:
+            self.tracer.begin_remote(message, received_at, received_wall)
+        return message
+
+    def enqueue_ingress(self, ingress, message, item):
+        """Постановка принятого сообщения в его полосу"""
+        if message.get('type') in self.CONTROL_TYPES:
+            lane = PriorityLanes.CONTROL
+        else:
+            lane = PriorityLanes.CHAT
+        if ingress.depth(lane) >= self.INGRESS_BACKLOG:
+            self.metrics.throttled.inc('backlog')
+            return
+        ingress.put(lane, item)
+
+    def ingress_depths(self):
+        """Необработанные сообщения обоих слушателей по полосам"""
+        return {lane: self.multicast_ingress.depth(lane) + self.tcp_ingress.depth(lane)
+                for lane in (PriorityLanes.CONTROL, PriorityLanes.CHAT)}
+
+    def admit(self, message, ip):
+        """Лимит на заявленного отправителя разобранного сообщения.
+
+        Имя отправителя ничем не подтверждено, поэтому бюджет считается по
+        паре (адрес, имя): подделка чужого имени с другого адреса тратит
+        только свой бюджет и не заглушает настоящего отправителя.
+        """
+        sender = message.get('sender') or message.get('username')
+        if sender is None or sender == self.username:
+            return True
+        if not self.sender_limiter.allow((ip, str(sender))):
+            self.metrics.throttled.inc('sender')
+            return False
         return True
 
-    def _send_private_message_thread(self, receiver, message):
-        """Поток для отправки личного сообщения"""
+    def handle_multicast(self, message, addr):
+        """Разбор multicast сообщения по типу"""
+        if message['type'] == 'presence':
+            # Присутствие из других сегментов приходит только по TCP (relay_presence)
+            if 'relay_id' not in message:
+                self.handle_presence(message, addr[0])
+        elif message['type'] == 'group_message':
+            self.handle_group_message(message)
+        elif message['type'] == 'roster_query':
+            self.handle_roster_query(message, addr[0])
+        elif message['type'] == 'group_op':
+            self.receive_group_ops([message['op']], self.origin_ip(message, addr), message.get('port'))
+        elif message['type'] == 'group_digest':
+            self.handle_group_digest(message, self.origin_ip(message, addr))
+
+    def origin_ip(self, message, addr):
+        """Адрес автора служебного сообщения состава групп.
+
+        Из другого сегмента его выпускает ретранслятор, и сеть показывает его
+        адрес. По этому адресу идут только запросы пропусков, а журнал
+        отдается лишь участникам группы.
+        """
+        if 'relay_id' in message:
+            return message.get('relay_ip', addr[0])
+        return addr[0]
+
+    def handle_presence(self, message, ip):
+        """Обработка сообщений о присутствии"""
+        if self.record_peer(message['username'], message['action'] == 'online', ip,
+                            message['port'], message.get('version', 0),
+                            message.get('interval'), message.get('caps', 0)):
+            self.message_queue.put(('update_contacts', None))
+
+    def record_peer(self, username, online, ip, port, version, interval=None, capabilities=0,
+                    secondhand=False):
+        """Учет сведений об участнике; True, если изменился контакт"""
+        if username == self.username:
+            return False
+        # Интервал приходит из сети и используется потоком маяков
+        interval = self.presence.clamp_interval(interval)
+
+        # Запоздавшие сведения о прошлом состоянии отбрасываются
+        if not self.directory.update(username, online, ip, port, version, interval, capabilities,
+                                     secondhand):
+            return False
+
+        contact = self.contacts.get(username)
+        if contact is None:
+            return False
+        state = (online, ip, port)
+
+        # Повторный маяк без изменений не трогает GUI
+        if state == (contact['online'], contact['ip'], contact['port']):
+            return False
+        contact['online'], contact['ip'], contact['port'] = state
+        return True
+
+    def send_roster_query(self):
+        """Запрос списка участников у соседей при входе в сегмент"""
+        query = {'type': 'roster_query', 'username': self.username, 'port': self.tcp_port}
+        self.multicast_sock.sendto(json.dumps(query).encode('utf-8'),
+                                   (self.multicast_group, self.port))
+
+    def handle_roster_query(self, message, ip):
+        """Ответ новичку; отвечает в среднем ROSTER_RESPONDERS соседей"""
+        if message['username'] == self.username or not self.announce_presence:
+            return
+
+        others = self.directory.online_count
+        if others and random.random() >= self.ROSTER_RESPONDERS / others:
+            return
+
+        thread = threading.Thread(target=self.send_roster_snapshot,
+                                  args=(ip, message['port'], message['username']))
+        thread.daemon = True
+        thread.start()
+
+    def send_roster_snapshot(self, ip, port, username):
+        """Отправка списка живых участников по TCP"""
+        if self.stop_event.wait(random.uniform(0, self.ROSTER_REPLY_SPREAD)):
+            return
+
+        entries = [(record.username, record.ip, record.port, record.version)
+                   for record in self.directory.alive() if record.username != username]
+        snapshot = {
+            'type': 'roster_snapshot',
+            'sender': self.username,
+            'port': self.tcp_port,
+            'version': self.presence_version,
+            'entries': encode_roster(entries)
+        }
+
+        try:
+            with socket.create_connection((ip, port), timeout=2) as sock:
+                data = json.dumps(snapshot).encode('utf-8') + b'\n'
+                sock.sendall(data)
+            self.metrics.bytes_sent.inc('tcp', amount=len(data))
+        except OSError as e:
+            print(f"Roster snapshot to {username} failed: {e}")
+
+    def handle_roster_snapshot(self, message, ip):
+        """Список участников от соседа"""
+        changed = False
+        for username, peer_ip, port, version in decode_roster(message.get('entries', [])):
+            changed |= self.record_peer(username, True, peer_ip, port, version, secondhand=True)
+        # Отправитель сообщает о себе сам, его адрес - адрес соединения
+        changed |= self.record_peer(message['sender'], True, ip, message['port'],
+                                    message.get('version', 0))
+        if changed:
+            self.message_queue.put(('update_contacts', None))
+
+    def handle_group_message(self, message):
+        """Обработка групповых сообщений"""
+        group_id = message['group_id']
+        if group_id in self.memberships and group_id not in self.subscriptions:
+            # Мы не состоим в группе или уже вышли из нее
+            return
+        if message['sender'] != self.username:
+            self.receive_hlc(message)
+            # Сохраняем в базу данных
+            self.save_message(
+                message['sender'],
+                message['group_id'],
+                'group',
+                message['text'],
+                message['hlc']
+            )
+            self.tracer.stamp(message, 'save')
+
+            # Отправляем в очередь для GUI
+            self.message_queue.put(('group_message', message))
+
+    def send_group_message(self, group_id, text):
+        """Отправка группового сообщения"""
+        try:
+            message = {
+                'type': 'group_message',
+                'sender': self.username,
+                'group_id': group_id,
+                'text': text,
+                'timestamp': datetime.now().isoformat(),
+                'hlc': self.clock.now()
+            }
+            self.tracer.start(message, group_id)
+
+            start = time.perf_counter()
+            data = json.dumps(self.tracer.wire_message(message)).encode('utf-8')
+            self.multicast_sock.sendto(data, (self.group_destination(group_id), self.port))
+            self.tracer.stamp(message, 'send')
+            self.tracer.finish(message)
+            self.metrics.send_seconds.observe(time.perf_counter() - start)
+            self.metrics.messages_sent.inc('group_message')
+            self.metrics.bytes_sent.inc('multicast', amount=len(data))
+
+            # Сохраняем свое сообщение
+            self.save_message(self.username, group_id, 'group', text, message['hlc'])
+            return True
+        except Exception as e:
+            self.metrics.send_failures.inc('group_message')
+            print(f"Send group message error: {e}")
+            return False
+
+    def listen_tcp(self):
+        """Прослушивание TCP соединений для личных сообщений"""
+        while self.running:
+            try:
+                read_sockets = [self.tcp_server, self.wakeup_reader] + self.client_sockets
+                timeout = 0 if self.tcp_ingress else self.idle_timeout()
+                read_sockets, _, _ = select.select(read_sockets, [], [], timeout)
+                if self.wakeup_reader in read_sockets:
+                    break
+                self.evict_idle_clients()
+
+                for sock in read_sockets:
+                    if sock == self.tcp_server:
+                        try:
+                            client_socket, addr = self.tcp_server.accept()
+                        except BlockingIOError:
+                            continue
+                        if not self.admit_connection(addr[0]):
+                            client_socket.close()
+                            continue
+                        client_socket.settimeout(1.0)
+                        self.client_sockets.append(client_socket)
+                        self.client_activity[client_socket] = [addr[0], time.monotonic()]
+                    elif sock in self.client_sockets:
+                        try:
+                            data = sock.recv(65536)
+                            if data:
+                                self.metrics.bytes_received.inc('tcp', amount=len(data))
+                                self.client_activity[sock][1] = time.monotonic()
+                                self.client_buffers[sock] = self.client_buffers.get(sock, b'') + data
+                                self.process_tcp_buffer(sock, received_at=time.monotonic())
+                                if len(self.client_buffers.get(sock, b'')) > self.MAX_TCP_BUFFER:
+                                    self.metrics.throttled.inc('oversize')
+                                    self.close_client(sock)
+                            else:
+                                self.process_tcp_buffer(sock, eof=True)
+                                self.close_client(sock)
+                        except (socket.timeout, ConnectionError):
+                            self.close_client(sock)
+
+                for _ in range(min(self.INGRESS_BATCH, len(self.tcp_ingress))):
+                    ip, message = self.tcp_ingress.pop()
+                    self.handle_tcp_message(ip, message)
+
+            except Exception as e:
+                if self.running:
+                    print(f"TCP listen error: {e}")
+
+    def admit_connection(self, ip):
+        """Прием нового TCP соединения с учетом лимитов"""
+        if not self.connection_limiter.allow(ip):
+            self.metrics.throttled.inc('connection_rate')
+            return False
+        if sum(1 for peer_ip, _ in self.client_activity.values() if peer_ip == ip) >= self.MAX_CLIENTS_PER_IP:
+            self.metrics.throttled.inc('connections')
+            return False
+        if len(self.client_sockets) >= self.MAX_CLIENTS:
+            # Место освобождает соединение, дольше всех молчащее
+            idlest = min(self.client_sockets, key=lambda sock: self.client_activity[sock][1])
+            self.metrics.throttled.inc('evicted')
+            self.close_client(idlest)
+        return True
+
+    def idle_timeout(self):
+        """Ожидание select до ближайшего закрытия молчащего соединения.
+
+        Без клиентов ждать нечего: поток будят сокеты и wakeup_reader.
+        """
+        if not self.client_sockets:
+            return None
+        earliest = min(self.client_activity[sock][1] for sock in self.client_sockets)
+        return max(0.0, earliest + self.CLIENT_IDLE_TIMEOUT - time.monotonic())
+
+    def evict_idle_clients(self):
+        """Закрытие соединений, по которым давно ничего не приходило"""
+        deadline = time.monotonic() - self.CLIENT_IDLE_TIMEOUT
+        for sock in [sock for sock in self.client_sockets if self.client_activity[sock][1] < deadline]:
+            self.metrics.throttled.inc('idle')
+            self.close_client(sock)
+
+    def process_tcp_buffer(self, sock, eof=False, received_at=None):
+        """Разбор накопленных данных TCP соединения.
+
+        Сообщения разделяются переводом строки. Старые клиенты шлют один JSON
+        без разделителя и закрывают соединение - он разбирается при EOF.
+        Разобранные сообщения ставятся в полосы и обрабатываются в listen_tcp.
+        """
+        buffer = self.client_buffers.get(sock, b'')
+        ip = self.client_activity[sock][0]
+        while True:
+            line, sep, rest = buffer.partition(b'\n')
+            if not sep:
+                break
+            buffer = rest
+            if not line.strip():
+                continue
+
+            if not self.ip_limiter.allow(ip):
+                self.metrics.throttled.inc('ip')
+                continue
+            message = self.decode_tcp_message(line, ip, received_at)
+            if message and message.get('type') == 'file_offer':
+                # Дальше соединение обслуживает поток приема файла
+                self.client_sockets.remove(sock)
+                self.client_buffers.pop(sock, None)
+                self.client_activity.pop(sock, None)
+                self.file_transfers.receive(sock, message, buffer, ip)
+                return
+            if message:
+                self.enqueue_ingress(self.tcp_ingress, message, (ip, message))
+
+        if eof and buffer.strip() and self.ip_limiter.allow(ip):
+            message = self.decode_tcp_message(buffer, ip, received_at)
+            if message:
+                self.enqueue_ingress(self.tcp_ingress, message, (ip, message))
+            buffer = b''
+        self.client_buffers[sock] = buffer
+
+    def decode_tcp_message(self, data, ip, received_at=None):
+        """Декодирование JSON сообщения из TCP потока"""
+        received_wall = time.time()
+        try:
+            message = json.loads(data.decode('utf-8'))
+        except ValueError:
+            message = None
+        if not isinstance(message, dict):
+            self.metrics.decode_errors.inc('tcp')
+            return None
+        if not self.admit(message, ip):
+            return None
+        self.metrics.messages_received.inc(self.metrics.message_type(message))
+        if 'trace' in message:
+            self.tracer.begin_remote(message, received_at or time.monotonic(), received_wall)
+        return message
+
+    def handle_tcp_message(self, ip, message):
+        """Разбор TCP сообщения по типу"""
+        msg_type = message.get('type')
+        if msg_type not in ('roster_snapshot', 'group_sync', 'group_ops', 'relay_presence'):
+            self.handle_private_message(message)
+            return
+
+        if msg_type == 'roster_snapshot':
+            self.handle_roster_snapshot(message, ip)
+        elif msg_type == 'relay_presence':
+            self.handle_relay_presence(message, ip)
+        elif msg_type == 'group_sync':
+            self.handle_group_sync(message, ip)
+        else:
+            # Ответ на запрос пропусков сам новых запросов не порождает
+            self.receive_group_ops(message.get('ops', []), ip, None)
+
+    def handle_relay_presence(self, message, ip):
+        """Присутствие из другого сегмента от ретранслятора.
+
+        Адрес участника берется из сообщения, поэтому оно принимается только
+        по TCP от ретранслятора из trusted_relays: иначе любой узел мог бы
+        направить чужие личные сообщения на произвольный адрес.
+        """
+        if ip not in self.settings.get('trusted_relays', []):
+            self.metrics.throttled.inc('untrusted_relay')
+            return
+        presence = message.get('presence')
+        if isinstance(presence, dict) and presence.get('type') == 'presence':
+            self.handle_presence(presence, message['ip'])
+
+    def close_client(self, sock):
+        """Закрытие клиентского TCP соединения"""
+        self.client_buffers.pop(sock, None)
+        self.client_activity.pop(sock, None)
+        if sock in self.client_sockets:
+            sock.close()
+            self.client_sockets.remove(sock)
+
+    def handle_private_message(self, message):
+        """Обработка личных сообщений"""
+        if message['type'] == 'private_message':
+            self.receive_hlc(message)
+            # Сохраняем в базу данных
+            self.save_message(
+                message['sender'],
+                message['receiver'],
+                'private',
+                message['text'],
+                message['hlc']
+            )
+            self.tracer.stamp(message, 'save')
+
+            # Отправляем в очередь для GUI
+            self.message_queue.put(('private_message', message))
+
+    def send_private_message(self, receiver, text):
+        """Отправка личного сообщения"""
+        # Всегда сохраняем сообщение в БД
+        hlc = self.clock.now()
+        self.save_message(self.username, receiver, 'private', text, hlc)
+
+        if receiver in self.contacts and self.contacts[receiver]['online']:
+            try:
+                message = {
+                    'type': 'private_message',
+                    'sender': self.username,
+                    'receiver': receiver,
+                    'text': text,
+                    'timestamp': datetime.now().isoformat(),
+                    'hlc': hlc
+                }
+                self.tracer.start(message, receiver)
+
+                # Создаем отдельный поток для отправки
+                thread = threading.Thread(
+                    target=self._send_private_message_thread,
+                    args=(receiver, message)
+                )
+                thread.daemon = True
+                thread.start()
+                return True
+            except Exception as e:
+                print(f"Send private message error: {e}")
+                return False
+        return True
+
+    def _send_private_message_thread(self, receiver, message):
+        """Поток для отправки личного сообщения"""
+        try:
+            self.tracer.stamp(message, 'thread_spawn')
+            start = time.perf_counter()
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(5.0)
+
+            contact_ip = self.contacts[receiver]['ip']
+            contact_port = self.contacts[receiver]['port']
+
+            sock.connect((contact_ip, contact_port))
+            self.tracer.stamp(message, 'connect')
+            data = json.dumps(self.tracer.wire_message(message)).encode('utf-8') + b'\n'
+            sock.sendall(data)
+            sock.close()
+            self.tracer.stamp(message, 'send')
+            self.tracer.finish(message)
+
+            self.metrics.send_seconds.observe(time.perf_counter() - start)
+            self.metrics.messages_sent.inc('private_message')
+            self.metrics.bytes_sent.inc('tcp', amount=len(data))
+
+        except (socket.timeout, ConnectionError):
+            self.metrics.send_failures.inc('private_message')
+            print(f"Timeout sending message to {receiver}")
+            self.contacts[receiver]['online'] = False
+            self.message_queue.put(('update_contacts', None))
+        except Exception as e:
+            self.metrics.send_failures.inc('private_message')
+            print(f"Error sending to {receiver}: {e}")
+            self.contacts[receiver]['online'] = False
+            self.message_queue.put(('update_contacts', None))
+
+    def save_message(self, sender, receiver, message_type, text, hlc=None):
+        """Сохранение сообщения в базу с учетом времени записи"""
+        if hlc is None:
+            hlc = self.clock.now()
+        start = time.perf_counter()
+        self.db.save_message(sender, receiver, message_type, text, hlc)
+        self.metrics.db_write_seconds.observe(time.perf_counter() - start)
+
+    def receive_hlc(self, message):
+        """Сдвиг часов по метке принятого сообщения.
+
+        Сохраняется метка отправителя, чтобы порядок совпадал на всех узлах.
+        Сообщениям от старых версий без метки и сообщениям с меткой, которую
+        часы не приняли (дальше MAX_DRIFT в будущем), назначается своя:
+        иначе такое сообщение навсегда осталось бы последним в беседе.
+        """
+        hlc = message.get('hlc')
+        local = self.clock.update(hlc)
+        # Принятая метка всегда меньше возвращенной
+        if not isinstance(hlc, int) or hlc >= local:
+            message['hlc'] = local
+
+    def send_file(self, receiver, path):
+        """Отправка файла контакту"""
+        if receiver in self.contacts and self.contacts[receiver]['online']:
+            return self.file_transfers.send(receiver, path)
+        return False
+
+    def answer_file_offer(self, transfer_id, accepted):
+        """Ответ пользователя на файл от отправителя не из контактов"""
+        self.file_transfers.answer(transfer_id, accepted)
+
+    def add_contact(self, contact_username):
+        """Добавление контакта"""
+        # Участника, замеченного в сети, можно добавить без локальной учетной записи
+        known = self.directory.get(contact_username) is not None
+        if contact_username != self.username and self.db.add_contact(self.username, contact_username, known):
+            # Уже замеченный участник сразу показывается в сети
+            peer = self.directory.get(contact_username)
+            if peer and peer.online:
+                self.contacts[contact_username] = {'online': True, 'ip': peer.ip, 'port': peer.port}
+            else:
+                self.contacts[contact_username] = {'online': False, 'ip': None, 'port': None}
+            self.message_queue.put(('update_contacts', None))
+            return True
+        return False
+
+    def create_group(self, group_name):
+        """Создание группового чата, видимого другим участникам"""
+        group_id = f"GROUP_{os.urandom(8).hex()}"
+        if self.group_operation(group_id, 'create', name=group_name):
+            return group_id
+        return None
+
+    def invite_to_group(self, group_id, username):
+        """Добавление участника; журнал группы сразу отправляется ему"""
+        if not self.group_operation(group_id, 'add', member=username):
+            return False
+        peer = self.directory.get(username)
+        if peer and peer.online and peer.port:
+            self.send_tcp_message(peer.ip, peer.port, {
+                'type': 'group_ops',
+                'sender': self.username,
+                'ops': self.memberships.missing(group_id, {})
+            })
+        return True
+
+    def remove_from_group(self, group_id, username):
+        """Исключение участника из группы"""
+        return self.group_operation(group_id, 'remove', member=username)
+
+    def leave_group(self, group_id):
+        """Выход из группы"""
+        return self.group_operation(group_id, 'remove', member=self.username)
+
+    def rename_group(self, group_id, name):
+        """Переименование группы"""
+        return self.group_operation(group_id, 'rename', name=name)
+
+    def group_operation(self, group_id, op, member=None, name=None):
+        """Локальная операция над составом группы и ее рассылка"""
+        if op != 'create' and not self.memberships.is_member(group_id, self.username):
+            return False
+        entry = self.memberships.create_op(group_id, self.username, op, self.clock.now(),
+                                           member, name)
+        self.db.save_group_ops([entry])
+        self.refresh_groups()
+        self.message_queue.put(('update_groups', None))
+
+        message = {'type': 'group_op', 'sender': self.username, 'port': self.tcp_port, 'op': entry}
+        try:
+            data = json.dumps(message).encode('utf-8')
+            self.multicast_sock.sendto(data, (self.multicast_group, self.port))
+            self.metrics.messages_sent.inc('group_op')
+            self.metrics.bytes_sent.inc('multicast', amount=len(data))
+        except OSError as e:
+            # Участники получат операцию при сверке журналов
+            print(f"Group operation broadcast error: {e}")
+        return True
+
+    def receive_group_ops(self, entries, ip, port):
+        """Применение чужих операций; о пропусках спрашиваем источник"""
+        if not isinstance(entries, list):
+            return
+        entries = [entry for entry in entries if GroupMembership.valid(entry)]
+        # Журналы чужих групп не храним, кроме тех, куда нас пригласили
+        invited = {entry.get('group') for entry in entries
+                   if entry.get('op') == 'add' and entry.get('member') == self.username}
+        applied = []
+        gaps = set()
+        for entry in entries:
+            group_id = entry.get('group')
+            if not (group_id in invited or group_id in self.memberships
+                    or self.memberships.awaiting(group_id)):
+                continue
+            self.clock.update(entry['hlc'])
+            applied += self.memberships.apply(entry)
+            if self.memberships.awaiting(group_id):
+                gaps.add(group_id)
+
+        if applied:
+            self.db.save_group_ops(applied)
+            self.refresh_groups()
+            self.message_queue.put(('update_groups', None))
+        if gaps and port:
+            self.request_group_repair(ip, port, gaps)
+
+    def send_group_digest(self):
+        """Рассылка векторов версий своих групп для сверки журналов"""
+        digest = self.memberships.digest(self.username)
+        if not digest:
+            return
+        message = {'type': 'group_digest', 'sender': self.username, 'port': self.tcp_port,
+                   'groups': digest}
+        data = json.dumps(message).encode('utf-8')
+        self.multicast_sock.sendto(data, (self.multicast_group, self.port))
+        self.metrics.messages_sent.inc('group_digest')
+        self.metrics.bytes_sent.inc('multicast', amount=len(data))
+
+    def handle_group_digest(self, message, ip):
+        """Сверка с чужим вектором: недостающее запрашивается по TCP"""
+        if message['sender'] == self.username:
+            return
+        behind = [group_id for group_id, vector in message.get('groups', {}).items()
+                  if group_id in self.memberships and self.memberships.behind(group_id, vector)]
+        if behind:
+            self.request_group_repair(ip, message['port'], behind)
+
+    def request_group_repair(self, ip, port, group_ids):
+        """Запрос недостающих операций у узла, у которого они есть"""
+        self.send_tcp_message(ip, port, {
+            'type': 'group_sync',
+            'sender': self.username,
+            'port': self.tcp_port,
+            'groups': {group_id: self.memberships.vector(group_id) for group_id in group_ids}
+        })
+
+    def handle_group_sync(self, message, ip):
+        """Ответ на запрос пропусков; журнал получают только участники"""
+        entries = []
+        for group_id, vector in message.get('groups', {}).items():
+            if self.memberships.is_member(group_id, message['sender']):
+                entries += self.memberships.missing(group_id, vector)
+        if entries:
+            self.send_tcp_message(ip, message['port'], {
+                'type': 'group_ops',
+                'sender': self.username,
+                'ops': entries
+            })
+
+    def send_tcp_message(self, ip, port, message):
+        """Отправка служебного TCP сообщения в отдельном потоке"""
+        def send():
+            try:
+                with socket.create_connection((ip, port), timeout=2) as sock:
+                    data = json.dumps(message).encode('utf-8') + b'\n'
+                    sock.sendall(data)
+                self.metrics.messages_sent.inc(message['type'])
+                self.metrics.bytes_sent.inc('tcp', amount=len(data))
+            except OSError as e:
+                print(f"{message['type']} to {ip}:{port} failed: {e}")
+
+        thread = threading.Thread(target=send)
+        thread.daemon = True
+        thread.start()
+
+    def get_all_messages(self, limit=500):
+        """Получение всех сообщений пользователя и его групп"""
+        # Групповые сообщения хранятся с id группы в получателе
+        groups = set(self.groups) | {'MAIN_GROUP'}
+        return self.db.get_all_messages(self.username, sorted(groups), limit)
+
+    def update_profile(self, display_name=None, status_text=None):
+        """Обновление профиля пользователя"""
+        return self.db.update_user_profile(self.username, display_name, status_text)
+
+    def change_username(self, new_username):
+        """Изменение имени пользователя"""
+        if new_username == self.username:
+            return True, "Имя не изменилось"
+
+        success = self.db.change_username(self.username, new_username)
+        if success:
+            old_username = self.username
+            self.username = new_username
+            self.presence_version += 1
+            # Соседи узнают о смене имени сразу, а не через интервал маяков
+            if self.announce_presence and self.running:
+                try:
+                    self.send_presence('offline', old_username)
+                except OSError:
+                    pass
+                self.announce_now()
+            return True, f"Имя пользователя изменено с '{old_username}' на '{new_username}'"
+        else:
+            return False, "Пользователь с таким именем уже существует"
+
+    def get_user_profile(self):
+        """Получение профиля пользователя"""
+        return self.db.get_user_profile(self.username)
+
+    def process_message_queue(self, limit=None):
+        """Обработка очереди сообщений для GUI.
+
+        За один вызов обрабатывается не более limit событий; возвращает True,
+        если в очереди что-то осталось. Управляющие события идут раньше
+        сообщений чата. Обновления списков выполняются один раз после пачки,
+        даже если оба события ведут к одному обработчику.
+        """
+        refresh = []
+        for msg_type, message in self.message_queue.drain(limit or sys.maxsize):
+            if msg_type == 'update_contacts' and hasattr(self, 'update_contacts_callback'):
+                refresh.append(self.update_contacts_callback)
+            elif msg_type == 'update_groups' and hasattr(self, 'update_groups_callback'):
+                refresh.append(self.update_groups_callback)
+            elif msg_type == 'group_message' and hasattr(self, 'group_message_callback'):
+                self.tracer.stamp(message, 'queue_wait')
+                self.group_message_callback(message)
+                self.tracer.stamp(message, 'render')
+                self.tracer.finish(message)
+            elif msg_type == 'private_message' and hasattr(self, 'private_message_callback'):
+                self.tracer.stamp(message, 'queue_wait')
+                self.private_message_callback(message)
+                self.tracer.stamp(message, 'render')
+                self.tracer.finish(message)
+            elif msg_type == 'file_progress' and hasattr(self, 'file_progress_callback'):
+                self.file_progress_callback(message)
+            elif msg_type == 'file_request' and hasattr(self, 'file_request_callback'):
+                self.file_request_callback(message)
+            elif msg_type == 'query_result' and hasattr(self, 'query_result_callback'):
+                self.query_result_callback(message)
+
+        for callback in dict.fromkeys(refresh):
+            callback()
+
+        return not self.message_queue.empty()
+
+    def load_roster(self):
+        """Загрузка контактов и групп в фоне, после показа окна"""
+        self.load_contacts()
+        self.load_groups()
+        self.message_queue.put(('update_contacts', None))
+        self.message_queue.put(('update_groups', None))
+        startup_profile.mark('roster_loaded')
+
+    def restore_presence(self, contacts):
+        """Контакты из снимка прошлой сессии, офлайн до первого маяка.
+
+        Порты TCP прошлой сессии уже закрыты, поэтому адреса из снимка не
+        берутся: личные сообщения ждут подтверждения присутствия.
+        """
+        for name, info in contacts.items():
+            # Живой маяк важнее снимка
+            if name != self.username and name not in self.contacts:
+                self.contacts[name] = dict(info)
+        self.message_queue.put(('update_contacts', None))
+
+    def start(self):
+        """Запуск всех потоков"""
+        threads = [
+            threading.Thread(target=self.load_roster),
+            threading.Thread(target=self.listen_multicast),
+            threading.Thread(target=self.listen_tcp),
+            threading.Thread(target=self.broadcast_presence)
+        ]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        self.threads.extend(threads)
+
+        self.start_metrics_server()
+
+    def start_metrics_server(self):
+        """Запуск HTTP сервера метрик, если он включен"""
+        if not self.metrics_port:
+            return
+        try:
+            self.metrics_server = MetricsServer(self.metrics.registry, self.metrics_port)
+            self.metrics_server.start()
+        except OSError as e:
+            print(f"Metrics server error: {e}")
+
+    def wakeup(self):
+        """Пробуждение всех циклов, ждущих в select"""
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            pass
+
+    def stop(self):
+        """Остановка мессенджера.
+
+        Порядок фиксирован: сигнал остановки будит все циклы, их потоки
+        завершаются, затем уходит пакет offline и закрываются сокеты.
+        """
+        if self.stopped:
+            return
+        self.stopped = True
+        self.running = False
+        self.stop_event.set()
+        self.presence_wakeup.set()
+        self.wakeup()
+
+        current = threading.current_thread()
+        for thread in self.threads:
+            if thread is not current:
+                thread.join(2.0)
+
+        if self.metrics_server:
+            self.metrics_server.stop()
+
+        try:
+            if self.announce_presence:
+                # Новая версия: списки соседей с прежней не вернут нас в сеть
+                self.presence_version += 1
+                self.send_presence('offline')
+        except:
+            pass
+
+        try:
+            self.multicast_sock.close()
+        except:
+            pass
+
+        try:
+            self.tcp_server.close()
+        except:
+            pass
+
+        for sock in self.client_sockets:
+            try:
+                sock.close()
+            except:
+                pass
+
+        for sock in (self.wakeup_reader, self.wakeup_writer):
+            sock.close()
+
+
+class RelayLink:
+    """Постоянное TCP соединение с соседним ретранслятором"""
+
+    def __init__(self, sock, outbound):
+        self.sock = sock
+        self.outbound = outbound
+        self.remote_id = None
+        self.duplicate = False
+        # Группа -> ретрансляторы, сегменты которых на нее подписаны
+        self.interest = {}
+        self.advertised = None
+        self.send_lock = threading.Lock()
+        self.reader = sock.makefile('rb')
+
+    def send(self, packet):
+        """Отправка одного кадра (JSON + перевод строки)"""
+        data = json.dumps(packet).encode('utf-8') + b'\n'
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def close(self):
+        """Закрытие соединения; поток чтения выходит сам"""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RelayNode(MulticastMessenger):
+    """Ретранслятор между multicast-сегментами.
+
+    Пересылает присутствие, групповые сообщения и операции состава групп
+    своего сегмента соседним ретрансляторам по постоянным TCP соединениям и выпускает в свой сегмент
+    то, что пришло от них. Групповые сообщения уходят соседу только если его
+    сторона подписана на группу. Петли отсекаются по маршруту пакета и кэшу
+    уже виденных идентификаторов.
+
+    Чужое присутствие несет адрес участника другого сегмента, поэтому оно
+    доставляется участникам своего сегмента не multicast, а по TCP: узлы
+    верят такому адресу только от ретранслятора из trusted_relays.
+    """
+
+    # Соединение доставки присутствия закрывается раньше, чем его закроет
+    # получатель за молчание (CLIENT_IDLE_TIMEOUT)
+    FEED_IDLE = 20.0
+    # Группа, замеченная только по сообщениям в сегменте, забывается после
+    # стольких секунд без ее сообщений
+    LEARNED_TTL = 600.0
+
+    def __init__(self, relay_id, relay_port=0, peers=(), groups=(),
+                 multicast_group='224.1.1.1', port=5007, interface=None,
+                 bind_host='0.0.0.0', max_hops=8, seen_ttl=60.0, seen_limit=65536,
+                 metrics_port=None):
+        super().__init__(f"relay:{relay_id}", multicast_group, port,
+                         db_path=':memory:', interface=interface, metrics_port=metrics_port)
+        self.announce_presence = False
+        self.relay_id = relay_id
+        self.peer_addresses = list(peers)
+        self.max_hops = max_hops
+        self.seen_ttl = seen_ttl
+        self.seen_limit = seen_limit
+        self.seen = collections.OrderedDict()
+        self.seen_lock = threading.Lock()
+        self.packet_counter = itertools.count(1)
+
+        # Группы, интересные нашему сегменту: заданные, замеченные в трафике
+        # и группы участников сегмента по их сводкам и операциям состава
+        self.static_interest = set(groups) | {'MAIN_GROUP'}
+        # Замеченные в трафике: группа -> время последнего сообщения
+        self.learned_groups = {}
+        self.next_expiry = time.monotonic() + self.LEARNED_TTL
+        self.member_groups = {}
+        self.local_interest = set(self.static_interest)
+        # Участники своего сегмента: имя -> (ip, TCP порт)
+        self.local_peers = {}
+        # Присутствие из других сегментов для доставки по TCP
+        self.feed = queue.Queue()
+        self.feed_sockets = {}
+        self.links = {}
+        self.links_lock = threading.Lock()
+
+        self.relay_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.relay_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.relay_server.bind((bind_host, relay_port))
+        self.relay_port = self.relay_server.getsockname()[1]
+        self.relay_server.listen(16)
+        self.relay_server.setblocking(False)
+
+    def start(self):
+        """Запуск потоков ретранслятора"""
+        threads = [
+            threading.Thread(target=self.listen_multicast),
+            threading.Thread(target=self.accept_relays),
+            threading.Thread(target=self.feed_segment)
+        ]
+        for address in self.peer_addresses:
+            threads.append(threading.Thread(target=self.connect_relay, args=(address,)))
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        self.threads.extend(threads)
+
+        self.start_metrics_server()
+
+    def stop(self):
+        """Остановка ретранслятора"""
+        if self.stopped:
+            return
+        self.running = False
+        self.stop_event.set()
+        self.wakeup()
+        self.feed.put(None)
+
+        # Закрытие соединений прерывает потоки, читающие из них
+        with self.links_lock:
+            links = list(self.links.values())
+            self.links.clear()
+        for link in links:
+            link.close()
+
+        super().stop()
+
+        for address in list(self.feed_sockets):
+            self.close_feed(address)
+        try:
+            self.relay_server.close()
+        except:
+            pass
+
+    def accept_relays(self):
+        """Прием входящих соединений от соседних ретрансляторов"""
+        while self.running:
+            readable, _, _ = select.select([self.relay_server, self.wakeup_reader], [], [])
+            if self.wakeup_reader in readable:
+                break
+            try:
+                sock, addr = self.relay_server.accept()
+            except BlockingIOError:
+                continue
+            except OSError:
+                break
+            sock.settimeout(None)
+            self.run_link(RelayLink(sock, outbound=False), background=True)
+
+    def connect_relay(self, address):
+        """Поддержание исходящего соединения с соседом"""
+        delay = 1.0
+        while self.running:
+            try:
+                sock = socket.create_connection(address, timeout=5.0)
+                sock.settimeout(None)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                delay = 1.0
+                link = RelayLink(sock, outbound=True)
+                self.run_link(link)
+
+                # Сосед уже подключился к нам сам - ждем, пока то соединение живо
+                while self.running and link.duplicate and link.remote_id in self.links:
+                    self.stop_event.wait(1.0)
+            except OSError as e:
+                if self.running:
+                    print(f"Relay connect error {address}: {e}")
+
+            # Переподключение с экспоненциальной задержкой
+            self.stop_event.wait(delay)
+            delay = min(delay * 2, 30.0)
+
+    def run_link(self, link, background=False):
+        """Обслуживание соединения с соседом"""
+        if background:
+            thread = threading.Thread(target=self.run_link, args=(link,))
+            thread.daemon = True
+            thread.start()
+            return
+
+        try:
+            link.send({'type': 'relay_hello', 'relay_id': self.relay_id})
+            for line in link.reader:
+                self.handle_relay_frame(link, json.loads(line.decode('utf-8')))
+        except (OSError, ValueError) as e:
+            if self.running and not link.duplicate:
+                print(f"Relay link error ({link.remote_id}): {e}")
+        finally:
+            link.close()
+            link.reader.close()
+            with self.links_lock:
+                if link.remote_id and self.links.get(link.remote_id) is link:
+                    del self.links[link.remote_id]
+            self.advertise_interest()
+
+    def handle_relay_frame(self, link, frame):
+        """Обработка кадра от соседнего ретранслятора; ValueError для некорректного"""
+        if not isinstance(frame, dict):
+            raise ValueError("relay frame is not an object")
+        frame_type = frame.get('type')
+
+        if frame_type == 'relay_hello':
+            remote_id = frame.get('relay_id')
+            if not isinstance(remote_id, str) or not remote_id:
+                raise ValueError("invalid relay id")
+            if remote_id == self.relay_id:
+                raise ValueError("connected to itself")
+            link.remote_id = remote_id
+            self.register_link(link)
+        elif frame_type == 'relay_interest':
+            groups = frame.get('groups', {})
+            if not isinstance(groups, dict) or not all(
+                    isinstance(origins, list) and all(isinstance(origin, str) for origin in origins)
+                    for origins in groups.values()):
+                raise ValueError("invalid relay interest")
+            link.interest = {group: set(origins) for group, origins in groups.items()}
+            # Подписка соседа влияет на то, что мы объявляем остальным
+            self.advertise_interest(exclude=link)
+        elif frame_type == 'relay_packet':
+            self.check_packet(frame)
+            self.handle_relay_packet(frame)
+
+    @staticmethod
+    def check_packet(packet):
+        """Проверка полей пакета от соседа до его разбора"""
+        path = packet.get('path')
+        if not isinstance(packet.get('id'), str) or not isinstance(packet.get('ip'), str) \
+                or not isinstance(path, list) or not all(isinstance(hop, str) for hop in path) \
+                or not isinstance(packet.get('payload'), dict):
+            raise ValueError("invalid relay packet")
+
+    def register_link(self, link):
+        """Регистрация соединения; дубликаты закрываются детерминированно"""
+        initiator = self.relay_id if link.outbound else link.remote_id
+        with self.links_lock:
+            existing = self.links.get(link.remote_id)
+            if existing is not None:
+                existing_initiator = self.relay_id if existing.outbound else existing.remote_id
+                # Оставляем соединение, открытое ретранслятором с меньшим id
+                if existing_initiator <= initiator:
+                    link.duplicate = True
+                    raise ValueError("duplicate link")
+                existing.close()
+            self.links[link.remote_id] = link
+        self.advertise_interest()
+
+    def interest_for(self, link):
+        """Группы, которые нужно запросить у соседа.
+
+        Группа, интересная только самому соседу, ему не объявляется - иначе
+        в топологии с циклом подписка возвращалась бы к источнику.
+        """
+        groups = {group: {self.relay_id} for group in self.local_interest}
+        for other in self.links.values():
+            if other is not link:
+                for group, origins in other.interest.items():
+                    groups.setdefault(group, set()).update(origins)
+        return {group: origins for group, origins in groups.items()
+                if not origins <= {link.remote_id}}
+
+    def advertise_interest(self, exclude=None):
+        """Рассылка таблиц интересов соседям при их изменении"""
+        with self.links_lock:
+            links = [link for link in self.links.values() if link is not exclude]
+            updates = []
+            for link in links:
+                groups = self.interest_for(link)
+                if groups != link.advertised:
+                    link.advertised = groups
+                    updates.append((link, groups))
+
+        for link, groups in updates:
+            try:
+                link.send({
+                    'type': 'relay_interest',
+                    'groups': {group: sorted(origins) for group, origins in groups.items()}
+                })
+            except OSError:
+                link.close()
+
+    def mark_seen(self, packet_id):
+        """Запоминание пакета; возвращает False для дубликата"""
+        now = time.monotonic()
+        with self.seen_lock:
+            # Удаляем устаревшие записи из начала очереди
+            while self.seen:
+                oldest_id, expires = next(iter(self.seen.items()))
+                if expires > now and len(self.seen) < self.seen_limit:
+                    break
+                del self.seen[oldest_id]
+
+            if packet_id in self.seen:
+                return False
+            self.seen[packet_id] = now + self.seen_ttl
+            return True
+
+    def handle_multicast(self, message, addr):
+        """Пересылка трафика своего сегмента соседям"""
+        now = time.monotonic()
+        if now >= self.next_expiry:
+            self.expire_learned(now)
+        if 'relay_id' in message:
+            # Пакет уже выпущен в сегмент ретранслятором
+            return
+
+        msg_type = message.get('type')
+        if msg_type == 'group_message':
+            group_id = message.get('group_id')
+            if not isinstance(group_id, str):
+                return
+            learned = group_id in self.learned_groups
+            self.learned_groups[group_id] = now
+            if not learned and group_id not in self.static_interest:
+                self.update_interest()
+        elif msg_type == 'presence':
+            self.track_local_peer(message, addr[0])
+        elif msg_type == 'group_digest':
+            groups = message.get('groups')
+            if isinstance(groups, dict):
+                self.member_groups[message.get('sender')] = set(groups)
+                self.update_interest()
+        elif msg_type == 'group_op':
+            self.track_group_op(message.get('op'))
+        else:
+            return
+
+        packet = {
+            'type': 'relay_packet',
+            'id': f"{self.relay_id}:{next(self.packet_counter)}",
+            'path': [self.relay_id],
+            'ip': addr[0],
+            'payload': {key: value for key, value in message.items() if key != '_trace'}
+        }
+        self.mark_seen(packet['id'])
+        self.forward(packet)
+
+    def track_local_peer(self, message, ip):
+        """Учет участников своего сегмента по их маякам"""
+        username = message.get('username')
+        if message.get('action') == 'online':
+            self.local_peers[username] = (ip, message.get('port'))
+        elif self.local_peers.pop(username, None) is not None:
+            if self.member_groups.pop(username, None):
+                self.update_interest()
+
+    def track_group_op(self, entry):
+        """Интерес к группе с момента ее создания или приглашения участника сегмента.
+
+        Исключения не учитываются: лишняя подписка стоит только трафика,
+        а следующая сводка group_digest участника ее уберет.
+        """
+        if not isinstance(entry, dict):
+            return
+        if entry.get('op') == 'create':
+            username = entry.get('author')
+        elif entry.get('op') == 'add':
+            username = entry.get('member')
+        else:
+            return
+        if username in self.local_peers:
+            self.member_groups.setdefault(username, set()).add(entry.get('group'))
+            self.update_interest()
+
+    def expire_learned(self, now):
+        """Забывание групп, сообщений которых давно не было в сегменте.
+
+        Проверка идет по пути multicast-трафика: маяки участников сегмента
+        приходят постоянно, а отдельный таймер ретранслятору не нужен.
+        """
+        self.next_expiry = now + self.LEARNED_TTL / 4
+        expired = [group_id for group_id, seen in self.learned_groups.items()
+                   if now - seen > self.LEARNED_TTL]
+        for group_id in expired:
+            del self.learned_groups[group_id]
+        if expired:
+            self.update_interest()
+
+    def update_interest(self):
+        """Пересчет интересов сегмента; соседям объявляются только изменения"""
+        interest = self.static_interest | set(self.learned_groups)
+        for groups in list(self.member_groups.values()):
+            interest |= groups
+        if interest != self.local_interest:
+            self.local_interest = interest
+            self.advertise_interest()
+
+    def handle_relay_packet(self, packet):
+        """Выпуск пакета от соседа в свой сегмент и дальнейшая пересылка"""
+        if not self.mark_seen(packet['id']):
+            return
+
+        payload = dict(packet['payload'])
+        payload['relay_id'] = packet['id']
+        if payload.get('type') in ('group_op', 'group_digest'):
+            # Запросы пропусков идут автору, а не ретранслятору
+            payload['relay_ip'] = packet['ip']
+        if payload.get('type') == 'presence':
+            self.feed.put({'type': 'relay_presence', 'ip': packet['ip'], 'presence': payload})
+        else:
+            try:
+                self.multicast_sock.sendto(
+                    json.dumps(payload).encode('utf-8'),
+                    (self.multicast_group, self.port)
+                )
+            except OSError as e:
+                print(f"Relay inject error: {e}")
+
+        if len(packet['path']) < self.max_hops:
+            packet['path'] = packet['path'] + [self.relay_id]
+            self.forward(packet)
+
+    def feed_segment(self):
+        """Доставка присутствия из других сегментов участникам своего по TCP"""
+        while True:
+            frame = self.feed.get()
+            if frame is None:
+                return
+            data = json.dumps(frame).encode('utf-8') + b'\n'
+            for address in set(self.local_peers.values()):
+                self.feed_send(address, data)
+
+    def feed_send(self, address, data):
+        """Отправка по постоянному соединению с участником сегмента"""
+        now = time.monotonic()
+        entry = self.feed_sockets.get(address)
+        if entry and now - entry[1] > self.FEED_IDLE:
+            self.close_feed(address)
+            entry = None
+        try:
+            if entry is None:
+                entry = self.feed_sockets[address] = [socket.create_connection(address, timeout=2.0), now]
+            entry[0].sendall(data)
+            entry[1] = now
+        except OSError:
+            self.close_feed(address)
+
+    def close_feed(self, address):
+        entry = self.feed_sockets.pop(address, None)
+        if entry:
+            try:
+                entry[0].close()
+            except OSError:
+                pass
+
+    def forward(self, packet):
+        """Отправка пакета соседям с учетом маршрута и подписок"""
+        payload = packet['payload']
+        group_id = payload.get('group_id') if payload.get('type') == 'group_message' else None
+
+        with self.links_lock:
+            links = list(self.links.values())
+
+        for link in links:
+            if link.remote_id in packet['path']:
+                continue
+            if group_id is not None and group_id not in link.interest:
+                continue
+            try:
+                link.send(packet)
+            except OSError:
+                link.close()
+
+
+def run_relay(args):
+    """Запуск узла-ретранслятора без графического интерфейса"""
+    peers = []
+    for peer in args.relay_peer:
+        host, _, port = peer.rpartition(':')
+        peers.append((host, int(port)))
+
+    relay = RelayNode(
+        args.relay,
+        relay_port=args.relay_port,
+        peers=peers,
+        groups=args.relay_group,
+        multicast_group=args.multicast_group or '224.1.1.1',
+        port=args.multicast_port or 5007,
+        interface=args.interface,
+        metrics_port=args.metrics_port
+    )
+    relay.start()
+    print(f"Relay {args.relay} listening on port {relay.relay_port}")
+
+    try:
+        relay.stop_event.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        relay.stop()
+
+
+class LoadGenerator:
+    """Нагрузочный генератор: N виртуальных узлов на loopback.
+
+    Каждый узел - полноценный MulticastMessenger с базой в памяти. Узлы
+    обмениваются присутствием, групповыми и личными сообщениями с заданной
+    интенсивностью; в текст сообщения зашита метка времени отправки, по
+    которой считается задержка доставки до очереди GUI получателя.
+    """
+
+    GROUP_ID = 'LOADTEST'
+
+    def __init__(self, peers=50, duration=30.0, group_rate=0.5, dm_rate=0.5,
+                 presence_interval=10.0, multicast_group='224.1.1.250', port=5099,
+                 interface='127.0.0.1', payload_size=64, warmup=2.0):
+        self.peer_count = peers
+        self.duration = duration
+        self.group_rate = group_rate
+        self.dm_rate = dm_rate
+        self.presence_interval = presence_interval
+        self.multicast_group = multicast_group
+        self.port = port
+        self.interface = interface
+        self.padding = 'x' * payload_size
+        self.warmup = warmup
+
+        self.peers = []
+        self.running = False
+        self.sent = {'group': 0, 'private': 0}
+        self.expected = {'group': 0, 'private': 0}
+        self.delivered = {'group': 0, 'private': 0}
+        self.latencies = {'group': [], 'private': []}
+        self.stats_lock = threading.Lock()
+
+    def create_peers(self):
+        """Создание виртуальных узлов со взаимными контактами"""
+        names = [f"load{i:04d}" for i in range(self.peer_count)]
+        for name in names:
+            # Порт метрик из настроек у всех узлов один - метрики выключены
+            peer = MulticastMessenger(name, self.multicast_group, self.port,
+                                      db_path=':memory:', interface=self.interface,
+                                      metrics_port=0)
+            peer.presence_interval = self.presence_interval
+            for other in names:
+                if other != name:
+                    peer.contacts[other] = {'online': False, 'ip': None, 'port': None}
+            self.peers.append(peer)
+
+    def run(self):
+        """Прогон нагрузки и формирование отчета"""
+        self.create_peers()
+        self.running = True
+        for peer in self.peers:
+            peer.start()
+
+        collector = threading.Thread(target=self.collect)
+        collector.daemon = True
+        collector.start()
+
+        # Даем узлам обменяться присутствием
+        time.sleep(self.warmup)
+
+        cpu_start = time.process_time()
+        wall_start = time.monotonic()
+        self.drive(wall_start + self.duration)
+        # Ждем доставки последних сообщений
+        time.sleep(1.0)
+        wall = time.monotonic() - wall_start
+        cpu = time.process_time() - cpu_start
+
+        self.running = False
+        for peer in self.peers:
+            peer.stop()
+        collector.join(2.0)
+
+        return self.report(wall, cpu)
+
+    def drive(self, deadline):
+        """Генерация трафика с заданной суммарной интенсивностью"""
+        rng = random.Random(1)
+        total_rate = (self.group_rate + self.dm_rate) * self.peer_count
+        if total_rate <= 0:
+            time.sleep(max(0.0, deadline - time.monotonic()))
+            return
+
+        group_share = self.group_rate / (self.group_rate + self.dm_rate)
+        next_send = time.monotonic()
+        seq = 0
+
+        while time.monotonic() < deadline:
+            next_send += rng.expovariate(total_rate)
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            seq += 1
+            sender = rng.choice(self.peers)
+            text = f"load|{seq}|{time.perf_counter_ns()}|{self.padding}"
+
+            if rng.random() < group_share:
+                if sender.send_group_message(self.GROUP_ID, text):
+                    with self.stats_lock:
+                        self.sent['group'] += 1
+                        self.expected['group'] += self.peer_count - 1
+            else:
+                receiver = rng.choice(self.peers).username
+                if receiver == sender.username or not sender.contacts[receiver]['online']:
+                    continue
+                sender.send_private_message(receiver, text)
+                with self.stats_lock:
+                    self.sent['private'] += 1
+                    self.expected['private'] += 1
+
+    def collect(self):
+        """Сбор доставленных сообщений из очередей всех узлов"""
+        while self.running:
+            idle = True
+            for peer in self.peers:
+                while True:
+                    try:
+                        msg_type, message = peer.message_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if msg_type in ('group_message', 'private_message'):
+                        idle = False
+                        self.record(msg_type, message)
+            if idle:
+                time.sleep(0.005)
+
+    def record(self, msg_type, message):
+        """Учет доставки и задержки одного сообщения"""
+        parts = message.get('text', '').split('|')
+        if len(parts) < 3 or parts[0] != 'load':
+            return
+        latency = (time.perf_counter_ns() - int(parts[2])) / 1e6
+        kind = 'group' if msg_type == 'group_message' else 'private'
+        with self.stats_lock:
+            self.delivered[kind] += 1
+            self.latencies[kind].append(latency)
+
+    def report(self, wall, cpu):
+        """Итоговый отчет нагрузочного теста"""
+        lines = [
+            f"Peers: {self.peer_count}, duration: {wall:.1f} s",
+            f"CPU: {cpu:.2f} s total, {cpu / wall * 100:.1f}% of one core, "
+            f"{cpu / self.peer_count * 1000:.1f} ms per peer"
+        ]
+        for kind in ('group', 'private'):
+            latencies = sorted(self.latencies[kind])
+            expected = self.expected[kind]
+            delivered = self.delivered[kind]
+            loss = (1 - delivered / expected) * 100 if expected else 0.0
+            lines.append(
+                f"{kind}: sent {self.sent[kind]}, delivered {delivered}/{expected} "
+                f"({delivered / wall:.0f}/s), loss {loss:.2f}%"
+            )
+            if latencies:
+                lines.append(
+                    "  latency ms: " + ", ".join(
+                        f"p{p}={percentile(latencies, p):.2f}" for p in (50, 90, 99)
+                    ) + f", max={latencies[-1]:.2f}"
+                )
+        return "\n".join(lines)
+
+
+def percentile(sorted_values, p):
+    """Перцентиль по отсортированному списку"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_loadtest(args):
+    """Запуск нагрузочного теста из командной строки"""
+    # Без явного адреса тест идет на своем, иначе синтетические узлы
+    # попадут в базы настоящих мессенджеров сегмента
+    network = {}
+    if args.multicast_group is not None:
+        network['multicast_group'] = args.multicast_group
+    if args.multicast_port is not None:
+        network['port'] = args.multicast_port
+    generator = LoadGenerator(
+        peers=args.loadtest,
+        duration=args.loadtest_duration,
+        group_rate=args.loadtest_group_rate,
+        dm_rate=args.loadtest_dm_rate,
+        presence_interval=args.loadtest_presence_interval,
+        interface=args.interface or '127.0.0.1',
+        **network
+    )
+    print(generator.run())
+
+
+def benchmark_storage(storage, messages, conversations, page_size=100):
+    """Одна и та же нагрузка на хранилище: запись, последние страницы, пролистывание"""
+    rng = random.Random(1)
+    chats = [('user0', f'user{i}', 'private') if i % 2 else ('user0', f'GROUP_{i}', 'group')
+             for i in range(1, conversations + 1)]
+    clock = HybridClock()
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = DatabaseManager(os.path.join(directory, 'bench.db'), storage=storage)
+
+        start = time.perf_counter()
+        for i in range(messages):
+            sender, receiver, message_type = rng.choice(chats)
+            db.save_message(sender, receiver, message_type, f"message {i} " + 'x' * rng.randrange(20, 200),
+                            clock.now())
+        results['append/s'] = messages / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for sender, receiver, message_type in chats:
+            db.get_message_page(sender, receiver, message_type, None, page_size)
+        results['latest page/s'] = len(chats) / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        pages = 0
+        for sender, receiver, message_type in chats:
+            before = None
+            while True:
+                rows = db.get_message_page(sender, receiver, message_type, before, page_size)
+                pages += 1
+                if len(rows) < page_size:
+                    break
+                before = rows[0][0]
+        results['scroll page/s'] = pages / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        db.get_all_messages('user0', [chat[1] for chat in chats if chat[2] == 'group'], 500)
+        results['all messages ms'] = (time.perf_counter() - start) * 1000
+
+        if hasattr(db.messages, 'close'):
+            db.messages.close()
+    return results
+
+
+def run_storage_benchmark(args):
+    """Сравнение хранилищ сообщений на одинаковой нагрузке"""
+    engines = ['sqlite'] + list(DatabaseManager.STORAGE_ENGINES)
+    results = {storage: benchmark_storage(storage, args.bench_storage, args.bench_conversations)
+               for storage in engines}
+
+    print(f"Messages: {args.bench_storage}, conversations: {args.bench_conversations}")
+    metrics = list(results['sqlite'])
+    print(f"{'':>16}" + ''.join(f"{storage:>12}" for storage in engines))
+    for metric in metrics:
+        print(f"{metric:>16}" + ''.join(f"{results[storage][metric]:>12.1f}" for storage in engines))
+
+
+def _messenger_worker_main(username, conn):
+    """Точка входа рабочего процесса: сеть и база данных"""
+    messenger = MulticastMessenger(username)
+    messenger.start()
+    MessengerWorker(messenger, conn).run()
+
+
+class MessengerWorker:
+    """Обслуживание MulticastMessenger в рабочем процессе.
+
+    События из message_queue пересылаются в GUI-процесс пачками по одному
+    каналу, поэтому их порядок сохраняется. Команды GUI выполняются в
+    порядке поступления.
+    """
+
+    def __init__(self, messenger, conn, batch_size=256):
+        self.messenger = messenger
+        self.conn = conn
+        self.batch_size = batch_size
+        self.send_lock = threading.Lock()
+
+    def send(self, packet):
+        """Отправка пакета в GUI-процесс"""
+        with self.send_lock:
+            self.conn.send(packet)
+
+    def run(self):
+        """Основной цикл рабочего процесса"""
+        self.send(('ready', {
+            'username': self.messenger.username,
+            'tcp_port': self.messenger.tcp_port,
+            'contacts': self.snapshot_contacts(),
+            'groups': self.snapshot_groups()
+        }))
+
+        forwarder = threading.Thread(target=self.forward_events)
+        forwarder.daemon = True
+        forwarder.start()
+
+        while True:
+            try:
+                packet = self.conn.recv()
+            except (EOFError, OSError):
+                # GUI-процесс завершился
+                self.messenger.stop()
+                self.messenger.message_queue.put(None)
+                return
+
+            if packet[0] == 'stop':
+                self.messenger.stop()
+                # Пустое событие завершает поток пересылки
+                self.messenger.message_queue.put(None)
+                forwarder.join(2.0)
+                self.send(('stopped', None))
+                return
+
+            _, request_id, target, method, args, kwargs = packet
+            try:
+                obj = self.messenger.db if target == 'db' else self.messenger
+                result = getattr(obj, method)(*args, **kwargs)
+                reply = ('result', request_id, True, result)
+            except Exception as e:
+                print(f"Worker call error ({method}): {e}")
+                reply = ('result', request_id, False, str(e))
+
+            if request_id is not None:
+                self.send(reply)
+
+    def forward_events(self):
+        """Пакетная пересылка событий GUI-процессу"""
+        while True:
+            event = self.messenger.message_queue.get()
+            if event is None:
+                return
+
+            batch = [event]
+            while len(batch) < self.batch_size:
+                try:
+                    event = self.messenger.message_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if event is None:
+                    self.send(('events', [self.prepare_event(item) for item in batch]))
+                    return
+                batch.append(event)
+
+            try:
+                self.send(('events', [self.prepare_event(event) for event in batch]))
+            except (BrokenPipeError, OSError):
+                return
+
+    def prepare_event(self, event):
+        """Добавление к событию состояния, которое нужно GUI"""
+        msg_type, message = event
+        if msg_type == 'update_contacts':
+            return msg_type, self.snapshot_contacts()
+        if msg_type == 'update_groups':
+            return msg_type, self.snapshot_groups()
+        return event
+
+    def snapshot_contacts(self):
+        """Копия списка контактов для передачи в GUI"""
+        return {name: dict(info) for name, info in list(self.messenger.contacts.items())}
+
+    def snapshot_groups(self):
+        """Копия списка групп для передачи в GUI"""
+        return {group_id: dict(info) for group_id, info in list(self.messenger.groups.items())}
+
+
+class RemoteDatabase:
+    """Заместитель DatabaseManager в GUI-процессе"""
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    def __getattr__(self, method):
+        return lambda *args, **kwargs: self.proxy.call(method, *args, target='db', **kwargs)
+
+
+class MessengerProcessProxy:
+    """Заместитель MulticastMessenger для GUI.
+
+    Сам мессенджер и DatabaseManager работают в отдельном процессе, поэтому
+    разбор JSON, запись в SQLite и работа с сокетами не конкурируют с Tk за GIL.
+    Отправка сообщений не ждет ответа рабочего процесса. Синхронные вызовы
+    GUI делает через QueryExecutor, а не из потока Tk.
+    """
+
+    # Дольше рабочий процесс не отвечает только если он завис
+    CALL_TIMEOUT = 10.0
+
+    def __init__(self, username, startup_timeout=10.0):
+        self.username = username
+        self.contacts = {}
+        self.groups = {}
+        self.tcp_port = None
+        self.running = True
+
+        # Настройки читаются из того же файла, что и в рабочем процессе
+        self.settings = SettingsManager()
+
+        # Трассы завершаются в GUI-процессе
+        self.tracer = MessageTracer(NullMetricsRegistry(), enabled=self.settings.get('tracing', False))
+
+        # Очередь для сообщений GUI
+        self.message_queue = EventChannel()
+
+        self.db = RemoteDatabase(self)
+
+        self.send_lock = threading.Lock()
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.next_request_id = 0
+        self.stopped = threading.Event()
+
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_messenger_worker_main,
+            args=(username, child_conn),
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+        # Дожидаемся начального состояния, чтобы GUI сразу показал контакты
+        if not self.conn.poll(startup_timeout):
+            self.process.terminate()
+            raise RuntimeError("Рабочий процесс мессенджера не запустился")
+        _, state = self.conn.recv()
+        self.tcp_port = state['tcp_port']
+        self.contacts = state['contacts']
+        self.groups = state['groups']
+
+    def send(self, packet):
+        """Отправка пакета рабочему процессу"""
+        with self.send_lock:
+            self.conn.send(packet)
+
+    def call(self, method, *args, target='messenger', **kwargs):
+        """Синхронный вызов метода в рабочем процессе.
+
+        RuntimeError, если процесс остановлен или не ответил за CALL_TIMEOUT.
+        """
+        waiter = threading.Event()
+        with self.pending_lock:
+            self.next_request_id += 1
+            request_id = self.next_request_id
+            self.pending[request_id] = [waiter, None]
+
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(5.0)
+            if self.stopped.is_set() or not self.process.is_alive():
+                raise RuntimeError("Рабочий процесс остановлен")
+            try:
+                self.send(('call', request_id, target, method, args, kwargs))
+            except (BrokenPipeError, OSError):
+                raise RuntimeError("Рабочий процесс остановлен")
+            if not waiter.wait(self.CALL_TIMEOUT):
+                raise RuntimeError(f"Рабочий процесс не ответил на {method}")
+        finally:
+            with self.pending_lock:
+                entry = self.pending.pop(request_id)
 
-            contact_ip = self.contacts[receiver]['ip']
-            contact_port = self.contacts[receiver]['port']
+        ok, result = entry[1]
+        if not ok:
+            raise RuntimeError(result)
+        return result
 
-            sock.connect((contact_ip, contact_port))
-            sock.send(json.dumps(message).encode('utf-8'))
-            sock.close()
+    def cast(self, method, *args, **kwargs):
+        """Асинхронный вызов без ожидания результата"""
+        self.send(('call', None, 'messenger', method, args, kwargs))
 
-        except (socket.timeout, ConnectionError):
-            print(f"Timeout sending message to {receiver}")
-            self.contacts[receiver]['online'] = False
-            self.message_queue.put(('update_contacts', None))
-        except Exception as e:
-            print(f"Error sending to {receiver}: {e}")
-            self.contacts[receiver]['online'] = False
-            self.message_queue.put(('update_contacts', None))
+    def read_worker(self):
+        """Прием событий и ответов от рабочего процесса"""
+        while True:
+            try:
+                packet = self.conn.recv()
+            except (EOFError, OSError):
+                break
+
+            kind = packet[0]
+            if kind == 'events':
+                for msg_type, message in packet[1]:
+                    if msg_type == 'update_contacts':
+                        self.contacts = message
+                        message = None
+                    elif msg_type == 'update_groups':
+                        self.groups = message
+                        message = None
+                    self.message_queue.put((msg_type, message))
+            elif kind == 'result':
+                _, request_id, ok, result = packet
+                with self.pending_lock:
+                    entry = self.pending.get(request_id)
+                    if entry:
+                        entry[1] = (ok, result)
+                        entry[0].set()
+            elif kind == 'stopped':
+                break
+
+        self.stopped.set()
+
+        # Не оставляем GUI ждать ответа, который уже не придет
+        with self.pending_lock:
+            for entry in self.pending.values():
+                if entry[1] is None:
+                    entry[1] = (False, "Рабочий процесс остановлен")
+                    entry[0].set()
+
+    def start(self):
+        """Запуск потока приема событий"""
+        thread = threading.Thread(target=self.read_worker)
+        thread.daemon = True
+        thread.start()
+
+    def send_group_message(self, group_id, text):
+        """Отправка группового сообщения"""
+        self.cast('send_group_message', group_id, text)
+        return True
+
+    def send_private_message(self, receiver, text):
+        """Отправка личного сообщения"""
+        self.cast('send_private_message', receiver, text)
+        return True
+
+    def send_file(self, receiver, path):
+        """Отправка файла контакту"""
+        contact = self.contacts.get(receiver)
+        if not contact or not contact['online'] or not os.path.isfile(path):
+            return False
+        self.cast('send_file', receiver, path)
+        return True
+
+    def answer_file_offer(self, transfer_id, accepted):
+        self.cast('answer_file_offer', transfer_id, accepted)
 
     def add_contact(self, contact_username):
         """Добавление контакта"""
-        if contact_username != self.username and self.db.add_contact(self.username, contact_username):
-            self.contacts[contact_username] = {'online': False, 'ip': None, 'port': None}
-            self.message_queue.put(('update_contacts', None))
-            return True
-        return False
+        return self.call('add_contact', contact_username)
+
+    def restore_presence(self, contacts):
+        """Контакты из снимка: сразу в GUI и в рабочий процесс"""
+        for name, info in contacts.items():
+            if name not in self.contacts:
+                self.contacts[name] = dict(info)
+        self.cast('restore_presence', contacts)
 
     def create_group(self, group_name):
         """Создание группового чата"""
-        group_id = self.db.create_group_chat(group_name, self.username)
-        if group_id:
-            self.load_groups()
-            self.message_queue.put(('update_groups', None))
-            return group_id
-        return None
+        return self.call('create_group', group_name)
+
+    def invite_to_group(self, group_id, username):
+        return self.call('invite_to_group', group_id, username)
+
+    def remove_from_group(self, group_id, username):
+        return self.call('remove_from_group', group_id, username)
+
+    def leave_group(self, group_id):
+        return self.call('leave_group', group_id)
+
+    def rename_group(self, group_id, name):
+        return self.call('rename_group', group_id, name)
 
     def get_all_messages(self, limit=500):
         """Получение всех сообщений пользователя"""
-        return self.db.get_all_messages(self.username, limit)
+        return self.call('get_all_messages', limit)
 
     def update_profile(self, display_name=None, status_text=None):
         """Обновление профиля пользователя"""
-        return self.db.update_user_profile(self.username, display_name, status_text)
+        return self.call('update_profile', display_name, status_text)
 
     def change_username(self, new_username):
         """Изменение имени пользователя"""
-        if new_username == self.username:
-            return True, "Имя не изменилось"
-
-        success = self.db.change_username(self.username, new_username)
+        success, message = self.call('change_username', new_username)
         if success:
-            old_username = self.username
             self.username = new_username
-            return True, f"Имя пользователя изменено с '{old_username}' на '{new_username}'"
-        else:
-            return False, "Пользователь с таким именем уже существует"
+        return success, message
 
     def get_user_profile(self):
         """Получение профиля пользователя"""
-        return self.db.get_user_profile(self.username)
+        return self.call('get_user_profile')
+
+    process_message_queue = MulticastMessenger.process_message_queue
 
-    def process_message_queue(self):
-        """Обработка очереди сообщений для GUI"""
+    def stop(self):
+        """Остановка рабочего процесса"""
+        self.running = False
         try:
-            while True:
-                msg_type, message = self.message_queue.get_nowait()
-
-                if msg_type == 'update_contacts' and hasattr(self, 'update_contacts_callback'):
-                    self.update_contacts_callback()
-                elif msg_type == 'update_groups' and hasattr(self, 'update_groups_callback'):
-                    self.update_groups_callback()
-                elif msg_type == 'group_message' and hasattr(self, 'group_message_callback'):
-                    self.group_message_callback(message)
-                elif msg_type == 'private_message' and hasattr(self, 'private_message_callback'):
-                    self.private_message_callback(message)
-
-        except queue.Empty:
+            self.send(('stop',))
+            self.stopped.wait(2.0)
+        except (BrokenPipeError, OSError):
             pass
 
-    def start(self):
-        """Запуск всех потоков"""
-        threads = [
-            threading.Thread(target=self.listen_multicast),
-            threading.Thread(target=self.listen_tcp),
-            threading.Thread(target=self.broadcast_presence)
-        ]
+        self.process.join(2.0)
+        if self.process.is_alive():
+            self.process.terminate()
 
-        for thread in threads:
-            thread.daemon = True
-            thread.start()
 
-    def stop(self):
-        """Остановка мессенджера"""
-        self.running = False
+class SessionSnapshot:
+    """Снимок сессии для мгновенной первой отрисовки.
 
-        try:
-            presence_msg = {
-                'type': 'presence',
-                'username': self.username,
-                'port': self.tcp_port,
-                'action': 'offline'
-            }
+    При выходе из аккаунта или закрытии окна сохраняются имена контактов,
+    группы и последние страницы недавних чатов. При запуске снимок
+    показывается сразу, а затем сверяется с базой и маяками присутствия.
+    Присутствие не сохраняется: контакты показываются офлайн, пока их
+    не подтвердит маяк.
+    """
 
-            self.multicast_sock.sendto(
-                json.dumps(presence_msg).encode('utf-8'),
-                (self.multicast_group, self.port)
-            )
-        except:
-            pass
+    # 2: строки истории начинаются с позиции (hlc, sender), а не с id
+    # 3: контакты без присутствия и адресов
+    VERSION = 3
 
+    def __init__(self, username):
+        digest = hashlib.sha256(username.encode('utf-8')).hexdigest()[:16]
+        self.path = f'session_{digest}.pkl'
+
+    def load(self):
+        """Чтение снимка; None, если его нет или он поврежден"""
         try:
-            self.multicast_sock.close()
-        except:
-            pass
+            with open(self.path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Error loading session snapshot: {e}")
+            return None
+        if not isinstance(snapshot, dict) or snapshot.get('version') != self.VERSION:
+            return None
 
+        snapshot['contacts'] = {name: {'online': False, 'ip': None, 'port': None}
+                                for name in snapshot['contacts']}
+        return snapshot
+
+    def save(self, contacts, groups, chats):
+        """Запись снимка через временный файл"""
+        snapshot = {
+            'version': self.VERSION,
+            'saved_at': time.time(),
+            'contacts': sorted(contacts),
+            'groups': {group_id: dict(info) for group_id, info in groups.items()},
+            'chats': chats
+        }
+        tmp_path = self.path + '.tmp'
         try:
-            self.tcp_server.close()
-        except:
-            pass
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Error saving session snapshot: {e}")
+
+
+class QueryExecutor:
+    """Фоновое выполнение запросов к базе для GUI.
+
+    Запросы выполняются по очереди в одном потоке, результат возвращается
+    через очередь событий мессенджера как событие 'query_result'. Запрос
+    с тем же ключом отменяет предыдущий: еще не начатый пропускается, а
+    результат уже выполненного отбрасывается при доставке.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.jobs = queue.Queue()
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='query-executor', daemon=True)
+        self.thread.start()
+
+    def submit(self, key, func, args, callback, errback=None):
+        """Постановка запроса; callback(result) или errback(error) вызывается в потоке Tk"""
+        with self.lock:
+            generation = self.generations.get(key, 0) + 1
+            self.generations[key] = generation
+        self.jobs.put((key, generation, func, args, callback, errback))
+
+    def cancel(self, key):
+        """Отмена запроса с ключом key"""
+        with self.lock:
+            self.generations[key] = self.generations.get(key, 0) + 1
+
+    def is_current(self, key, generation):
+        with self.lock:
+            return self.generations.get(key) == generation
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+
+            key, generation, func, args, callback, errback = job
+            if not self.is_current(key, generation):
+                continue
 
-        for sock in self.client_sockets:
             try:
-                sock.close()
-            except:
-                pass
+                result, error = func(*args), None
+            except Exception as e:
+                result, error = None, e
+            self.channel.put(('query_result', {
+                'key': key, 'generation': generation, 'callback': callback,
+                'errback': errback, 'result': result, 'error': error
+            }))
+
+    def deliver(self, message):
+        """Передача результата получателю, если запрос не устарел"""
+        if not self.is_current(message['key'], message['generation']):
+            return
+        if message['error'] is not None:
+            print(f"Query {message['key']} failed: {message['error']}")
+            if message['errback']:
+                message['errback'](message['error'])
+            return
+        message['callback'](message['result'])
+
+    def stop(self):
+        self.jobs.put(None)
+
+
+class HistoryCache:
+    """LRU-кэш последних сообщений по чатам.
+
+    Для каждого недавно открытого чата хранится его последняя страница,
+    поэтому возврат в чат не требует запроса к базе. Новые сообщения
+    дописываются в кэш сразу (write-through). Общий объем ограничен
+    budget сообщениями; при превышении вытесняются давно открытые чаты.
+    """
+
+    def __init__(self, budget, per_chat):
+        self.per_chat = per_chat
+        self.budget = max(budget, per_chat)
+        self.chats = collections.OrderedDict()
+        self.loading = set()
+        self.size = 0
+
+    def get(self, key):
+        """Последняя страница чата или None, если ее нет в кэше"""
+        rows = self.chats.get(key)
+        if rows is None or key in self.loading:
+            return None
+        self.chats.move_to_end(key)
+        return list(rows)
+
+    def begin(self, key):
+        """Начало загрузки из базы: новые сообщения копятся до ответа"""
+        self.store(key, [])
+        self.loading.add(key)
+
+    def fill(self, key, rows):
+        """Ответ базы с учетом сообщений, пришедших во время запроса"""
+        arrived = self.chats.get(key, ()) if key in self.loading else ()
+        self.loading.discard(key)
+        recent = {(sender, text) for _, sender, text, _ in rows[-len(arrived):]} if arrived else set()
+        self.store(key, rows + [row for row in arrived if (row[1], row[2]) not in recent])
+
+    def append(self, key, row):
+        """Запись нового сообщения в кэш, если чат в нем есть"""
+        rows = self.chats.get(key)
+        if rows is None:
+            return
+        before = len(rows)
+        rows.append(row)
+        self.size += len(rows) - before
+        # Загружаемый чат ждет ответа базы - его не вытесняем
+        self.evict(keep=key if key in self.loading else None)
+
+    def refresh(self, key, rows):
+        """Сверка страницы из снимка с базой.
+
+        Сообщения, дописанные после восстановления и еще не видимые в
+        ответе базы, сохраняются.
+        """
+        if key not in self.chats or key in self.loading:
+            return
+        seen = {(sender, text) for _, sender, text, _ in rows}
+        last = rows[-1][0] if rows else None
+        extra = [row for row in self.chats[key]
+                 if (row[1], row[2]) not in seen
+                 and (row[0] is None or last is None or row[0] > last)]
+        self.chats[key] = collections.deque(rows + extra, maxlen=self.per_chat)
+        self.size = sum(len(chat) for chat in self.chats.values())
+
+    def export(self):
+        """Содержимое кэша от давних чатов к недавним"""
+        return [(key, list(rows)) for key, rows in self.chats.items() if key not in self.loading]
+
+    def store(self, key, rows):
+        old = self.chats.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.chats[key] = collections.deque(rows, maxlen=self.per_chat)
+        self.size += len(self.chats[key])
+        self.evict()
+
+    def set_budget(self, budget):
+        self.budget = max(budget, self.per_chat)
+        self.evict()
+
+    def evict(self, keep=None):
+        """Вытеснение давно открытых чатов сверх бюджета, кроме keep"""
+        for evicted in list(self.chats):
+            if self.size <= self.budget or len(self.chats) <= 1:
+                break
+            if evicted == keep:
+                continue
+            old = self.chats.pop(evicted)
+            self.loading.discard(evicted)
+            self.size -= len(old)
+
+
+class MessageView:
+    """Окно отрисованных сообщений поверх постраничной истории.
+
+    В Text держится не больше max_rendered сообщений. Прокрутка к верхнему
+    краю подгружает из базы предыдущую страницу, а лишнее удаляется с
+    противоположного края. Новые сообщения копятся и вставляются одной
+    пачкой за кадр.
+
+    Страницы запрашиваются асинхронно: load_page(before, limit, callback)
+    должен вызвать callback(rows) в потоке Tk, когда данные готовы.
+    """
+
+    PAGE_SIZE = 100
+    MAX_RENDERED = 300
+
+    def __init__(self, text, formatter, page_size=PAGE_SIZE, max_rendered=MAX_RENDERED):
+        self.text = text
+        self.formatter = formatter
+        self.page_size = page_size
+        self.max_rendered = max_rendered
+        self.mark_ids = itertools.count()
+
+        # Отрисованные блоки сверху вниз: (метка начала, позиция (hlc, sender)
+        # или None для своих неподтвержденных сообщений и служебных строк)
+        self.blocks = collections.deque()
+        self.pending = []
+        # Служебные строки, пришедшие во время загрузки истории: тег -> строка
+        self.pending_status = {}
+        self.flush_scheduled = False
+        self.load_page = None
+        self.latest_pending = False
+        self.has_older = False
+        # Новейшие сообщения вытеснены при чтении старых
+        self.detached = False
+        self.loading = False
+
+        text.configure(yscrollcommand=self.on_scroll)
+
+    def reset(self, load_page=None, header=None):
+        """Переключение на другой чат.
+
+        load_page отдает строки истории (position, sender, text, timestamp),
+        где position = (hlc, sender); без него история не загружается.
+        """
+        self.cancel()
+        self.load_page = load_page
+        self.pending = []
+        self.pending_status = {}
+        self.text.config(state=tk.NORMAL)
+        self.clear()
+        if header:
+            self.text.insert(tk.END, header, "system")
+        self.text.config(state=tk.DISABLED)
+        self.load_latest()
+
+    def clear(self):
+        """Удаление всего отрисованного"""
+        self.text.delete('1.0', tk.END)
+        for mark, _ in self.blocks:
+            self.text.mark_unset(mark)
+        self.blocks.clear()
+        self.detached = False
+        self.has_older = False
+
+    def load_latest(self):
+        """Запрос последней страницы истории; до ответа видна заглушка"""
+        if not self.load_page:
+            return
+
+        self.loading = True
+        self.latest_pending = True
+        # Страница из кэша приходит сразу, тогда заглушка не нужна
+        self.load_page(None, self.page_size, self.show_latest)
+        if self.latest_pending and not self.blocks:
+            self.text.config(state=tk.NORMAL)
+            self.text.insert(tk.END, "⏳ Загрузка истории...\n", ("system", "placeholder"))
+            self.text.config(state=tk.DISABLED)
+
+    def show_latest(self, rows):
+        """Отрисовка последней страницы истории"""
+        self.loading = False
+        self.latest_pending = False
+
+        # Сообщения, пришедшие во время загрузки, могут уже быть в rows
+        recent = {(sender, text) for _, sender, text, _ in rows[-len(self.pending):]} if self.pending else set()
+        self.pending = [entry for entry in self.pending if entry[:2] not in recent]
+
+        self.text.config(state=tk.NORMAL)
+        self.clear()
+        for position, sender, text, timestamp in rows:
+            self.insert_block(tk.END, position, sender, text, timestamp)
+        self.text.config(state=tk.DISABLED)
+        self.has_older = len(rows) == self.page_size
+        self.text.see(tk.END)
+        pending_status, self.pending_status = self.pending_status, {}
+        for tag, line in pending_status.items():
+            self.show_status(tag, line)
+        if self.pending:
+            self.flush()
+
+    def load_older(self):
+        """Запрос предыдущей страницы при прокрутке к началу"""
+        if not self.load_page or not self.has_older or not self.blocks:
+            self.loading = False
+            return
+
+        first_mark, first_position = self.blocks[0]
+        if first_position is not None:
+            self.load_page(first_position, self.page_size,
+                           lambda rows: self.show_older(first_mark, rows, self.page_size, 0))
+        else:
+            # Верхнее сообщение отправлено отсюда, его позиция неизвестна:
+            # отсчитываем страницу от конца истории
+            rendered = len(self.blocks)
+            self.load_page(None, rendered + self.page_size,
+                           lambda rows: self.show_older(first_mark, rows, rendered + self.page_size, rendered))
+
+    def show_older(self, first_mark, rows, requested, skip_newest):
+        """Вставка предыдущей страницы над отрисованными сообщениями"""
+        self.loading = False
+        if not self.blocks or self.blocks[0][0] != first_mark:
+            # Окно успело сдвинуться, страница уже не подходит
+            return
+
+        self.has_older = len(rows) == requested
+        if skip_newest:
+            rows = rows[:max(0, len(rows) - skip_newest)]
+        if not rows:
+            self.has_older = False
+            return
+
+        # Метка прежнего первого сообщения сдвигается вставкой вправо
+        self.text.config(state=tk.NORMAL)
+        self.text.mark_gravity(first_mark, tk.RIGHT)
+        older = []
+        for position, sender, text, timestamp in rows:
+            older.append(self.insert_block(first_mark, position, sender, text, timestamp, prepend=True))
+        self.text.mark_gravity(first_mark, tk.LEFT)
+        self.blocks.extendleft(reversed(older))
+
+        # Лишнее снизу уходит; вернуться к нему можно прокруткой вниз
+        excess = len(self.blocks) - self.max_rendered
+        if excess > 0:
+            self.text.delete(self.blocks[-excess][0], tk.END)
+            for _ in range(excess):
+                self.text.mark_unset(self.blocks.pop()[0])
+            self.detached = True
+        self.text.config(state=tk.DISABLED)
+        self.text.yview(first_mark)
+
+    def insert_block(self, index, position, sender, text, timestamp, prepend=False):
+        """Вставка одного сообщения с меткой его начала"""
+        mark = f"msg{next(self.mark_ids)}"
+        # Вставка в END идет перед завершающим переводом строки
+        self.text.mark_set(mark, 'end-1c' if index == tk.END else index)
+        self.text.mark_gravity(mark, tk.LEFT)
+        args = []
+        for chunk, tag in self.formatter(sender, text, timestamp):
+            args += [chunk, tag]
+        self.text.insert(index, *args)
+        if not prepend:
+            self.blocks.append((mark, position))
+        return mark, position
+
+    def show_status(self, tag, line):
+        """Служебная строка (прогресс передачи файла) отдельным блоком без позиции.
+
+        Строка с тем же tag, пока она отрисована, обновляется на месте.
+        Как блок она учитывается при обрезке окна и не рвет соседние блоки.
+        """
+        if self.latest_pending:
+            # Загрузка истории очистит окно - строка дождется ее
+            self.pending_status[tag] = line
+            return
+
+        self.text.config(state=tk.NORMAL)
+        ranges = self.text.tag_ranges(tag)
+        if ranges:
+            old = self.text.get(ranges[0], ranges[1])
+            # Новый текст вставляется перед старым: метки блока и следующего
+            # блока остаются на своих местах
+            self.text.mark_set('status_old', ranges[0])
+            self.text.mark_gravity('status_old', tk.RIGHT)
+            self.text.insert(ranges[0], line, ("system", tag))
+            self.text.delete('status_old', f'status_old + {len(old)} chars')
+            self.text.mark_unset('status_old')
+        else:
+            mark = f"msg{next(self.mark_ids)}"
+            self.text.mark_set(mark, 'end-1c')
+            self.text.mark_gravity(mark, tk.LEFT)
+            self.text.insert(tk.END, line, ("system", tag))
+            self.blocks.append((mark, None))
+            self.text.see(tk.END)
+        self.text.config(state=tk.DISABLED)
+
+    def append(self, sender, text, timestamp, position=None):
+        """Новое сообщение; отрисовывается вместе с остальными в кадре"""
+        self.pending.append((sender, text, timestamp, position))
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.text.after_idle(self.flush)
+
+    def flush(self):
+        """Вставка накопленных сообщений одной пачкой"""
+        self.flush_scheduled = False
+        if self.latest_pending:
+            # Новые сообщения дождутся загрузки истории
+            return
+        pending, self.pending = self.pending, []
+        if not pending or self.detached:
+            # Читатель ушел в историю: новые сообщения придут из базы
+            return
+
+        at_bottom = self.text.yview()[1] >= 1.0
+        if not at_bottom and len(self.blocks) + len(pending) > self.max_rendered and self.load_page:
+            self.detached = True
+            return
+
+        self.text.config(state=tk.NORMAL)
+        for sender, text, timestamp, position in pending:
+            self.insert_block(tk.END, position, sender, text, timestamp)
+
+        excess = len(self.blocks) - self.max_rendered
+        if excess > 0:
+            self.text.delete('1.0', self.blocks[excess][0])
+            for _ in range(excess):
+                self.text.mark_unset(self.blocks.popleft()[0])
+            self.has_older = self.load_page is not None
+        self.text.config(state=tk.DISABLED)
+
+        if at_bottom:
+            self.text.see(tk.END)
+
+    def on_scroll(self, first, last):
+        """Прокрутка: обновление полосы и подгрузка у краев окна"""
+        self.text.vbar.set(first, last)
+        if self.loading:
+            return
+        if float(first) <= 0.0 and self.has_older:
+            self.loading = True
+            self.text.after_idle(self.load_older)
+        elif float(last) >= 1.0 and self.detached:
+            self.loading = True
+            self.text.after_idle(self.load_latest)
+
+    def cancel(self):
+        """Сброс ожидания после отмены запроса"""
+        self.loading = False
+        self.latest_pending = False
 
 
 class ModernMessengerGUI:
@@ -817,6 +5799,21 @@ class ModernMessengerGUI:
         self.messenger.private_message_callback = self.handle_private_message
         self.messenger.update_contacts_callback = self.update_chats_list
         self.messenger.update_groups_callback = self.update_chats_list
+        self.messenger.file_progress_callback = self.handle_file_progress
+        self.messenger.file_request_callback = self.handle_file_request
+        self.messenger.query_result_callback = self.handle_query_result
+
+        # Запросы истории выполняются вне потока Tk, последние страницы
+        # недавних чатов берутся из памяти
+        self.queries = QueryExecutor(self.messenger.message_queue)
+        self.history_cache = HistoryCache(
+            self.messenger.settings.get('message_history_limit', 1000), MessageView.PAGE_SIZE)
+
+        self.messenger.settings.subscribe(self.on_settings_changed)
+
+        # Снимок прошлой сессии рисуется сразу, сверка идет в фоне
+        self.session_snapshot = SessionSnapshot(self.messenger.username)
+        self.restore_snapshot()
 
         # Современная цветовая схема
         self.colors = {
@@ -834,15 +5831,17 @@ class ModernMessengerGUI:
         self.setup_ui()
         self.load_chat_history()
 
-        # Запуск обработки очереди сообщений
-        self.process_queue()
+        # Сетевые потоки будят GUI сами, опрос очереди не нужен
+        self.install_event_wakeup()
 
     def setup_ui(self):
         """Настройка современного графического интерфейса"""
         self.root.title(f"✨ NeoChat - {self.messenger.username}")
-        self.root.geometry("1400x900")
+        self.root.geometry(self.messenger.settings.get('window_geometry', "1400x900"))
         self.root.configure(bg=self.colors['primary'])
         self.root.minsize(1200, 800)
+        # Частые события Configure стоят только записи в память
+        self.root.bind('<Configure>', self.on_root_configure, add='+')
 
         # Создаем стили
         self.setup_styles()
@@ -900,13 +5899,10 @@ class ModernMessengerGUI:
                            fg=self.colors['text_primary'])
         app_logo.pack(anchor='w', padx=15, pady=(15, 5))
 
-        # Отображаемое имя пользователя (кликабельное)
-        profile = self.messenger.get_user_profile()
-        display_name = profile['display_name'] if profile else self.messenger.username
-        
+        # Отображаемое имя пользователя (кликабельное); профиль читается в фоне
         self.user_name_label = tk.Label(
             user_profile_frame, 
-            text=f"👤 {display_name}",
+            text=f"👤 {self.messenger.username}",
             font=('Segoe UI', 12, 'bold'),
             bg=self.colors['accent'],
             fg=self.colors['text_primary'],
@@ -914,6 +5910,7 @@ class ModernMessengerGUI:
         )
         self.user_name_label.pack(anchor='w', padx=15, pady=(0, 15))
         self.user_name_label.bind('<Button-1>', self.show_profile_menu)
+        self.queries.submit('display_name', self.messenger.get_user_profile, (), self.show_display_name)
 
         # Панель управления
         control_frame = tk.Frame(sidebar, bg=self.colors['secondary'], pady=15)
@@ -922,7 +5919,10 @@ class ModernMessengerGUI:
         buttons = [
             ("👥 Добавить контакт", self.add_contact_dialog),
             ("🆕 Создать группу", self.create_group_dialog),
+            ("➕ Пригласить в группу", self.invite_to_group_dialog),
+            ("🛠 Управление группой", self.manage_group_menu),
             ("📜 История сообщений", self.show_message_history),
+            ("🗑 Очистить историю чата", self.clear_chat_history),
             ("⚙️ Настройки", self.show_settings_dialog)
         ]
 
@@ -965,6 +5965,7 @@ class ModernMessengerGUI:
                                  scrollregion=self.chats_canvas.bbox('all')))
 
         # Обновляем список чатов
+        self.bind_chat_items()
         self.update_chats_list()
 
     def setup_chat_area(self, parent):
@@ -1001,6 +6002,7 @@ class ModernMessengerGUI:
             highlightthickness=0
         )
         self.messages_text.pack(fill=tk.BOTH, expand=True)
+        self.message_view = MessageView(self.messages_text, self.format_message)
 
         # Настройка тегов для сообщений
         self.setup_message_tags()
@@ -1058,6 +6060,22 @@ class ModernMessengerGUI:
         )
         send_button.pack(side=tk.RIGHT, padx=(10, 0))
 
+        # Кнопка отправки файла
+        attach_button = tk.Button(
+            input_main_frame,
+            text="📎",
+            command=self.send_file_dialog,
+            bg=self.colors['accent'],
+            fg=self.colors['text_primary'],
+            font=('Segoe UI', 14, 'bold'),
+            relief='flat',
+            borderwidth=0,
+            width=3,
+            height=2,
+            cursor='hand2'
+        )
+        attach_button.pack(side=tk.RIGHT, padx=(10, 0))
+
         self.update_char_count()
 
     def setup_message_tags(self):
@@ -1110,19 +6128,14 @@ class ModernMessengerGUI:
             anchor='w'
         )
 
-    def create_chat_item(self, parent, text, is_online, is_group=False):
-        """Создание элемента списка чатов"""
+    def create_chat_item(self, parent, key, text, is_online, is_group=False):
+        """Создание элемента списка чатов с ключом (тип, id)"""
         chat_frame = tk.Frame(parent, bg=self.colors['secondary'], 
                              relief='flat', borderwidth=0)
-        chat_frame.pack(fill=tk.X, padx=5, pady=2)
 
         # Иконка и статус
-        if is_group:
-            icon = "👥"
-            status_color = self.colors['success'] if is_online else self.colors['text_secondary']
-        else:
-            icon = "👤"
-            status_color = self.colors['success'] if is_online else self.colors['text_secondary']
+        icon = "👥" if is_group else "👤"
+        status_color = self.colors['success'] if is_online else self.colors['text_secondary']
 
         icon_label = tk.Label(chat_frame, text=icon, font=('Segoe UI', 12),
                              bg=self.colors['secondary'], fg=self.colors['text_primary'])
@@ -1137,39 +6150,58 @@ class ModernMessengerGUI:
         # Индикатор статуса
         status_canvas = tk.Canvas(chat_frame, width=8, height=8, bg=self.colors['secondary'],
                                  highlightthickness=0)
-        status_canvas.create_oval(0, 0, 8, 8, fill=status_color, outline="")
+        status_oval = status_canvas.create_oval(0, 0, 8, 8, fill=status_color, outline="")
         status_canvas.pack(side=tk.RIGHT, padx=(0, 15))
 
-        # Привязываем события для hover эффекта
-        def on_enter(e):
-            chat_frame.configure(bg=self.colors['accent'])
-            for child in chat_frame.winfo_children():
-                if isinstance(child, tk.Label):
-                    child.configure(bg=self.colors['accent'])
-                elif isinstance(child, tk.Canvas):
-                    child.configure(bg=self.colors['accent'])
-
-        def on_leave(e):
-            chat_frame.configure(bg=self.colors['secondary'])
-            for child in chat_frame.winfo_children():
-                if isinstance(child, tk.Label):
-                    child.configure(bg=self.colors['secondary'])
-                elif isinstance(child, tk.Canvas):
-                    child.configure(bg=self.colors['secondary'])
-
-        def on_click(e):
-            self.on_chat_select(text)
-
-        chat_frame.bind('<Enter>', on_enter)
-        chat_frame.bind('<Leave>', on_leave)
-        chat_frame.bind('<Button-1>', on_click)
-
-        for child in chat_frame.winfo_children():
-            child.bind('<Enter>', on_enter)
-            child.bind('<Leave>', on_leave)
-            child.bind('<Button-1>', on_click)
-
-        return chat_frame
+        item = {
+            'key': key,
+            'frame': chat_frame,
+            'widgets': (chat_frame, icon_label, text_label, status_canvas),
+            'label': text_label,
+            'status': status_canvas,
+            'oval': status_oval,
+            'text': text,
+            'online': is_online,
+        }
+
+        # Hover и клик обрабатываются общими привязками класса ChatItem,
+        # поэтому у элемента нет собственных замыканий
+        for widget in item['widgets']:
+            widget.bindtags(('ChatItem',) + widget.bindtags())
+            self.chat_item_widgets[str(widget)] = item
+
+        return item
+
+    def bind_chat_items(self):
+        """Общие обработчики событий для всех элементов списка чатов"""
+        self.chat_items = {}
+        self.chat_order = []
+        self.chat_item_widgets = {}
+        self.root.bind_class('ChatItem', '<Enter>',
+                             lambda e: self.highlight_chat_item(e, self.colors['accent']))
+        self.root.bind_class('ChatItem', '<Leave>',
+                             lambda e: self.highlight_chat_item(e, self.colors['secondary']))
+        self.root.bind_class('ChatItem', '<Button-1>', self.on_chat_item_click)
+
+    def highlight_chat_item(self, event, color):
+        """Подсветка элемента при наведении"""
+        item = self.chat_item_widgets.get(str(event.widget))
+        if item:
+            for widget in item['widgets']:
+                widget.configure(bg=color)
+
+    def on_chat_item_click(self, event):
+        """Выбор чата кликом по элементу"""
+        item = self.chat_item_widgets.get(str(event.widget))
+        if item:
+            self.on_chat_select(item['key'])
+
+    def remove_chat_item(self, key):
+        """Удаление элемента списка чатов"""
+        item = self.chat_items.pop(key)
+        for widget in item['widgets']:
+            self.chat_item_widgets.pop(str(widget), None)
+        item['frame'].destroy()
 
     def update_char_count(self, event=None):
         """Обновление счетчика символов"""
@@ -1198,49 +6230,147 @@ class ModernMessengerGUI:
             return 'break'
         return None
 
+    # Сколько событий обрабатывается за один проход, чтобы поток
+    # сообщений не замораживал интерфейс
+    DISPATCH_BATCH = 200
+
+    def install_event_wakeup(self):
+        """Подписка на пробуждение от сетевых потоков"""
+        self.wakeup_reader = self.wakeup_writer = None
+        self.root.bind('<<MessagesReady>>', lambda event: self.dispatch_events())
+        self.root.bind('<Destroy>', self.on_destroy, add='+')
+
+        if hasattr(self.root.tk, 'createfilehandler'):
+            # POSIX: сетевой поток пишет байт в пару сокетов и не ждет Tk
+            self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+            self.wakeup_reader.setblocking(False)
+            self.wakeup_writer.setblocking(False)
+            self.root.tk.createfilehandler(self.wakeup_reader, tk.READABLE, self.on_wakeup_socket)
+            waker = self.wake_by_socket
+        elif self.root.tk.eval('info exists tcl_platform(threaded)') == '1':
+            # Windows: виртуальное событие из другого потока
+            waker = self.wake_by_event
+        else:
+            # Tcl без потоков - остается опрос очереди
+            self.process_queue()
+            return
+
+        self.messenger.message_queue.set_waker(waker)
+
+    def wake_by_socket(self):
+        """Пробуждение GUI через пару сокетов"""
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            # Буфер полон - пробуждение уже ожидает обработки
+            pass
+
+    def wake_by_event(self):
+        """Пробуждение GUI виртуальным событием"""
+        try:
+            self.root.event_generate('<<MessagesReady>>', when='tail')
+        except (tk.TclError, RuntimeError):
+            pass
+
+    def on_wakeup_socket(self, fileobj, mask):
+        """Обработчик готовности сокета пробуждения"""
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except OSError:
+            pass
+        self.dispatch_events()
+
+    def dispatch_events(self):
+        """Обработка пачки событий; остаток - в следующем кадре"""
+        if self.messenger.process_message_queue(self.DISPATCH_BATCH):
+            self.root.after(1, self.dispatch_events)
+
+    def on_destroy(self, event):
+        """Отключение пробуждения при закрытии окна"""
+        if event.widget is not self.root:
+            return
+        self.messenger.message_queue.set_waker(None)
+        self.messenger.settings.unsubscribe(self.on_settings_changed)
+        self.queries.stop()
+        if self.wakeup_reader:
+            self.root.tk.deletefilehandler(self.wakeup_reader)
+            self.wakeup_reader.close()
+            self.wakeup_writer.close()
+            self.wakeup_reader = None
+
     def process_queue(self):
-        """Обработка очереди сообщений"""
-        self.messenger.process_message_queue()
+        """Обработка очереди сообщений (режим опроса)"""
+        self.messenger.process_message_queue(self.DISPATCH_BATCH)
         self.root.after(100, self.process_queue)
 
     def update_chats_list(self):
-        """Обновление списка чатов"""
-        # Очищаем текущий список
-        for widget in self.chats_frame.winfo_children():
-            widget.destroy()
-
-        # Основной групповой чат
-        self.create_chat_item(self.chats_frame, "🔥 Основной чат", True, True)
-
-        # Групповые чаты
-        for group_id, group_info in self.messenger.groups.items():
-            self.create_chat_item(self.chats_frame, f"👥 {group_info['name']}", 
-                                group_info['online'], True)
-
-        # Личные чаты
-        for contact, info in self.messenger.contacts.items():
-            self.create_chat_item(self.chats_frame, f"👤 {contact}", 
-                                info['online'], False)
-
-        # Обновляем прокрутку
-        self.chats_canvas.configure(scrollregion=self.chats_canvas.bbox('all'))
-
-    def on_chat_select(self, chat_text):
-        """Обработка выбора чата"""
-        if chat_text.startswith("🔥"):
+        """Обновление списка чатов.
+
+        Элементы хранятся по ключу (тип, id) и переиспользуются: создаются
+        только новые чаты, удаляются исчезнувшие, у остальных меняются
+        лишь текст и цвет индикатора, если они изменились.
+        """
+        # Основной групповой чат, групповые чаты, личные чаты
+        wanted = {('group', 'MAIN_GROUP'): ("🔥 Основной чат", True, True)}
+        for group_id, group_info in list(self.messenger.groups.items()):
+            wanted[('group', group_id)] = (f"👥 {group_info['name']}", group_info['online'], True)
+        for contact, info in list(self.messenger.contacts.items()):
+            wanted[('private', contact)] = (f"👤 {contact}", info['online'], False)
+
+        for key in [key for key in self.chat_items if key not in wanted]:
+            self.remove_chat_item(key)
+        order = [key for key in self.chat_order if key in wanted]
+
+        for key, (text, is_online, is_group) in wanted.items():
+            item = self.chat_items.get(key)
+            if item is None:
+                item = self.create_chat_item(self.chats_frame, key, text, is_online, is_group)
+                self.chat_items[key] = item
+                item['frame'].pack(fill=tk.X, padx=5, pady=2)
+                order.append(key)
+                continue
+
+            if item['text'] != text:
+                item['text'] = text
+                item['label'].configure(text=text)
+            if item['online'] != is_online:
+                item['online'] = is_online
+                color = self.colors['success'] if is_online else self.colors['text_secondary']
+                item['status'].itemconfigure(item['oval'], fill=color)
+
+        # Переставляем только элементы, стоящие не на своем месте
+        wanted_order = list(wanted)
+        if order != wanted_order:
+            for index, key in enumerate(wanted_order):
+                position = order.index(key)
+                if position == index:
+                    continue
+                frame = self.chat_items[key]['frame']
+                if index == 0:
+                    frame.pack_configure(before=self.chat_items[order[0]]['frame'])
+                else:
+                    frame.pack_configure(after=self.chat_items[wanted_order[index - 1]]['frame'])
+                order.insert(index, order.pop(position))
+        self.chat_order = wanted_order
+
+    def on_chat_select(self, key):
+        """Обработка выбора чата по ключу (тип, id)"""
+        chat_type, chat_id = key
+        if chat_type == 'group' and chat_id == 'MAIN_GROUP':
             self.current_chat = 'MAIN_GROUP'
             self.current_chat_type = 'group'
             self.chat_title.config(text="💬 Основной чат")
-        elif chat_text.startswith("👥"):
-            group_name = chat_text[2:]
-            for group_id, info in self.messenger.groups.items():
-                if info['name'] == group_name:
-                    self.current_chat = group_id
-                    self.current_chat_type = 'group'
-                    self.chat_title.config(text=f"👥 {group_name}")
-                    break
-        elif chat_text.startswith("👤"):
-            contact = chat_text[2:]
+        elif chat_type == 'group':
+            # Названия групп не уникальны - выбор идет по id
+            group = self.messenger.groups.get(chat_id)
+            if group is None:
+                return
+            self.current_chat = chat_id
+            self.current_chat_type = 'group'
+            self.chat_title.config(text=f"👥 {group['name']}")
+        else:
+            contact = chat_id
             self.current_chat = contact
             self.current_chat_type = 'private'
             is_online = self.messenger.contacts[contact]['online']
@@ -1251,37 +6381,100 @@ class ModernMessengerGUI:
 
     def load_chat_history(self):
         """Загрузка истории текущего чата"""
-        self.messages_text.config(state=tk.NORMAL)
-        self.messages_text.delete('1.0', tk.END)
+        # Ответ на запрос для предыдущего чата уже не нужен
+        self.queries.cancel('chat_history')
 
-        if self.current_chat_type == 'group':
-            if self.current_chat == 'MAIN_GROUP':
-                self.messages_text.insert(tk.END, 
-                    "Добро пожаловать в основной групповой чат!\n\n", "system")
+        if self.current_chat_type == 'group' and self.current_chat == 'MAIN_GROUP':
+            self.message_view.reset(
+                header="Добро пожаловать в основной групповой чат!\n\n")
+            return
+
+        chat, chat_type = self.current_chat, self.current_chat_type
+        key = (chat_type, chat)
+
+        def load_page(before, limit, callback):
+            latest = before is None and limit == MessageView.PAGE_SIZE
+            if latest:
+                rows = self.history_cache.get(key)
+                if rows is not None:
+                    callback(rows)
+                    return
+                self.history_cache.begin(key)
+
+                def fill(rows):
+                    self.history_cache.fill(key, rows)
+                    callback(rows)
             else:
-                messages = self.messenger.db.get_message_history(
-                    self.messenger.username,
-                    self.current_chat,
-                    'group'
-                )
-                for sender, text, timestamp in messages:
-                    self.display_message(sender, text, timestamp, 'group')
-        else:
-            messages = self.messenger.db.get_message_history(
-                self.messenger.username,
-                self.current_chat,
-                'private'
-            )
-            for sender, text, timestamp in messages:
-                self.display_message(sender, text, timestamp, 'private')
+                fill = callback
+
+            self.queries.submit(
+                'chat_history', self.messenger.db.get_message_page,
+                (self.messenger.username, chat, chat_type, before, limit), fill)
 
-        self.messages_text.config(state=tk.DISABLED)
-        self.messages_text.see(tk.END)
+        self.message_view.reset(load_page)
 
-    def display_message(self, sender, text, timestamp, msg_type):
+    def clear_chat_history(self):
+        """Удаление всей истории открытого чата"""
+        chat, chat_type = self.current_chat, self.current_chat_type
+        if not messagebox.askyesno("Очистить историю", "Удалить всю историю этого чата?",
+                                   parent=self.root):
+            return
+        key = (chat_type, chat)
+
+        def on_dropped(_):
+            self.history_cache.store(key, [])
+            if (self.current_chat_type, self.current_chat) == key:
+                self.load_chat_history()
+
+        self.queries.submit(('drop_conversation', key), self.messenger.db.drop_conversation,
+                            (self.messenger.username, chat, chat_type), on_dropped,
+                            lambda error: self.show_modern_message(
+                                "Ошибка", f"Не удалось удалить историю: {error}", "error"))
+
+    def on_settings_changed(self, changes):
+        """Применение измененных настроек"""
+        if 'message_history_limit' in changes:
+            self.history_cache.set_budget(changes['message_history_limit'])
+
+    def on_root_configure(self, event):
+        """Запоминание размера и положения окна"""
+        if event.widget is self.root:
+            self.messenger.settings.set('window_geometry', self.root.geometry())
+
+    def handle_query_result(self, message):
+        """Результат фонового запроса к базе"""
+        self.queries.deliver(message)
+
+    def restore_snapshot(self):
+        """Восстановление списка чатов и недавних страниц из снимка"""
+        snapshot = self.session_snapshot.load()
+        if not snapshot:
+            return
+
+        for group_id, info in snapshot['groups'].items():
+            self.messenger.groups.setdefault(group_id, info)
+        self.messenger.restore_presence(snapshot['contacts'])
+
+        for key, rows in snapshot['chats']:
+            self.history_cache.store(key, rows)
+            chat_type, chat = key
+            self.queries.submit(
+                ('reconcile', key), self.messenger.db.get_message_page,
+                (self.messenger.username, chat, chat_type, None, MessageView.PAGE_SIZE),
+                lambda rows, key=key: self.history_cache.refresh(key, rows))
+
+    def save_snapshot(self):
+        """Сохранение снимка сессии при выходе"""
+        self.session_snapshot.save(dict(self.messenger.contacts),
+                                   dict(self.messenger.groups),
+                                   self.history_cache.export())
+
+    def display_message(self, sender, text, timestamp, msg_type, position=None):
         """Отображение сообщения в чате"""
-        self.messages_text.config(state=tk.NORMAL)
+        self.message_view.append(sender, text, timestamp, position)
 
+    def format_message(self, sender, text, timestamp):
+        """Разметка сообщения: список пар (текст, тег)"""
         try:
             time_obj = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
             time_str = time_obj.strftime('%H:%M')
@@ -1299,23 +6492,25 @@ class ModernMessengerGUI:
         else:
             prefix = f"[{time_str}] {sender}\n"
 
-        self.messages_text.insert(tk.END, prefix, tag)
-        self.messages_text.insert(tk.END, f"{text}\n\n", tag)
-        
-        self.messages_text.config(state=tk.DISABLED)
-        self.messages_text.see(tk.END)
+        return [(prefix, tag), (f"{text}\n\n", tag)]
 
     def handle_group_message(self, message):
         """Обработка входящего группового сообщения"""
+        position = DatabaseManager.position(message.get('hlc'), message['sender'])
+        self.history_cache.append(('group', message['group_id']),
+                                  (position, message['sender'], message['text'], message['timestamp']))
         if self.current_chat_type == 'group' and self.current_chat == message['group_id']:
             self.display_message(message['sender'], message['text'], 
-                               message['timestamp'], 'group')
+                               message['timestamp'], 'group', position)
 
     def handle_private_message(self, message):
         """Обработка входящего личного сообщения"""
+        position = DatabaseManager.position(message.get('hlc'), message['sender'])
+        self.history_cache.append(('private', message['sender']),
+                                  (position, message['sender'], message['text'], message['timestamp']))
         if self.current_chat_type == 'private' and self.current_chat == message['sender']:
             self.display_message(message['sender'], message['text'], 
-                               message['timestamp'], 'private')
+                               message['timestamp'], 'private', position)
 
     def send_message(self):
         """Отправка сообщения"""
@@ -1343,12 +6538,59 @@ class ModernMessengerGUI:
 
         if success:
             timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            self.history_cache.append((self.current_chat_type, self.current_chat),
+                                      (None, self.messenger.username, text, timestamp))
             self.display_message(self.messenger.username, text, timestamp,
                                self.current_chat_type)
         else:
             self.show_modern_message("Ошибка отправки", 
                                    "Не удалось отправить сообщение", "error")
 
+    def send_file_dialog(self):
+        """Выбор и отправка файла текущему контакту"""
+        if self.current_chat_type != 'private':
+            self.show_modern_message("Передача файлов",
+                                   "Файлы можно отправлять только в личных чатах", "warning")
+            return
+
+        path = filedialog.askopenfilename(parent=self.root, title="Выберите файл")
+        if not path:
+            return
+
+        if not self.messenger.send_file(self.current_chat, path):
+            self.show_modern_message("Ошибка отправки",
+                                   "Контакт не в сети или файл недоступен", "error")
+
+    def handle_file_request(self, info):
+        """Вопрос о приеме файла от отправителя не из контактов"""
+        accepted = messagebox.askyesno(
+            "📥 Входящий файл",
+            f"{info['peer']} (не из ваших контактов) передает файл "
+            f"{info['filename']} ({format_size(info['size'])}). Принять?",
+            parent=self.root)
+        self.messenger.answer_file_offer(info['transfer_id'], accepted)
+
+    def handle_file_progress(self, info):
+        """Отображение прогресса передачи файла в чате"""
+        if self.current_chat_type != 'private' or self.current_chat != info['peer']:
+            return
+
+        if info['status'] == 'done':
+            state = "✅ готово"
+        elif info['status'] == 'failed':
+            state = "⚠️ прервано"
+        elif info['status'] == 'rejected':
+            state = "🚫 отклонено"
+        else:
+            percent = info['done'] * 100 // info['size'] if info['size'] else 100
+            state = f"{percent}%"
+
+        arrow = "📤" if info['direction'] == 'out' else "📥"
+        line = f"{arrow} {info['filename']} ({format_size(info['size'])}): {state}\n"
+
+        # Строка прогресса помечена тегом передачи и обновляется на месте
+        self.message_view.show_status(f"file_{info['transfer_id']}", line)
+
     def add_contact_dialog(self):
         """Современный диалог добавления контакта"""
         self.create_input_dialog("Добавить контакт", "Введите имя пользователя:", 
@@ -1359,6 +6601,60 @@ class ModernMessengerGUI:
         self.create_input_dialog("Создать группу", "Введите название группы:",
                                self.messenger.create_group, "Группа создана")
 
+    def current_managed_group(self):
+        """Открытая реплицируемая группа; None с сообщением, если такой нет"""
+        group_id = self.current_chat
+        if self.current_chat_type != 'group' or 'members' not in self.messenger.groups.get(group_id, {}):
+            self.show_modern_message("Ошибка", "Откройте группу, созданную в этой версии", "error")
+            return None
+        return group_id
+
+    def invite_to_group_dialog(self):
+        """Приглашение участника в открытую группу"""
+        group_id = self.current_managed_group()
+        if group_id is None:
+            return
+        self.create_input_dialog("Пригласить в группу", "Введите имя участника:",
+                               lambda username: self.messenger.invite_to_group(group_id, username),
+                               "Участник добавлен")
+
+    def manage_group_menu(self):
+        """Меню операций над составом открытой группы"""
+        group_id = self.current_managed_group()
+        if group_id is None:
+            return
+
+        menu = tk.Menu(self.root, tearoff=0, bg=self.colors['secondary'], fg=self.colors['text_primary'],
+                      activebackground=self.colors['highlight'], activeforeground=self.colors['text_primary'])
+        menu.add_command(label="✏️ Переименовать", command=lambda: self.create_input_dialog(
+            "Переименовать группу", "Новое название:",
+            lambda name: self.messenger.rename_group(group_id, name), "Группа переименована"))
+        menu.add_command(label="➖ Исключить участника", command=lambda: self.create_input_dialog(
+            "Исключить из группы", "Имя участника:",
+            lambda username: self.messenger.remove_from_group(group_id, username), "Участник исключен"))
+        menu.add_separator()
+        menu.add_command(label="🚪 Покинуть группу", command=lambda: self.leave_group(group_id))
+
+        try:
+            menu.tk_popup(self.root.winfo_pointerx(), self.root.winfo_pointery())
+        finally:
+            menu.grab_release()
+
+    def leave_group(self, group_id):
+        """Выход из группы с подтверждением"""
+        name = self.messenger.groups.get(group_id, {}).get('name', group_id)
+        if not messagebox.askyesno("Покинуть группу", f"Покинуть группу {name}?", parent=self.root):
+            return
+
+        def on_left(success):
+            if not success:
+                self.show_modern_message("Ошибка", "Не удалось покинуть группу", "error")
+            elif self.current_chat == group_id:
+                self.on_chat_select(('group', 'MAIN_GROUP'))
+
+        self.queries.submit(('leave_group', group_id), self.messenger.leave_group, (group_id,),
+                            on_left, lambda error: on_left(False))
+
     def create_input_dialog(self, title, prompt, callback, success_message):
         """Универсальный диалог ввода"""
         dialog = tk.Toplevel(self.root)
@@ -1396,15 +6692,23 @@ class ModernMessengerGUI:
         button_frame = tk.Frame(dialog, bg=self.colors['primary'])
         button_frame.pack(fill=tk.X, padx=50, pady=20)
 
+        def on_result(result):
+            if not dialog.winfo_exists():
+                return
+            submit_btn.config(state=tk.NORMAL)
+            if result:
+                self.show_modern_message("Успех", success_message, "success")
+                dialog.destroy()
+            else:
+                self.show_modern_message("Ошибка", "Операция не выполнена", "error")
+
         def on_submit():
             value = entry.get().strip()
             if value:
-                result = callback(value)
-                if result:
-                    self.show_modern_message("Успех", success_message, "success")
-                    dialog.destroy()
-                else:
-                    self.show_modern_message("Ошибка", "Операция не выполнена", "error")
+                # Вызов может идти в рабочий процесс - поток Tk его не ждет
+                submit_btn.config(state=tk.DISABLED)
+                self.queries.submit(('dialog', title), callback, (value,), on_result,
+                                    lambda error: on_result(False))
 
         submit_btn = tk.Button(button_frame, text="Подтвердить", command=on_submit,
                               bg=self.colors['highlight'], fg=self.colors['text_primary'],
@@ -1460,26 +6764,40 @@ class ModernMessengerGUI:
         history_text.tag_config("header", foreground=self.colors['warning'],
                               font=('Segoe UI', 12, 'bold'))
 
-        # Загрузка истории
-        messages = self.messenger.get_all_messages(1000)
+        # Загрузка истории в фоне
         history_text.insert(tk.END, "=== ПОЛНАЯ ИСТОРИЯ СООБЩЕНИЙ ===\n\n", "header")
+        history_text.insert(tk.END, "⏳ Загрузка...\n", "placeholder")
+        history_text.config(state=tk.DISABLED)
 
-        for sender, receiver, msg_type, text, timestamp in messages:
-            msg_type_str = "Группа" if msg_type == 'group' else "Личное"
-            time_str = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').strftime('%d.%m %H:%M')
+        def show_history(messages):
+            if not history_text.winfo_exists():
+                return
 
-            if sender == self.messenger.username:
-                prefix = "📤 Вы ->"
-                tag = "own"
-            else:
-                prefix = f"📥 {sender} ->"
-                tag = "other"
+            lines = []
+            for sender, receiver, msg_type, text, timestamp in messages:
+                msg_type_str = "Группа" if msg_type == 'group' else "Личное"
+                time_str = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').strftime('%d.%m %H:%M')
 
-            history_text.insert(tk.END,
-                              f"[{time_str}] {prefix} {receiver} ({msg_type_str}): {text}\n",
-                              tag)
+                if sender == self.messenger.username:
+                    prefix = "📤 Вы ->"
+                    tag = "own"
+                else:
+                    prefix = f"📥 {sender} ->"
+                    tag = "other"
 
-        history_text.config(state=tk.DISABLED)
+                lines += [f"[{time_str}] {prefix} {receiver} ({msg_type_str}): {text}\n", tag]
+
+            history_text.config(state=tk.NORMAL)
+            placeholder = history_text.tag_ranges("placeholder")
+            if placeholder:
+                history_text.delete(*placeholder)
+            if lines:
+                history_text.insert(tk.END, *lines)
+            history_text.config(state=tk.DISABLED)
+
+        self.queries.submit('full_history', self.messenger.get_all_messages, (1000,), show_history)
+        history_window.bind('<Destroy>', lambda e: self.queries.cancel('full_history')
+                            if e.widget is history_window else None)
 
         # Кнопка закрытия
         close_btn = tk.Button(history_window, text="Закрыть",
@@ -1498,6 +6816,8 @@ class ModernMessengerGUI:
         
         menu.add_command(label="✏️ Изменить профиль", command=self.show_profile_settings)
         menu.add_command(label="👤 Сменить имя пользователя", command=self.show_change_username_dialog)
+        if self.messenger.tracer.enabled:
+            menu.add_command(label="🔬 Трассировка сообщений", command=self.show_trace_view)
         menu.add_separator()
         menu.add_command(label="🚪 Выйти из аккаунта", command=self.logout)
         
@@ -1507,10 +6827,19 @@ class ModernMessengerGUI:
         finally:
             menu.grab_release()
 
+    def show_display_name(self, profile):
+        """Отображаемое имя из загруженного профиля"""
+        if profile and profile['display_name']:
+            self.user_name_label.config(text=f"👤 {profile['display_name']}")
+
     def show_profile_settings(self):
-        """Показ настроек профиля"""
-        profile = self.messenger.get_user_profile()
-        
+        """Показ настроек профиля после загрузки профиля в фоне"""
+        self.queries.submit('profile', self.messenger.get_user_profile, (),
+                            self.open_profile_settings,
+                            lambda error: self.open_profile_settings(None))
+
+    def open_profile_settings(self, profile):
+        """Окно настроек профиля"""
         settings_window = tk.Toplevel(self.root)
         settings_window.title("✏️ Настройки профиля")
         settings_window.geometry("500x400")
@@ -1570,18 +6899,24 @@ class ModernMessengerGUI:
         button_frame = tk.Frame(main_frame, bg=self.colors['primary'])
         button_frame.pack(fill=tk.X)
 
-        def save_profile():
-            display_name = display_name_var.get().strip()
-            status_text = status_var.get().strip()
-            
-            if self.messenger.update_profile(display_name, status_text):
+        def on_saved(success, display_name):
+            if success:
                 # Обновляем отображаемое имя в интерфейсе
                 self.user_name_label.config(text=f"👤 {display_name}")
                 self.show_modern_message("Успех", "Профиль обновлен", "success")
-                settings_window.destroy()
+                if settings_window.winfo_exists():
+                    settings_window.destroy()
             else:
                 self.show_modern_message("Ошибка", "Не удалось обновить профиль", "error")
 
+        def save_profile():
+            display_name = display_name_var.get().strip()
+            status_text = status_var.get().strip()
+            self.queries.submit('update_profile', self.messenger.update_profile,
+                                (display_name, status_text),
+                                lambda success: on_saved(success, display_name),
+                                lambda error: on_saved(False, display_name))
+
         save_btn = tk.Button(button_frame, text="💾 Сохранить", command=save_profile,
                             bg=self.colors['success'], fg=self.colors['text_primary'],
                             font=('Segoe UI', 12, 'bold'), relief='flat', borderwidth=0,
@@ -1597,6 +6932,62 @@ class ModernMessengerGUI:
         display_name_entry.focus_set()
         display_name_entry.select_range(0, tk.END)
 
+    def show_trace_view(self):
+        """Окно с разбивкой задержек сообщений по этапам"""
+        trace_window = tk.Toplevel(self.root)
+        trace_window.title("🔬 Трассировка сообщений")
+        trace_window.geometry("900x700")
+        trace_window.configure(bg=self.colors['primary'])
+
+        header = tk.Label(trace_window, text="🔬 Задержки по этапам",
+                         font=('Segoe UI', 18, 'bold'), bg=self.colors['accent'],
+                         fg=self.colors['text_primary'], pady=20)
+        header.pack(fill=tk.X)
+
+        trace_text = scrolledtext.ScrolledText(
+            trace_window,
+            wrap=tk.NONE,
+            font=('Consolas', 10),
+            bg=self.colors['secondary'],
+            fg=self.colors['text_primary'],
+            padx=20,
+            pady=20
+        )
+        trace_text.pack(fill=tk.BOTH, expand=True, padx=20, pady=(20, 0))
+        trace_text.tag_config("header", foreground=self.colors['warning'],
+                              font=('Consolas', 11, 'bold'))
+
+        def refresh():
+            tracer = self.messenger.tracer
+            trace_text.config(state=tk.NORMAL)
+            trace_text.delete('1.0', tk.END)
+
+            trace_text.insert(tk.END, "Этап            p50 мс    p90 мс    p99 мс\n", "header")
+            summary = tracer.summary()
+            for stage in tracer.STAGES:
+                if stage in summary:
+                    values = summary[stage]
+                    trace_text.insert(tk.END, f"{stage:<14}{values[50]:>8.2f}{values[90]:>10.2f}"
+                                              f"{values[99]:>10.2f}\n")
+
+            trace_text.insert(tk.END, "\nПоследние сообщения\n", "header")
+            for trace in tracer.recent_traces():
+                arrow = "📤" if trace['direction'] == 'out' else "📥"
+                stages = " → ".join(f"{stage} {ms:.2f}" for stage, ms in trace['stages'])
+                trace_text.insert(tk.END, f"[{trace['time']}] {arrow} {trace['peer']} #{trace['id']} "
+                                          f"всего {trace['total_ms']:.2f} мс\n    {stages}\n")
+            trace_text.config(state=tk.DISABLED)
+
+        refresh()
+
+        button_frame = tk.Frame(trace_window, bg=self.colors['primary'], pady=15)
+        button_frame.pack(fill=tk.X)
+
+        tk.Button(button_frame, text="🔄 Обновить", command=refresh,
+                  bg=self.colors['highlight'], fg=self.colors['text_primary'],
+                  font=('Segoe UI', 11, 'bold'), relief='flat', borderwidth=0,
+                  padx=25, pady=10).pack(side=tk.RIGHT, padx=20)
+
     def show_change_username_dialog(self):
         """Диалог смены имени пользователя"""
         dialog = tk.Toplevel(self.root)
@@ -1654,10 +7045,15 @@ class ModernMessengerGUI:
                 dialog.destroy()
                 return
 
-            success, message = self.messenger.change_username(new_username)
+            self.queries.submit('change_username', self.messenger.change_username, (new_username,),
+                                on_changed, lambda error: on_changed((False, str(error))))
+
+        def on_changed(outcome):
+            success, message = outcome
             if success:
                 self.show_modern_message("Успех", message, "success")
-                dialog.destroy()
+                if dialog.winfo_exists():
+                    dialog.destroy()
                 # Перезапускаем приложение
                 self.root.after(1000, self.restart_application)
             else:
@@ -1722,13 +7118,19 @@ class ModernMessengerGUI:
 
         self.create_settings_section(scrollable_frame, "🚀 Запуск", [
             ("Автоматический вход", "auto_login", "bool"),
-            ("Запуск свернутым", "start_minimized", "bool")
+            ("Запуск свернутым", "start_minimized", "bool"),
+            ("Сеть и хранилище в отдельном процессе", "network_process", "bool")
         ])
 
         self.create_settings_section(scrollable_frame, "👤 Профиль", [
             ("Показывать статус онлайн", "show_online_status", "bool")
         ])
 
+        self.create_settings_section(scrollable_frame, "🛠 Диагностика", [
+            ("Трассировка задержек сообщений", "tracing", "bool"),
+            ("Порт метрик (0 - выключено)", "metrics_port", "int")
+        ])
+
         # Кнопки
         button_frame = tk.Frame(settings_window, bg=self.colors['primary'], pady=20)
         button_frame.pack(fill=tk.X, side=tk.BOTTOM)
@@ -1788,14 +7190,14 @@ class ModernMessengerGUI:
 
     def save_settings(self, settings_window):
         """Сохранение настроек"""
-        # Собираем все настройки из виджетов
-        for widget in settings_window.winfo_children():
-            if isinstance(widget, tk.Canvas):
-                for child in widget.winfo_children():
-                    if isinstance(child, tk.Frame):
-                        self.process_settings_frame(child)
+        # Собираем все настройки из виджетов; запись на диск одна и в фоне
+        with self.messenger.settings.transaction():
+            for widget in settings_window.winfo_children():
+                if isinstance(widget, tk.Canvas):
+                    for child in widget.winfo_children():
+                        if isinstance(child, tk.Frame):
+                            self.process_settings_frame(child)
         
-        self.messenger.settings.save_settings()
         self.show_modern_message("Успех", "Настройки сохранены", "success")
         settings_window.destroy()
 
@@ -1822,6 +7224,7 @@ class ModernMessengerGUI:
     def logout(self):
         """Выход из аккаунта"""
         if messagebox.askyesno("Выход", "Вы уверены, что хотите выйти из аккаунта?"):
+            self.save_snapshot()
             self.messenger.stop()
             self.root.destroy()
             # Перезапускаем приложение для показа окна входа
@@ -1829,6 +7232,7 @@ class ModernMessengerGUI:
 
     def restart_application(self):
         """Перезапуск приложения"""
+        self.save_snapshot()
         self.messenger.stop()
         self.root.destroy()
         main()
@@ -2201,13 +7605,20 @@ class ModernLoginWindow:
         self.root.withdraw()
 
         main_root = tk.Toplevel(self.root)
-        messenger = MulticastMessenger(username)
+        if SettingsManager().get('network_process'):
+            # Сеть и база данных работают в отдельном процессе
+            messenger = MessengerProcessProxy(username)
+        else:
+            # Соединение окна входа переходит мессенджеру
+            messenger = MulticastMessenger(username, db=self.db)
         messenger.start()
 
         gui = ModernMessengerGUI(main_root, messenger)
+        main_root.after_idle(lambda: startup_profile.mark('main_window_paint'))
 
         def on_closing():
             if messagebox.askokcancel("Выход", "Вы уверены, что хотите выйти?"):
+                gui.save_snapshot()
                 messenger.stop()
                 main_root.destroy()
                 self.root.destroy()
@@ -2216,9 +7627,63 @@ class ModernLoginWindow:
         main_root.focus_set()
 
 
+def parse_args(argv=None):
+    """Разбор аргументов командной строки"""
+    parser = argparse.ArgumentParser(description="NeoChat")
+    parser.add_argument('--relay', metavar='ID',
+                        help="запустить узел-ретранслятор без интерфейса")
+    parser.add_argument('--relay-port', type=int, default=5008,
+                        help="TCP порт для соседних ретрансляторов")
+    parser.add_argument('--relay-peer', action='append', default=[], metavar='HOST:PORT',
+                        help="адрес соседнего ретранслятора (можно несколько)")
+    parser.add_argument('--relay-group', action='append', default=[], metavar='GROUP_ID',
+                        help="группа, на которую всегда подписан сегмент")
+    parser.add_argument('--multicast-group',
+                        help="multicast адрес сегмента (по умолчанию 224.1.1.1, у --loadtest свой)")
+    parser.add_argument('--multicast-port', type=int,
+                        help="UDP порт сегмента (по умолчанию 5007, у --loadtest свой)")
+    parser.add_argument('--interface', help="IP адрес интерфейса для multicast")
+    parser.add_argument('--metrics-port', type=int,
+                        help="порт локального HTTP сервера метрик Prometheus")
+    parser.add_argument('--loadtest', type=int, metavar='N',
+                        help="нагрузочный тест с N виртуальными узлами на loopback")
+    parser.add_argument('--loadtest-duration', type=float, default=30.0)
+    parser.add_argument('--loadtest-group-rate', type=float, default=0.5,
+                        help="групповых сообщений в секунду на узел")
+    parser.add_argument('--loadtest-dm-rate', type=float, default=0.5,
+                        help="личных сообщений в секунду на узел")
+    parser.add_argument('--loadtest-presence-interval', type=float, default=10.0)
+    parser.add_argument('--bench-storage', type=int, metavar='N',
+                        help="сравнить хранилища сообщений на N сообщениях")
+    parser.add_argument('--bench-conversations', type=int, default=50)
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="вывести время этапов запуска до первой отрисовки")
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+
 def main():
+    if getattr(sys, 'frozen', False):
+        multiprocessing.freeze_support()
+    args = parse_args()
+    if args.relay:
+        run_relay(args)
+        return
+    if args.loadtest:
+        run_loadtest(args)
+        return
+    if args.bench_storage:
+        run_storage_benchmark(args)
+        return
+
+    startup_profile.enabled = args.profile_startup
+    startup_profile.mark('imports')
     root = tk.Tk()
+    startup_profile.mark('tk_ready')
     login_app = ModernLoginWindow(root)
+    startup_profile.mark('login_window')
+    # Отложенные вызовы выполняются после перерисовки окна
+    root.after_idle(lambda: startup_profile.mark('first_paint'))
 
     def on_closing():
         if messagebox.askokcancel("Выход", "Вы уверены, что хотите выйти?"):
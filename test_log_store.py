@@ -0,0 +1,75 @@
+"""Журнал сообщений: компакция, повторное открытие и неудачная подмена каталога"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import deepseek_python_20251113_43ee8e as neochat
+
+
+class LogMessageStoreTest(unittest.TestCase):
+    SEGMENT_SIZE = 4096
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'messages.log')
+        self.store = neochat.LogMessageStore(self.path, self.SEGMENT_SIZE)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.root)
+
+    def fill(self):
+        """По 40 сообщений в трех беседах; сегменты сменяются несколько раз"""
+        for i in range(120):
+            receiver = f'peer{i % 3}'
+            self.store.save('me', receiver, 'private', f'text {i}', i + 1, self.key(receiver))
+
+    @staticmethod
+    def key(receiver):
+        return neochat.DatabaseManager.conversation_key('me', receiver, 'private')
+
+    def pages(self, store):
+        return {receiver: store.page(self.key(receiver), None, 1000)
+                for receiver in ('peer0', 'peer1', 'peer2')}
+
+    def test_compact_and_reopen(self):
+        self.fill()
+        self.assertTrue(self.store.drop(self.key('peer1')))
+        self.store.compact()
+        expected = self.pages(self.store)
+        self.assertEqual(expected['peer1'], [])
+        self.assertEqual([row[2] for row in expected['peer0']], [f'text {i}' for i in range(0, 120, 3)])
+        self.assertEqual(self.store.live_bytes, self.store.total_bytes)
+
+        self.store.close()
+        self.store = neochat.LogMessageStore(self.path, self.SEGMENT_SIZE)
+        self.assertEqual(self.pages(self.store), expected)
+        self.assertFalse(os.path.exists(self.path + '.compact'))
+        self.assertFalse(os.path.exists(self.path + '.old'))
+
+    def test_failed_swap_keeps_store_usable(self):
+        self.fill()
+        self.store.drop(self.key('peer2'))
+        expected = self.pages(self.store)
+
+        replace = os.replace
+
+        def fail_compacted(source, target):
+            if source.endswith('.compact'):
+                raise PermissionError(source)
+            replace(source, target)
+
+        with mock.patch.object(neochat.os, 'replace', side_effect=fail_compacted):
+            with self.assertRaises(PermissionError):
+                self.store.compact()
+
+        self.assertEqual(self.pages(self.store), expected)
+        self.store.save('me', 'peer0', 'private', 'after', 1000, self.key('peer0'))
+        self.assertEqual(self.store.page(self.key('peer0'), None, 1)[0][2], 'after')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+"""Остановка узлов: без ожидания таймаутов циклов и с завершенными потоками"""
+
+import time
+import unittest
+
+import deepseek_python_20251113_43ee8e as neochat
+
+
+class StopTest(unittest.TestCase):
+    # Остановка ждет только завершения потоков, а не таймаутов их циклов
+    MAX_STOP_SECONDS = 0.1
+
+    def assert_stops_quickly(self, node):
+        time.sleep(0.2)
+        start = time.perf_counter()
+        node.stop()
+        elapsed = time.perf_counter() - start
+
+        self.assertLess(elapsed, self.MAX_STOP_SECONDS)
+        for thread in node.threads:
+            self.assertFalse(thread.is_alive(), thread.name)
+        # Повторная остановка ничего не делает
+        node.stop()
+
+    def test_messenger_stop(self):
+        node = neochat.MulticastMessenger('stop-test', '224.1.1.91', 5191, db_path=':memory:',
+                                          interface='127.0.0.1', metrics_port=0)
+        node.start()
+        self.assert_stops_quickly(node)
+
+    def test_relay_stop(self):
+        remote = neochat.RelayNode('stop-remote', bind_host='127.0.0.1', multicast_group='224.1.1.92',
+                                   port=5192, interface='127.0.0.1', metrics_port=0)
+        relay = neochat.RelayNode('stop-local', bind_host='127.0.0.1',
+                                  peers=[('127.0.0.1', remote.relay_port)],
+                                  multicast_group='224.1.1.91', port=5191,
+                                  interface='127.0.0.1', metrics_port=0)
+        remote.start()
+        relay.start()
+        try:
+            # Останавливаем с открытым соединением между ретрансляторами
+            deadline = time.monotonic() + 2.0
+            while not relay.links and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(relay.links)
+            self.assert_stops_quickly(relay)
+        finally:
+            remote.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()